@@ -0,0 +1,323 @@
+"""
+Local OpenAI-compatible chat completions server for benchmarks.
+
+It answers every POST (Azure or OpenAI routes) with a small chat completion,
+after a configurable latency, and can fail a share of the requests with 500
+errors or 429 rate limits (random, or from a requests-per-minute window).
+Nothing is sent to Azure, so the captioning pipeline can be measured for free.
+
+The Files and Batches routes of the Batch API are mocked too: a created
+batch completes at once, its requests answered like chat completions.
+
+Usage:
+$ python -m benchmarks.mock_server --port 8765 --latency 0.2 --rate-limit-rate 0.05
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import Counter, deque
+from email import message_from_bytes
+from typing import Dict, Optional, Tuple
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+
+class MockOpenAIServer:
+    """
+    Threaded mock of the chat completions endpoint.
+
+    Args:
+        host (str): Interface to listen on.
+        port (int): Port to listen on; 0 picks a free port.
+        latency (float): Base response latency, in seconds.
+        jitter (float): Extra latency drawn uniformly from [0, jitter], in seconds.
+        error_rate (float): Share of requests answered with a 500 error.
+        rate_limit_rate (float): Share of requests answered with a 429.
+        max_rpm (int, optional): Answer 429 once more than `max_rpm` requests
+            were accepted in the last 60 seconds.
+        retry_after (float): Value of the `retry-after` header of 429 responses.
+        seed (int): Seed of the failure draws.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        max_rpm: Optional[int] = None,
+        retry_after: float = 1.0,
+        seed: int = 0
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.max_rpm = max_rpm
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._accepted = deque()
+        self._files = {}
+        self._batches = {}
+        self.reset_stats()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._stats = {"requests": 0, "bytes_received": 0, "bytes_sent": 0, "status": Counter(), "connections": set()}
+
+    def stats(self) -> Dict:
+        """
+        Returns the request count, bytes received and sent, status counts and
+        number of distinct client connections since the last reset.
+        """
+        with self._lock:
+            return {
+                "requests": self._stats["requests"],
+                "bytes_received": self._stats["bytes_received"],
+                "bytes_sent": self._stats["bytes_sent"],
+                "status": {str(k): v for k, v in sorted(self._stats["status"].items())},
+                "connections": len(self._stats["connections"])
+            }
+
+    def _outcome(self) -> int:
+        with self._lock:
+            draw = self._random.random()
+            if draw < self.error_rate:
+                return 500
+            if draw < self.error_rate + self.rate_limit_rate:
+                return 429
+            if self.max_rpm is not None:
+                now = time.monotonic()
+                while self._accepted and now - self._accepted[0] > 60:
+                    self._accepted.popleft()
+                if len(self._accepted) >= self.max_rpm:
+                    return 429
+                self._accepted.append(now)
+            return 200
+
+    def _chat(self, body: bytes) -> Tuple[int, Dict, Dict]:
+        status = self._outcome()
+        time.sleep(self.latency + self._random.uniform(0, self.jitter) if self.jitter else self.latency)
+
+        headers = {}
+        if status == 200:
+            payload = self.completion(body)
+            headers["x-ratelimit-remaining-requests"] = "1000"
+            headers["x-ratelimit-remaining-tokens"] = "1000000"
+        elif status == 429:
+            payload = {"error": {"code": "429", "message": "Rate limit is exceeded. Try again later."}}
+            headers["retry-after"] = f"{self.retry_after:g}"
+            headers["retry-after-ms"] = str(int(self.retry_after * 1000))
+        else:
+            payload = {"error": {"code": "InternalServerError", "message": "Mock server error."}}
+        return status, payload, headers
+
+    def _add_file(self, content: bytes, filename: str, purpose: str) -> Dict:
+        with self._lock:
+            file = {
+                "id": f"file-{len(self._files):06d}",
+                "object": "file",
+                "bytes": len(content),
+                "created_at": int(time.time()),
+                "filename": filename,
+                "purpose": purpose,
+                "status": "processed"
+            }
+            self._files[file["id"]] = (file, content)
+        return file
+
+    def _upload(self, body: bytes, content_type: str) -> Dict:
+        message = message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body)
+        fields, content, filename = {}, b"", "upload.jsonl"
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if name == "file":
+                content = part.get_payload(decode=True)
+                filename = part.get_filename() or filename
+            else:
+                fields[name] = part.get_payload(decode=True).decode("utf-8")
+        return self._add_file(content, filename, fields.get("purpose", "batch"))
+
+    def _create_batch(self, body: bytes) -> Dict:
+        """
+        Runs every request of the batch input file at once, writing the
+        answers to an output file and the failures to an error file.
+        """
+        request = json.loads(body)
+        _, content = self._files[request["input_file_id"]]
+        output, errors = [], []
+        for line in content.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            status, payload, _ = self._chat(json.dumps(item["body"]).encode("utf-8"))
+            result = {
+                "id": f"batch_req_{len(output) + len(errors):06d}",
+                "custom_id": item["custom_id"],
+                "response": {"status_code": status, "body": payload},
+                "error": None
+            }
+            (output if status == 200 else errors).append(json.dumps(result))
+        output_file = self._add_file("\n".join(output).encode("utf-8"), "output.jsonl", "batch_output")
+        error_file = self._add_file("\n".join(errors).encode("utf-8"), "errors.jsonl", "batch_output") if errors else None
+        with self._lock:
+            batch = {
+                "id": f"batch_{len(self._batches):06d}",
+                "object": "batch",
+                "endpoint": request["endpoint"],
+                "input_file_id": request["input_file_id"],
+                "completion_window": request["completion_window"],
+                "status": "completed",
+                "created_at": int(time.time()),
+                "output_file_id": output_file["id"],
+                "error_file_id": error_file["id"] if error_file else None,
+                "request_counts": {"total": len(output) + len(errors), "completed": len(output), "failed": len(errors)}
+            }
+            self._batches[batch["id"]] = batch
+        return batch
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, out: bytes, headers: Dict, received: int = 0) -> None:
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+                with server._lock:
+                    stats = server._stats
+                    stats["requests"] += 1
+                    stats["bytes_received"] += received
+                    stats["bytes_sent"] += len(out)
+                    stats["status"][status] += 1
+                    stats["connections"].add(self.client_address)
+
+            def _not_found(self, received: int = 0) -> None:
+                payload = {"error": {"code": "404", "message": "Resource not found."}}
+                self._reply(404, json.dumps(payload).encode("utf-8"), {"Content-Type": "application/json"}, received)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                path = self.path.split("?")[0].rstrip("/")
+                status, headers = 200, {}
+                if path.endswith("/files"):
+                    payload = server._upload(body, self.headers.get("Content-Type", ""))
+                elif path.endswith("/batches"):
+                    payload = server._create_batch(body)
+                else:
+                    status, payload, headers = server._chat(body)
+                headers["Content-Type"] = "application/json"
+                self._reply(status, json.dumps(payload).encode("utf-8"), headers, len(body))
+
+            def do_GET(self):
+                parts = self.path.split("?")[0].rstrip("/").split("/")
+                if len(parts) >= 2 and parts[-2] == "batches" and parts[-1] in server._batches:
+                    out = json.dumps(server._batches[parts[-1]]).encode("utf-8")
+                    self._reply(200, out, {"Content-Type": "application/json"})
+                elif len(parts) >= 3 and parts[-3] == "files" and parts[-1] == "content" and parts[-2] in server._files:
+                    self._reply(200, server._files[parts[-2]][1], {"Content-Type": "application/octet-stream"})
+                else:
+                    self._not_found()
+
+        return Handler
+
+    @staticmethod
+    def completion(body: bytes) -> Dict:
+        """
+        Builds a deterministic chat completion for a request body. Requests
+        with a JSON-schema response format get a JSON object with one caption
+        per required property.
+        """
+        digest = hashlib.sha256(body).hexdigest()[:12]
+        try:
+            request = json.loads(body)
+        except ValueError:
+            request = {}
+        image_tokens = 85 * sum(
+            1 for message in request.get("messages", []) if isinstance(message.get("content"), list)
+            for part in message["content"] if part.get("type") == "image_url"
+        )
+        prompt_tokens = len(body) // 400 + image_tokens
+        content = f"Mock caption {digest}: a vivid scene with people, colors and patterns."
+        schema = ((request.get("response_format") or {}).get("json_schema") or {}).get("schema")
+        if schema is not None:
+            # Packed request: one caption per required property (image id)
+            content = json.dumps({key: f"{content} ({key})" for key in schema.get("required", [])})
+        completion_tokens = len(content.split())
+        return {
+            "id": f"chatcmpl-{digest}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content}
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": 0, "image_tokens": image_tokens}
+            }
+        }
+
+    def start(self) -> "MockOpenAIServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a mock OpenAI chat completions server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--max-rpm", type=int, default=None)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(
+        host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+        max_rpm=args.max_rpm, retry_after=args.retry_after
+    )
+    print(f"🧪 Mock OpenAI server listening on {server.url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,365 @@
+"""
+Benchmark suite of the captioning pipeline.
+
+Synthetic datasets are generated once in a work directory, a mock
+OpenAI-compatible server is started locally, and every benchmark runs in its
+own spawned process so that its peak RSS is measured in isolation. Results
+(images/sec, p50/p95/p99 latency, peak RSS, bytes uploaded, server status
+counts) are written as JSON so runs can be compared.
+
+Usage:
+$ python -m benchmarks.run --images 200 --latency 0.1 --concurrency 8 --output benchmarks/results/run.json
+$ python -m benchmarks.run --only describe_image generate_captions --rate-limit-rate 0.05
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows: peak RSS is not reported
+    resource = None
+
+from benchmarks.mock_server import MockOpenAIServer
+from benchmarks import synthetic
+
+PROMPT = "Describe this image in one sentence."
+
+def peak_rss_bytes() -> Optional[int]:
+    """
+    Returns the peak resident set size of the current process, in bytes.
+    """
+    # On Linux, ru_maxrss survives exec and would include the parent's peak
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def latency_summary(latencies: List[float]) -> Optional[Dict[str, float]]:
+    """
+    Summarizes latencies (in seconds) as milliseconds percentiles.
+    """
+    if not latencies:
+        return None
+    values = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99), "mean_ms": float(values.mean()), "max_ms": float(values.max())}
+
+def timed(fn: Callable, latencies: List[float]) -> Callable:
+    """
+    Wraps a function so that the duration of every call is appended to `latencies`.
+    """
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return wrapper
+
+def _load_images(dataset_path: str, limit: Optional[int] = None):
+    from datasets import load_from_disk
+
+    dataset = load_from_disk(dataset_path)
+    if limit is not None:
+        dataset = dataset.select(range(min(limit, len(dataset))))
+    names = dataset.features["label"].names
+    return [(example["image"], names[example["label"]]) for example in dataset]
+
+# --------------------------- BENCHMARKS ---------------------------
+def bench_image_to_base64(dataset_path: str, detail: Optional[str] = "auto", max_image_bytes: Optional[int] = None, **_) -> Dict:
+    from utils.image import image_to_base64
+
+    images = _load_images(dataset_path)
+    latencies, encoded_bytes = [], 0
+    encode = timed(image_to_base64, latencies)
+    start = time.perf_counter()
+    for image, _ in images:
+        encoded_bytes += len(encode(image, detail=detail, max_bytes=max_image_bytes))
+    return {"items": len(images), "seconds": time.perf_counter() - start, "latencies": latencies, "encoded_bytes": encoded_bytes}
+
+def bench_build_image_payload(dataset_path: str, detail: Optional[str] = "auto", max_image_bytes: Optional[int] = None, **_) -> Dict:
+    from datasets import Image, load_from_disk
+    from utils.call_openai_api import build_image_payload
+
+    dataset = load_from_disk(dataset_path).cast_column("image", Image(decode=False))
+    images = [image["bytes"] for image in dataset["image"]]
+    latencies, encoded_bytes = [], 0
+    build = timed(build_image_payload, latencies)
+    start = time.perf_counter()
+    for image in images:
+        encoded_bytes += len(build(image=image, detail=detail, max_image_bytes=max_image_bytes)["image_url"]["url"])
+    return {"items": len(images), "seconds": time.perf_counter() - start, "latencies": latencies, "encoded_bytes": encoded_bytes}
+
+def bench_describe_image(dataset_path: str, concurrency: int = 8, detail: str = "auto", **_) -> Dict:
+    from utils.call_openai_api import describe_image, get_client
+
+    images = _load_images(dataset_path)
+    client = get_client(max_connections=max(concurrency, 20))
+    latencies = []
+    describe = timed(describe_image, latencies)
+
+    def run(item):
+        image, label = item
+        return describe(PROMPT, image=image, label=label, show_image=False, client=client, detail=detail)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        captions = list(executor.map(run, images))
+    return {
+        "items": len(images),
+        "seconds": time.perf_counter() - start,
+        "latencies": latencies,
+        "failed": sum(caption is None for caption in captions)
+    }
+
+def bench_generate_captions(dataset_path: str, workdir: str, concurrency: int = 8, detail: str = "auto", **_) -> Dict:
+    import scripts.generate_caption as generate_caption
+    from datasets import load_from_disk
+
+    latencies = []
+    generate_caption.describe_image = timed(generate_caption.describe_image, latencies)
+    output_path = os.path.join(workdir, "captions", "generate_captions")
+    start = time.perf_counter()
+    generate_caption.generate_captions(
+        dataset_path,
+        output_path,
+        category="fashion",
+        concurrency=concurrency,
+        detail=detail,
+        cache_path=None,
+        retry_base_delay=0.1,
+        retry_max_delay=1.0
+    )
+    return {"items": len(load_from_disk(dataset_path)), "seconds": time.perf_counter() - start, "latencies": latencies}
+
+def bench_merge_caption_parts(workdir: str, num_records: int = 10000, num_segments: int = 4, repeat: int = 3, **_) -> Dict:
+    from scripts.generate_caption import merge_caption_parts
+
+    output_path = os.path.join(workdir, "merge", "captions")
+    segments = synthetic.make_caption_segments(output_path, num_records=num_records, num_segments=num_segments)
+    latencies = []
+    merge = timed(merge_caption_parts, latencies)
+    for _ in range(repeat):
+        merge(output_path, f"{output_path}.json", delete_parts=False, save_csv=True, part_files=segments)
+    return {"items": num_records * repeat, "seconds": sum(latencies), "latencies": latencies}
+
+def bench_prepare_hf_dataset(dataset_path: str, workdir: str, num_images: int, repeat: int = 3, num_proc: Optional[int] = None, **_) -> Dict:
+    from scripts.prepare_dataset import prepare_hf_dataset
+
+    caption_file = synthetic.make_caption_file(os.path.join(workdir, "prepare", "captions.json"), num_images)
+    latencies = []
+    prepare = timed(prepare_hf_dataset, latencies)
+    for k in range(repeat):
+        prepare(dataset_path, caption_file, os.path.join(workdir, "prepare", f"dataset_{k}"), num_proc=num_proc)
+    return {"items": num_images * repeat, "seconds": sum(latencies), "latencies": latencies}
+
+def bench_build_image_dataset_from_folders(folders_dir: str, num_folder_images: int, repeat: int = 3, embed_images: bool = True, **_) -> Dict:
+    from utils.dataset import build_image_dataset_from_folders
+
+    latencies = []
+    build = timed(build_image_dataset_from_folders, latencies)
+    for _ in range(repeat):
+        build(folders_dir, ["train", "test"], keep_splits=False, embed_images=embed_images)
+    return {"items": num_folder_images * repeat, "seconds": sum(latencies), "latencies": latencies}
+
+BENCHMARKS = {
+    "image_to_base64": bench_image_to_base64,
+    "build_image_payload": bench_build_image_payload,
+    "describe_image": bench_describe_image,
+    "generate_captions": bench_generate_captions,
+    "merge_caption_parts": bench_merge_caption_parts,
+    "prepare_hf_dataset": bench_prepare_hf_dataset,
+    "build_image_dataset_from_folders": bench_build_image_dataset_from_folders,
+}
+NETWORK_BENCHMARKS = ("describe_image", "generate_captions")
+
+# --------------------------- HARNESS ---------------------------
+def _child(name: str, params: Dict, conn) -> None:
+    os.chdir(params["workdir"])
+    try:
+        result = BENCHMARKS[name](**params)
+        result["peak_rss_bytes"] = peak_rss_bytes()
+        conn.send(result)
+    except BaseException as e:
+        conn.send({"error": f"{type(e).__name__}: {e}"})
+        raise
+    finally:
+        conn.close()
+
+def run_benchmark(name: str, params: Dict, server: Optional[MockOpenAIServer] = None) -> Dict:
+    """
+    Runs one benchmark in a spawned process and summarizes its measurements.
+
+    Args:
+        name (str): The benchmark name (a key of `BENCHMARKS`).
+        params (Dict): Keyword arguments of the benchmark.
+        server (MockOpenAIServer, optional): The mock server, whose stats are
+            reset before and read after the benchmark.
+
+    Returns:
+        Dict: The benchmark result.
+    """
+    if server is not None:
+        server.reset_stats()
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=_child, args=(name, params, child_conn))
+    process.start()
+    child_conn.close()
+    raw = parent_conn.recv() if parent_conn.poll(None) else {"error": "no result"}
+    process.join()
+
+    result = {"name": name}
+    if "error" in raw:
+        result["error"] = raw["error"]
+        return result
+    result.update({
+        "items": raw["items"],
+        "seconds": raw["seconds"],
+        "items_per_sec": raw["items"] / raw["seconds"] if raw["seconds"] else None,
+        "latency": latency_summary(raw["latencies"]),
+        "peak_rss_bytes": raw["peak_rss_bytes"]
+    })
+    result.update({k: v for k, v in raw.items() if k not in result and k not in ("latencies", "items", "seconds")})
+    if server is not None and name in NETWORK_BENCHMARKS:
+        stats = server.stats()
+        result["bytes_uploaded"] = stats["bytes_received"]
+        result["server"] = stats
+    return result
+
+def run_suite(
+    workdir: str,
+    names: List[str],
+    num_images: int = 200,
+    image_size: tuple = (640, 480),
+    images_per_class: int = 50,
+    concurrency: int = 8,
+    detail: str = "auto",
+    num_records: int = 10000,
+    repeat: int = 3,
+    latency: float = 0.05,
+    jitter: float = 0.0,
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    max_rpm: Optional[int] = None
+) -> Dict:
+    """
+    Generates the synthetic inputs, starts the mock server and runs the benchmarks.
+
+    Returns:
+        Dict: The run configuration, environment and results.
+    """
+    config = {k: v for k, v in locals().items() if k != "workdir"}
+    dataset_path = os.path.join(workdir, "dataset")
+    folders_dir = os.path.join(workdir, "folders")
+    num_classes = 5
+    if not os.path.exists(dataset_path):
+        print(f"🧪 Generating {num_images} synthetic images...")
+        synthetic.make_image_dataset(dataset_path, num_images=num_images, size=image_size, num_labels=num_classes)
+    if "build_image_dataset_from_folders" in names and not os.path.exists(folders_dir):
+        synthetic.make_image_folders(folders_dir, num_classes=num_classes, images_per_class=images_per_class)
+
+    params = {
+        "workdir": workdir,
+        "dataset_path": dataset_path,
+        "folders_dir": folders_dir,
+        "num_images": num_images,
+        "num_folder_images": 2 * num_classes * images_per_class,
+        "concurrency": concurrency,
+        "detail": detail,
+        "num_records": num_records,
+        "repeat": repeat
+    }
+
+    with MockOpenAIServer(
+        latency=latency, jitter=jitter, error_rate=error_rate,
+        rate_limit_rate=rate_limit_rate, max_rpm=max_rpm
+    ) as server:
+        # Inherited by the spawned benchmark processes
+        os.environ["AZURE_OPENAI_ENDPOINT"] = server.url
+        os.environ.setdefault("AZURE_OPENAI_KEY", "mock-key")
+        results = []
+        for name in names:
+            print(f"⏱️ Running {name}...")
+            result = run_benchmark(name, params, server=server)
+            results.append(result)
+            if "error" in result:
+                print(f"❌ {name} failed: {result['error']}")
+            else:
+                print(f"✅ {name}: {result['items_per_sec']:.1f} items/sec")
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": config,
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "results": results
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the captioning pipeline against a local mock endpoint.")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS), help="Benchmarks to run.")
+    parser.add_argument("--workdir", default=None, help="Directory of the synthetic inputs (reused when it exists). Defaults to a temporary directory.")
+    parser.add_argument("--output", default=None, help="JSON file to write the results to. Defaults to stdout.")
+    parser.add_argument("--images", type=int, default=200, help="Number of synthetic dataset images.")
+    parser.add_argument("--image-size", type=int, nargs=2, default=[640, 480], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--images-per-class", type=int, default=50, help="Images per class folder.")
+    parser.add_argument("--records", type=int, default=10000, help="Caption records merged by merge_caption_parts.")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions of the bulk benchmarks.")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--detail", default="auto", choices=["low", "high", "auto"])
+    parser.add_argument("--latency", type=float, default=0.05, help="Mock server latency, in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Mock server latency jitter, in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of 500 responses.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of 429 responses.")
+    parser.add_argument("--max-rpm", type=int, default=None, help="Requests per minute accepted before 429s.")
+    args = parser.parse_args()
+
+    with (tempfile.TemporaryDirectory() if args.workdir is None else nullcontext(args.workdir)) as workdir:
+        workdir = os.path.abspath(workdir)
+        os.makedirs(workdir, exist_ok=True)
+        report = run_suite(
+            workdir,
+            args.only,
+            num_images=args.images,
+            image_size=tuple(args.image_size),
+            images_per_class=args.images_per_class,
+            concurrency=args.concurrency,
+            detail=args.detail,
+            num_records=args.records,
+            repeat=args.repeat,
+            latency=args.latency,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            rate_limit_rate=args.rate_limit_rate,
+            max_rpm=args.max_rpm
+        )
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Results saved to: {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
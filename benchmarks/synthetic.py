@@ -0,0 +1,145 @@
+"""
+Synthetic inputs for benchmarks: image datasets readable with `load_from_disk`,
+partition/class image folders, caption log segments and caption files.
+
+Images are smooth color gradients with noise, so that their JPEG size is close
+to that of photos of the same resolution.
+"""
+
+from datasets import Dataset, Features, ClassLabel, Value, Image as HfImage
+from PIL import Image
+from typing import List, Sequence, Tuple
+import io
+import json
+import os
+import numpy as np
+
+from utils.caption_log import CaptionWriter, list_segments, segment_path
+
+def make_image(rng: np.random.Generator, size: Tuple[int, int] = (640, 480), quality: int = 90) -> bytes:
+    """
+    Returns a JPEG-encoded synthetic image.
+
+    Args:
+        rng (np.random.Generator): Random generator of the image content.
+        size (Tuple[int, int]): Width and height.
+        quality (int): JPEG quality.
+
+    Returns:
+        bytes: The encoded image.
+    """
+    width, height = size
+    x = np.linspace(0, 1, width)[None, :, None]
+    y = np.linspace(0, 1, height)[:, None, None]
+    start, step_x, step_y = rng.random((3, 1, 1, 3)) * 255
+    pixels = start + step_x * x + step_y * y + rng.normal(0, 12, (height, width, 3))
+    image = Image.fromarray(np.clip(pixels % 256, 0, 255).astype(np.uint8))
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+def label_names(num_labels: int) -> List[str]:
+    return [f"label_{i}" for i in range(num_labels)]
+
+def make_image_dataset(
+    path: str,
+    num_images: int = 1000,
+    size: Tuple[int, int] = (640, 480),
+    num_labels: int = 5,
+    seed: int = 0
+) -> str:
+    """
+    Saves a synthetic image dataset with 'image', 'label' (ClassLabel) and 'id' fields.
+
+    Args:
+        path (str): Directory to save the dataset to.
+        num_images (int): Number of images.
+        size (Tuple[int, int]): Width and height of the images.
+        num_labels (int): Number of classes.
+        seed (int): Random seed.
+
+    Returns:
+        str: The dataset path.
+    """
+    rng = np.random.default_rng(seed)
+    features = Features({
+        "image": HfImage(),
+        "label": ClassLabel(names=label_names(num_labels)),
+        "id": Value("string")
+    })
+    dataset = Dataset.from_dict({
+        "image": [{"bytes": make_image(rng, size), "path": None} for _ in range(num_images)],
+        "label": [i % num_labels for i in range(num_images)],
+        "id": [f"img_{i:05d}" for i in range(num_images)]
+    }, features=features)
+    dataset.save_to_disk(path)
+    return path
+
+def make_image_folders(
+    root_dir: str,
+    partitions: Sequence[str] = ("train", "test"),
+    num_classes: int = 5,
+    images_per_class: int = 100,
+    size: Tuple[int, int] = (320, 240),
+    seed: int = 0
+) -> str:
+    """
+    Writes synthetic images in a `root_dir/partition/class/` layout.
+
+    Returns:
+        str: The root directory.
+    """
+    rng = np.random.default_rng(seed)
+    for partition in partitions:
+        for class_name in label_names(num_classes):
+            class_dir = os.path.join(root_dir, partition, class_name)
+            os.makedirs(class_dir, exist_ok=True)
+            for i in range(images_per_class):
+                with open(os.path.join(class_dir, f"{class_name}_{i:05d}.jpg"), 'wb') as f:
+                    f.write(make_image(rng, size))
+    return root_dir
+
+def caption_record(index: int, num_labels: int = 5) -> dict:
+    return {
+        "id": f"img_{index:05d}",
+        "label": f"label_{index % num_labels}",
+        "prompt": "Describe this image in one sentence.",
+        "caption": f"A synthetic caption number {index} with some colorful details about the scene."
+    }
+
+def make_caption_segments(output_path: str, num_records: int = 10000, num_segments: int = 4) -> List[str]:
+    """
+    Writes caption log segments for `output_path`, each in id order, with the
+    records interleaved across segments as concurrent runs leave them.
+    Existing segments of `output_path` are replaced.
+
+    Returns:
+        List[str]: The segment paths.
+    """
+    for path in list_segments(output_path):
+        os.remove(path)
+    paths = [segment_path(output_path, k) for k in range(num_segments)]
+    writers = [CaptionWriter(path, fsync="never") for path in paths]
+    try:
+        for index in range(num_records):
+            writers[index % num_segments].write(caption_record(index))
+    finally:
+        for writer in writers:
+            writer.close()
+    return paths
+
+def make_caption_file(caption_file: str, num_records: int, missing_every: int = 10) -> str:
+    """
+    Writes a merged caption JSON file for the first `num_records` ids, with
+    every `missing_every`-th caption missing.
+
+    Returns:
+        str: The caption file path.
+    """
+    records = [caption_record(i) for i in range(num_records)]
+    for record in records[::missing_every]:
+        record["caption"] = None
+    os.makedirs(os.path.dirname(caption_file) or ".", exist_ok=True)
+    with open(caption_file, 'w', encoding='utf-8') as f:
+        json.dump({"prompt": records[0]["prompt"] if records else None, "captions": records}, f, ensure_ascii=False, indent=2)
+    return caption_file
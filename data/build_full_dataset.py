@@ -7,111 +7,350 @@ main domains: Fashion and Food. It ensures label consistency by:
 1. Mapping numeric labels to their corresponding class names using ClassLabel.
 2. Unifying the label space across datasets.
 3. Concatenating datasets with and without labels, preserving metadata.
-4. Saving the merged datasets for future use (e.g., image captioning, classification).
+4. Flagging near-duplicate images, so that only one image per cluster is captioned.
+5. Saving the merged datasets for future use (e.g., image captioning, classification).
+
+Builds are incremental: each source under `data/raw/...` is fingerprinted and
+its converted dataset (and perceptual hashes) cached under `data/cache/build`,
+so only changed sources are rebuilt. Ids are allocated per source and kept in
+`ids.json`, so appending rows or sources never renumbers existing images.
 
 """
 
-from datasets import load_from_disk, Dataset, concatenate_datasets, Value, Features, Image as HfImage
-import pandas as pd
+from datasets import load_from_disk, concatenate_datasets, Value
+import pyarrow as pa
+import pyarrow.compute as pc
+import numpy as np
+import hashlib
+import json
 import os
+import shutil
+from utils.dedup import dataset_hashes, find_duplicate_clusters, duplicate_of, cluster_sizes
+
+BUILD_CACHE_DIR = "data/cache/build"
+BUILD_VERSION = 1
+
+FASHION_SOURCES = [
+    # African attire (with ethnic group labels)
+    {"name": "african-atire", "path": "data/raw/fashion/african-atire", "split": "train"},
+    # Wax patterns (without labels)
+    {"name": "african-wax-patterns", "path": "data/raw/fashion/african-wax-patterns", "split": "train", "label": "wax-pattern"},
+]
+
+FOOD_SOURCES = [
+    # Nigerian foods (10 categories)
+    {"name": "nigeria-foods", "path": "data/raw/food/nigeria-foods"},
+    # Ghanaian & Cameroonian foods (6 categories)
+    {"name": "ghana-cameroun-foods", "path": "data/raw/food/ghana-cameroun-foods"},
+]
 
 def convert_class_labels_to_strings(dataset):
     """
     Converts numeric labels in a dataset to their corresponding string labels.
 
+    The conversion is a single Arrow `take` of the class names on the label
+    column; the image column is never read or copied. Missing labels (-1)
+    become null.
+
     Parameters:
     - dataset (Dataset): A HuggingFace dataset with numeric labels.
 
     Returns:
     - Dataset: The dataset with string-based labels.
     """
-    label_feature = dataset.features['label'].names
-    df = dataset.to_pandas()
-    df['label'] = df['label'].apply(lambda x: label_feature[x])
-    features = Features({
-        "image": HfImage(),
-        "label": Value(dtype="string")
-    })
-    return Dataset.from_pandas(df, features=features).cast(features)
+    label_names = pa.array(dataset.features['label'].names, type=pa.string())
+    labels = dataset.with_format("arrow")['label']
+    labels = pc.if_else(pc.less(labels, 0), None, labels)
+    string_labels = pc.take(label_names, labels).combine_chunks()
+    return dataset.remove_columns('label').add_column('label', string_labels, feature=Value(dtype="string"))
+
+def fingerprint_source(path):
+    """
+    Fingerprints a saved dataset directory from its file names, sizes and modification times.
+
+    Parameters:
+    - path (str): The dataset directory.
+
+    Returns:
+    - str: A SHA-256 hex digest that changes whenever a file is added, removed or rewritten.
+    """
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            file_path = os.path.join(dirpath, filename)
+            stat = os.stat(file_path)
+            digest.update(f"{os.path.relpath(file_path, path)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+def load_source_rows(source):
+    """
+    Loads a raw source (memory-mapped), with its split applied.
+    """
+    dataset = load_from_disk(source["path"])
+    return dataset[source["split"]] if source.get("split") else dataset
+
+def load_source(source):
+    """
+    Loads a raw source and converts it to the merged schema (image, string label).
+
+    Parameters:
+    - source (dict): A source spec with 'name', 'path', an optional 'split'
+      and an optional placeholder 'label' for unlabeled sources.
+
+    Returns:
+    - Dataset: The converted source.
+    """
+    dataset = load_source_rows(source)
 
-def merge_fashion_datasets():
+    if "label" in source:
+        # Add missing 'label' field with placeholder
+        if "label" in dataset.column_names:
+            dataset = dataset.remove_columns("label")
+        placeholder = pa.array([source["label"]] * len(dataset), type=pa.string())
+        return dataset.add_column("label", placeholder, feature=Value(dtype="string"))
+
+    # Convert numeric labels to string labels
+    return convert_class_labels_to_strings(dataset)
+
+def load_id_registry(path):
+    """
+    Loads the id allocation of a domain: the id ranges of each source and the next free id.
+    """
+    if not os.path.exists(path):
+        return {"next_id": 0, "sources": {}}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_id_registry(path, registry):
+    """
+    Atomically writes the id allocation of a domain.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(registry, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+def allocate_ids(registry, name, num_rows):
+    """
+    Returns the id numbers of a source's rows, allocating ids for new rows.
+
+    Rows are assumed to be appended to a source: the first rows keep the ids
+    they had, and rows beyond the allocated ones get fresh ids after every id
+    in use. A source that shrank is renumbered.
+
+    Parameters:
+    - registry (dict): The domain's id registry (updated in place).
+    - name (str): The source name.
+    - num_rows (int): The current number of rows of the source.
+
+    Returns:
+    - np.ndarray: The id number of each row.
+    """
+    ranges = registry["sources"].get(name, [])
+    allocated = sum(count for _, count in ranges)
+    if allocated > num_rows:
+        print(f"⚠️ Source '{name}' shrank from {allocated} to {num_rows} rows; its images get new ids.")
+        ranges, allocated = [], 0
+    if num_rows > allocated:
+        ranges = ranges + [[registry["next_id"], num_rows - allocated]]
+        registry["next_id"] += num_rows - allocated
+    registry["sources"][name] = ranges
+    return np.concatenate([np.arange(start, start + count, dtype=np.int64) for start, count in ranges] or [np.zeros(0, dtype=np.int64)])
+
+def format_ids(id_numbers):
+    """
+    Formats id numbers as 5-digit ids (e.g., 'img_00042').
+    """
+    return pa.array([f"img_{i:05d}" for i in id_numbers], type=pa.string())
+
+def build_source(source, id_numbers, cache_dir, num_proc=None):
+    """
+    Returns the converted dataset of a source with its 'id' column, from the
+    build cache when neither the source nor its ids changed.
+
+    Parameters:
+    - source (dict): The source spec.
+    - id_numbers (np.ndarray): The id number of each row, from `allocate_ids`.
+    - cache_dir (str): The cache directory of this source.
+    - num_proc (int): Number of processes used to write the cached dataset.
+
+    Returns:
+    - Dataset: The converted source.
+    """
+    meta = {
+        "version": BUILD_VERSION,
+        "source": source,
+        "fingerprint": fingerprint_source(source["path"]),
+        "ids": hashlib.sha256(id_numbers.tobytes()).hexdigest()
+    }
+    meta_path = os.path.join(cache_dir, "meta.json")
+    dataset_path = os.path.join(cache_dir, "dataset")
+
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            if json.load(f) == meta:
+                print(f"♻️ Reusing cached source '{source['name']}'.")
+                return load_from_disk(dataset_path)
+
+    print(f"🔨 Building source '{source['name']}'...")
+    dataset = load_source(source)
+    dataset = dataset.add_column("id", format_ids(id_numbers), feature=Value(dtype="string"))
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(cache_dir)
+    dataset.save_to_disk(dataset_path, num_proc=num_proc)
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    return load_from_disk(dataset_path)
+
+def source_hashes(dataset, cache_dir, num_proc=None):
+    """
+    Returns the perceptual hashes of a built source, computed once per build.
+    """
+    hashes_path = os.path.join(cache_dir, "hashes.npy")
+    if os.path.exists(hashes_path):
+        return np.load(hashes_path)
+    hashes = dataset_hashes(dataset, num_proc=num_proc)
+    np.save(hashes_path, hashes)
+    return hashes
+
+def merge_sources(sources, cache_dir=None, num_proc=None, dedup=False, dedup_threshold=4):
+    """
+    Merges sources into one dataset with 'image', 'label' and 'id' fields.
+
+    Without a cache directory, everything is rebuilt and ids follow the row
+    positions. With one, unchanged sources are reused from the cache, ids come
+    from the domain's id registry and rows are ordered by id.
+
+    Parameters:
+    - sources (list): The source specs, in order.
+    - cache_dir (str): The domain's build cache directory, or None.
+    - num_proc (int): Number of processes for writing and hashing.
+    - dedup (bool): Whether to add a 'duplicate_of' field.
+    - dedup_threshold (int): Maximum Hamming distance between perceptual hashes of duplicates.
+
+    Returns:
+    - Dataset: The merged dataset.
+    """
+    if cache_dir is None:
+        merged = concatenate_datasets([load_source(source) for source in sources])
+        # Add 5-digit ID field
+        merged = merged.add_column("id", format_ids(range(len(merged))), feature=Value(dtype="string"))
+        if dedup:
+            merged = add_duplicate_column(merged, threshold=dedup_threshold, num_proc=num_proc)
+        return merged
+
+    registry_path = os.path.join(cache_dir, "ids.json")
+    registry = load_id_registry(registry_path)
+
+    datasets, id_numbers, hashes = [], [], []
+    for source in sources:
+        source_dir = os.path.join(cache_dir, source["name"])
+        ids = allocate_ids(registry, source["name"], len(load_source_rows(source)))
+        dataset = build_source(source, ids, source_dir, num_proc=num_proc)
+        datasets.append(dataset)
+        id_numbers.append(ids)
+        if dedup:
+            hashes.append(source_hashes(dataset, source_dir, num_proc=num_proc))
+    save_id_registry(registry_path, registry)
+
+    merged = concatenate_datasets(datasets)
+    id_numbers = np.concatenate(id_numbers)
+    order = np.argsort(id_numbers, kind="stable")
+    # Rows appended to an earlier source have the newest ids: move them last
+    if (np.diff(id_numbers) < 0).any():
+        merged = merged.select(order)
+
+    if dedup:
+        representatives = find_duplicate_clusters(np.concatenate(hashes)[order], threshold=dedup_threshold)
+        merged = _add_duplicate_of(merged, representatives)
+    return merged
+
+def merge_fashion_datasets(cache_dir=None, num_proc=None):
     """
     Merges two fashion-related datasets:
     - African attire (with ethnic group labels)
     - Wax patterns (without labels)
 
+    Parameters:
+    - cache_dir (str): Build cache directory for an incremental build, or None to rebuild everything.
+    - num_proc (int): Number of processes for writing the cached sources.
+
     Returns:
     - Dataset: Unified fashion dataset with 'label' field where available.
     """
-    attire_path = "data/raw/fashion/african-atire"
-    wax_path = "data/raw/fashion/african-wax-patterns"
+    return merge_sources(FASHION_SOURCES, cache_dir=cache_dir, num_proc=num_proc)
 
-    # Load datasets
-    attire_ds = load_from_disk(attire_path)['train']
-    wax_ds = load_from_disk(wax_path)['train']
-    
-    # Add missing 'label' field to wax dataset with placeholder
-    wax_ds = wax_ds.map(lambda x: {'label': 'wax-pattern'})
-    
-    # Convert numeric labels to string labels
-    attire_ds = convert_class_labels_to_strings(attire_ds)
-
-    # Merge
-    merged = concatenate_datasets([attire_ds, wax_ds])
-    
-    # Add 5-digit ID field
-    merged = merged.map(
-        lambda x, idx: {'id': f"img_{idx:05d}"},
-        with_indices=True
-    )
-    
-    return merged
-
-def merge_food_datasets():
+def merge_food_datasets(cache_dir=None, num_proc=None):
     """
     Merges two food-related datasets:
     - Nigerian foods (10 categories)
     - Ghanaian & Cameroonian foods (6 categories)
 
+    Parameters:
+    - cache_dir (str): Build cache directory for an incremental build, or None to rebuild everything.
+    - num_proc (int): Number of processes for writing the cached sources.
+
     Returns:
     - Dataset: Unified food dataset with consistent string-based labels.
     """
-    nigerian_path = "data/raw/food/nigeria-foods"
-    gc_path = "data/raw/food/ghana-cameroun-foods"
+    return merge_sources(FOOD_SOURCES, cache_dir=cache_dir, num_proc=num_proc)
 
-    # Load datasets
-    nigeria_ds = load_from_disk(nigerian_path)
-    gc_ds = load_from_disk(gc_path)
+def _add_duplicate_of(dataset, representatives):
+    clusters = cluster_sizes(representatives)
+    print(f"🔁 Found {sum(clusters.values()) - len(clusters)} near-duplicates in {len(clusters)} clusters.")
+    return dataset.add_column("duplicate_of", duplicate_of(dataset["id"], representatives))
 
-    # Convert numeric labels to string labels
-    nigeria_ds = convert_class_labels_to_strings(nigeria_ds)
-    gc_ds = convert_class_labels_to_strings(gc_ds)
-    
-    # Merge
-    merged = concatenate_datasets([nigeria_ds, gc_ds])
-    
-    # Add 5-digit ID field
-    merged = merged.map(
-        lambda x, idx: {'id': f"img_{idx:05d}"},
-        with_indices=True
-    )
-    
-    return merged
+def add_duplicate_column(dataset, threshold=4, num_proc=None):
+    """
+    Adds a 'duplicate_of' column with the id of each image's near-duplicate
+    cluster representative (its own id if it is one).
+
+    Parameters:
+    - dataset (Dataset): A merged dataset with 'image' and 'id' fields.
+    - threshold (int): Maximum Hamming distance between perceptual hashes of duplicates.
+    - num_proc (int): Number of hashing processes.
+
+    Returns:
+    - Dataset: The dataset with the 'duplicate_of' field.
+    """
+    hashes = dataset_hashes(dataset, num_proc=num_proc)
+    return _add_duplicate_of(dataset, find_duplicate_clusters(hashes, threshold=threshold))
 
-def save_merged_datasets():
+def save_merged_datasets(dedup=True, dedup_threshold=4, num_proc=None, incremental=True, cache_dir=BUILD_CACHE_DIR):
     """
     Merges and saves fashion and food datasets into the `data/processed` directory.
+
+    Parameters:
+    - dedup (bool): Whether to flag near-duplicate images in a 'duplicate_of' field.
+    - dedup_threshold (int): Maximum Hamming distance between perceptual hashes of duplicates.
+    - num_proc (int): Number of hashing and writing processes.
+    - incremental (bool): Whether to reuse the cached sources that did not change and keep ids stable.
+    - cache_dir (str): The build cache directory used by incremental builds.
     """
     os.makedirs("data/processed", exist_ok=True)
 
-    fashion_ds = merge_fashion_datasets()
-    food_ds = merge_food_datasets()
-
-    fashion_ds.save_to_disk("data/processed/african-fashion")
-    food_ds.save_to_disk("data/processed/african-food")
+    domains = {
+        "african-fashion": FASHION_SOURCES,
+        "african-food": FOOD_SOURCES
+    }
+    for name, sources in domains.items():
+        merged = merge_sources(
+            sources,
+            cache_dir=os.path.join(cache_dir, name) if incremental else None,
+            num_proc=num_proc,
+            dedup=dedup,
+            dedup_threshold=dedup_threshold
+        )
+        merged.save_to_disk(f"data/processed/{name}", num_proc=num_proc)
 
     print("✅ Datasets successfully merged and saved.")
 
 # Run the pipeline
 if __name__ == "__main__":
-    save_merged_datasets()
+    # Settings come from the `build` section of configs/pipeline.yaml
+    from scripts.cli import main
+    import sys
+
+    main(["build", *sys.argv[1:]])
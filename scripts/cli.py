@@ -0,0 +1,211 @@
+"""
+Command line entry point of the whole pipeline.
+
+Every command runs one step with its settings from a section of the config
+file (configs/pipeline.yaml by default, YAML or JSON). A section with `jobs`
+runs each named job with the section's shared settings; `--job` selects some
+of them. Command line options and `--set key=value` override the config.
+
+Modules are imported by the command that needs them, so `--help` and short
+jobs (shards, retries, merges) do not pay for datasets or openai imports.
+
+Usage:
+$ python -m scripts.cli crawl
+$ python -m scripts.cli build --num-proc 8
+$ python -m scripts.cli caption --job fashion --shard-index 0 --num-shards 8 --concurrency 16
+$ python -m scripts.cli merge --job fashion --num-shards 8
+$ python -m scripts.cli prepare --set num_proc=4
+$ python -m scripts.cli export --job fashion --max-shard-size 1GB
+"""
+
+import argparse
+import json
+import os
+import sys
+
+DEFAULT_CONFIG = os.getenv("AFRO_CONFIG", "configs/pipeline.yaml")
+# Options that point a job at other data: given without --job, they replace the configured jobs
+PATH_KEYS = {"dataset_path", "output_path", "caption_file"}
+MERGE_KEYS = ("output_path", "num_shards", "output_format", "delete_parts", "save_csv", "save_summary")
+
+# --------------------------- CONFIG ---------------------------
+def load_config(path):
+    """
+    Loads a YAML or JSON config file. A missing file is an empty config.
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith(".json"):
+            return json.load(f)
+        import yaml
+
+        return yaml.safe_load(f) or {}
+
+def parse_assignment(text):
+    """
+    Parses a `key=value` override, the value being read as YAML (numbers, booleans, lists, null).
+    """
+    import yaml
+
+    key, sep, value = text.partition("=")
+    if not sep or not key:
+        raise argparse.ArgumentTypeError(f"Expected key=value, got '{text}'.")
+    return key.replace("-", "_"), yaml.safe_load(value)
+
+def expand_jobs(section, names=None, overrides=None):
+    """
+    Returns the (name, settings) pairs a command runs for a config section.
+
+    Args:
+        section (dict): The config section, with optional `jobs` by name.
+        names (List[str], optional): The jobs to run. Defaults to every job,
+            or to a single unnamed job when `overrides` set a path.
+        overrides (dict, optional): Settings overriding every job.
+
+    Returns:
+        List[Tuple[str, dict]]: The job names and settings.
+    """
+    section = dict(section or {})
+    jobs = section.pop("jobs", None) or {}
+    overrides = overrides or {}
+    if names:
+        unknown = [name for name in names if name not in jobs]
+        if unknown:
+            raise SystemExit(f"Unknown job(s) {unknown}. Available jobs: {list(jobs)}.")
+    elif not jobs or PATH_KEYS & overrides.keys():
+        return [(None, {**section, **overrides})]
+    return [(name, {**section, **jobs[name], **overrides}) for name in names or jobs]
+
+# --------------------------- COMMANDS ---------------------------
+def run_crawl(settings):
+    from scripts.download_data import download_categories
+
+    download_categories(**settings)
+
+def run_build(settings):
+    from data.build_full_dataset import save_merged_datasets
+
+    save_merged_datasets(**settings)
+
+def run_caption(settings):
+    from scripts.generate_caption import generate_captions
+
+    generate_captions(**settings)
+
+def run_merge(settings):
+    from scripts.generate_caption import caption_file_path, combine_shards, merge_caption_parts
+
+    settings = dict(settings)
+    output_path = settings.pop("output_path")
+    num_shards = settings.pop("num_shards", 1)
+    if num_shards > 1:
+        combine_shards(output_path, num_shards, **settings)
+    else:
+        output_file = caption_file_path(output_path, settings.pop("output_format", "json"))
+        merge_caption_parts(base_path=output_path, output_file=output_file, **settings)
+
+def run_prepare(settings):
+    from scripts.prepare_dataset import prepare_hf_dataset
+
+    prepare_hf_dataset(**settings)
+
+def run_export(settings):
+    from scripts.export_shards import export_shards
+
+    export_shards(**settings)
+
+# Command: (runner, config section, log file name)
+COMMANDS = {
+    "crawl": (run_crawl, "crawl", "download_data"),
+    "build": (run_build, "build", "build_full_dataset"),
+    "caption": (run_caption, "caption", "generate_caption"),
+    "merge": (run_merge, "caption", "generate_caption"),
+    "prepare": (run_prepare, "prepare", "prepare_dataset"),
+    "export": (run_export, "export", "export_shards")
+}
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m scripts.cli", description="AfroAnnotation data pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--config", default=DEFAULT_CONFIG, help=f"YAML or JSON config file (default: {DEFAULT_CONFIG}).")
+    common.add_argument("--job", action="append", dest="jobs", help="Job of the config section to run. Repeatable; defaults to every job.")
+    common.add_argument("--set", action="append", dest="assignments", default=[], type=parse_assignment, metavar="KEY=VALUE", help="Overrides a setting. Repeatable.")
+    common.add_argument("--log-level", help="Minimum level of the logs printed to stdout.")
+    # Only the options given on the command line override the config
+    option = dict(default=argparse.SUPPRESS)
+
+    crawl = subparsers.add_parser("crawl", parents=[common], help="Download the category images.")
+    crawl.add_argument("--base-path", **option)
+    crawl.add_argument("--max-num", type=int, **option, help="Maximum number of images per keyword.")
+
+    build = subparsers.add_parser("build", parents=[common], help="Merge the source datasets into data/processed.")
+    build.add_argument("--num-proc", type=int, **option)
+    build.add_argument("--full", action="store_false", dest="incremental", **option, help="Rebuild every source from scratch.")
+
+    caption = subparsers.add_parser("caption", parents=[common], help="Generate the captions of a dataset.")
+    caption.add_argument("--dataset-path", **option, help="Dataset to caption, instead of the configured jobs.")
+    caption.add_argument("--output-path", **option, help="Path to save the generated captions.")
+    caption.add_argument("--category", choices=["fashion", "food"], **option)
+    caption.add_argument("--max-samples", type=int, **option)
+    caption.add_argument("--concurrency", type=int, **option)
+    caption.add_argument("--encode-workers", type=int, **option, help="Image encoding processes (0 encodes in the request threads).")
+    caption.add_argument("--prefetch", type=int, **option, help="Examples read ahead of the API calls.")
+    caption.add_argument("--pack-size", type=int, **option, help="Images sharing a label captioned per request.")
+    caption.add_argument("--output-format", choices=["json", "parquet", "arrow"], **option, help="Format of the merged caption file.")
+    caption.add_argument("--backend", choices=["azure", "local", "fake"], **option, help="Captioning backend; its options go in `backend_options`.")
+    caption.add_argument("--mode", choices=["online", "batch", "ingest"], **option)
+    caption.add_argument("--batch-force", action="store_true", **option, help="Request ids again even if an earlier batch holds them.")
+    caption.add_argument("--shard-index", type=int, **option)
+    caption.add_argument("--num-shards", type=int, **option)
+    caption.add_argument("--trace-path", **option, help="JSONL file receiving one metrics event per request.")
+    caption.add_argument("--prometheus-path", **option, help="Prometheus textfile receiving the aggregated metrics.")
+    caption.add_argument("--deployments", dest="deployments_config", **option, help="JSON file of the deployments to route requests across.")
+    caption.add_argument("--combine", action="store_true", help="Combine the shards of --output-path instead of captioning (same as the merge command).")
+
+    merge = subparsers.add_parser("merge", parents=[common], help="Merge the caption logs (and shards) of the caption jobs.")
+    merge.add_argument("--output-path", **option)
+    merge.add_argument("--num-shards", type=int, **option)
+    merge.add_argument("--output-format", choices=["json", "parquet", "arrow"], **option)
+
+    prepare = subparsers.add_parser("prepare", parents=[common], help="Join the captions to the dataset for training.")
+    prepare.add_argument("--dataset-path", **option)
+    prepare.add_argument("--caption-file", **option)
+    prepare.add_argument("--output-path", **option)
+    prepare.add_argument("--num-proc", type=int, **option)
+
+    export = subparsers.add_parser("export", parents=[common], help="Export the prepared datasets as tar shards for streaming training reads.")
+    export.add_argument("--dataset-path", **option)
+    export.add_argument("--output-path", **option, help="Directory of the shards and their index.")
+    export.add_argument("--max-shard-size", **option, help="Maximum size of each shard (e.g., 500MB).")
+    export.add_argument("--num-proc", type=int, **option)
+    return parser
+
+def main(argv=None):
+    args = vars(build_parser().parse_args(argv))
+    command = args.pop("command")
+    if args.pop("combine", False):
+        command = "merge"
+    config = load_config(args.pop("config"))
+    names = args.pop("jobs")
+    log_level = args.pop("log_level")
+    overrides = {**{k: v for k, v in args.items() if k != "assignments"}, **dict(args["assignments"])}
+
+    from utils.log import setup_logging
+
+    runner, section, log_name = COMMANDS[command]
+    logging = dict(config.get("logging") or {})
+    if log_level is not None:
+        logging["level"] = log_level
+    setup_logging(log_name, **logging)
+
+    for name, settings in expand_jobs(config.get(section), names, overrides):
+        if command == "merge":
+            settings = {**(config.get("merge") or {}), **{k: settings[k] for k in MERGE_KEYS if k in settings}}
+        if name is not None:
+            print(f"[INFO] ▶️ {command} job '{name}'")
+        runner(settings)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -3,18 +3,21 @@ Script to download images from Bing based on African scene categories.
 Uses the `icrawler` library to automate image scraping.
 Each category contains relevant search keywords.
 
+Keywords are crawled concurrently with per-host politeness limits. Every
+category directory keeps a manifest of fetched URLs, so an interrupted run
+resumes where it stopped, and images are stored under their content hash.
+
 Requirements:
 - pip install icrawler
 
 Usage:
-$ python scripts/download_data.py
+$ python -m scripts.cli crawl
 """
 
-from icrawler.builtin import BingImageCrawler
+from utils.crawler import crawl_keywords
 import os
-from tqdm.notebook import tqdm
 
-def download_images(keyword: str, save_dir: str, max_num: int = 100):
+def download_images(keyword: str, save_dir: str, max_num: int = 100, **crawl_kwargs):
     """
     Downloads images for a specific keyword using BingImageCrawler.
 
@@ -22,42 +25,32 @@ def download_images(keyword: str, save_dir: str, max_num: int = 100):
     - keyword (str): Search term to use for image crawling.
     - save_dir (str): Path to save the downloaded images.
     - max_num (int): Maximum number of images to download.
+    - crawl_kwargs: Options of `utils.crawler.crawl_keywords` (e.g., max_edge).
     """
-    os.makedirs(save_dir, exist_ok=True)
-    
-    crawler = BingImageCrawler(storage={'root_dir': save_dir})
-    crawler.crawl(keyword=keyword, max_num=max_num)
+    crawl_keywords({save_dir: [keyword]}, max_num=max_num, **crawl_kwargs)
 
+def download_categories(categories: dict, base_path: str = "data", max_num: int = 1000, **crawl_kwargs):
+    """
+    Downloads the images of every category keyword concurrently.
 
-if __name__ == "__main__":
-    categories = {
-        "fashion": [
-            "African traditional clothing",
-            "Wax fabric fashion",
-            "Bazin riche Senegal",
-            "Kente wedding Ghana"
-        ],
-        "markets": [
-            "African market scene",
-            "West African street market",
-            "Traditional African vendors"
-        ],
-        "rural_landscapes": [
-            "African village scene",
-            "Rural life in Africa",
-            "Traditional African houses"
-        ],
-        "african_cuisine": [
-            "Thieboudienne Senegal",
-            "Fufu and soup Ghana",
-            "Attiéké poisson Côte d'Ivoire"
-        ]
+    Parameters:
+    - categories (dict): Search keywords by category.
+    - base_path (str): Root directory; images go to `<base_path>/<category>/raw`.
+    - max_num (int): Maximum number of images per keyword.
+    - crawl_kwargs: Options of `utils.crawler.crawl_keywords` (e.g., max_keywords, max_per_host, max_edge).
+    """
+    keywords_by_dir = {
+        os.path.join(base_path, category, "raw"): keywords
+        for category, keywords in categories.items()
     }
+    counts = crawl_keywords(keywords_by_dir, max_num=max_num, **crawl_kwargs)
+    for save_dir, count in counts.items():
+        print(f"[INFO] {count} images in {save_dir}")
+
 
-    base_path = "data"
+if __name__ == "__main__":
+    # Categories and keywords come from the `crawl` section of configs/pipeline.yaml
+    from scripts.cli import main
+    import sys
 
-    for category, keywords in categories.items():
-        for keyword in keywords:
-            print(f"[INFO] Downloading: {keyword} into {category}")
-            save_path = os.path.join(base_path, category, "raw")
-            download_images(keyword, save_dir=save_path, max_num=1000)
+    main(["crawl", *sys.argv[1:]])
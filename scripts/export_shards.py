@@ -0,0 +1,160 @@
+"""
+This script exports a prepared dataset (see prepare_dataset.py) as tar shards
+in the WebDataset layout, for streaming training reads.
+
+Every sample is stored as its original image bytes (`<key>.jpg`, never
+re-encoded) next to a JSON file with its prompt, caption and other fields
+(`<key>.json`). Shards are bounded in size and listed, with their sample counts,
+in an `index.json` file. Reading a shard is a single sequential read, instead
+of the random accesses of `load_from_disk`; see `utils.webdataset.iter_webdataset`
+for the streaming reader with its shuffle buffer.
+
+"""
+
+from datasets import load_from_disk, Image as HfImage
+from datasets.utils.py_utils import convert_file_size_to_int
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Union
+import pyarrow.compute as pc
+import glob
+import os
+from tqdm import tqdm
+
+from utils.webdataset import TarShardWriter, sample_fields, sample_key, tar_file_size, tar_member_size, write_index
+
+# Rows read from the dataset at a time
+READ_BATCH_SIZE = 256
+
+def plan_shards(dataset, max_shard_size: int, max_shard_samples: Optional[int] = None, batch_size: int = 1000) -> List[range]:
+    """
+    Splits a dataset into consecutive index ranges of at most `max_shard_size`
+    bytes (and `max_shard_samples` samples).
+
+    Shard sizes are exact: each sample takes the tar size of its image member
+    (from the Arrow length of the image bytes, which are not read) and of its
+    encoded JSON member, with their headers and block padding.
+
+    Args:
+        dataset (Dataset): Dataset with an undecoded `image` column.
+        max_shard_size (int): Maximum size of a shard, in bytes.
+        max_shard_samples (int, optional): Maximum number of samples per shard.
+        batch_size (int): Number of rows read at a time.
+
+    Returns:
+        List[range]: The dataset indices of each shard.
+    """
+    columns = [column for column in dataset.column_names if column != "image"]
+    ranges, start, size = [], 0, 0
+    for offset in range(0, len(dataset), batch_size):
+        rows = dataset.with_format("arrow")[offset:offset + batch_size]
+        images = rows["image"]
+        lengths = pc.binary_length(pc.struct_field(images, "bytes")).to_pylist()
+        paths = pc.struct_field(images, "path").to_pylist()
+        fields = rows.select(columns).to_pylist()
+        for i, (length, path, sample) in enumerate(zip(lengths, paths, fields), start=offset):
+            image_size = length if length is not None else os.path.getsize(path)
+            sample_size = tar_member_size(image_size) + tar_member_size(len(sample_fields(sample)))
+            if i > start and (tar_file_size(size + sample_size) > max_shard_size or i - start == max_shard_samples):
+                ranges.append(range(start, i))
+                start, size = i, 0
+            size += sample_size
+    if start < len(dataset):
+        ranges.append(range(start, len(dataset)))
+    return ranges
+
+def write_shard(dataset_path: str, indices: range, shard_file: str) -> Dict:
+    """
+    Writes the samples of a dataset index range to a tar shard. Runs in the
+    export processes, each loading the dataset memory-mapped.
+
+    Args:
+        dataset_path (str): Path to the prepared dataset.
+        indices (range): The dataset indices of the shard.
+        shard_file (str): The tar shard to write.
+
+    Returns:
+        Dict: The shard's index entry (file, samples, bytes and first index).
+    """
+    dataset = load_from_disk(dataset_path)
+    dataset = dataset.cast_column("image", HfImage(decode=False)).select(indices)
+    columns = [column for column in dataset.column_names if column != "image"]
+    keys = iter(indices)
+    with TarShardWriter(shard_file) as writer:
+        for batch in dataset.iter(batch_size=READ_BATCH_SIZE):
+            for k, image in enumerate(batch["image"]):
+                if image["bytes"] is None:
+                    with open(image["path"], 'rb') as f:
+                        image["bytes"] = f.read()
+                writer.write(sample_key(next(keys)), image["bytes"], {column: batch[column][k] for column in columns})
+    return {
+        "file": os.path.basename(shard_file),
+        "samples": len(indices),
+        "bytes": os.path.getsize(shard_file),
+        "start": indices.start
+    }
+
+def export_shards(
+    dataset_path: str,
+    output_path: str,
+    max_shard_size: Union[str, int] = "500MB",
+    max_shard_samples: Optional[int] = None,
+    num_proc: Optional[int] = None,
+    prefix: str = "shard"
+) -> str:
+    """
+    Exports a prepared dataset as size-bounded tar shards with a shard index.
+
+    Shards are written in parallel, one per task, by `num_proc` processes.
+    Previous shards of `output_path` are removed first.
+
+    Args:
+        dataset_path (str): Path to the prepared dataset (with `image`,
+            `prompt` and `caption` columns).
+        output_path (str): Directory of the shards and of `index.json`.
+        max_shard_size (str or int): Maximum size of each shard (e.g., "500MB").
+        max_shard_samples (int, optional): Maximum number of samples per shard.
+        num_proc (int, optional): Number of export processes. Defaults to the
+            CPU count; 0 or 1 exports in this process.
+        prefix (str): File name prefix of the shards.
+
+    Returns:
+        str: The shard index file.
+    """
+    print(f"[INFO] 📦 Loading dataset from: {dataset_path}")
+    dataset = load_from_disk(dataset_path)
+    if "image" not in dataset.column_names:
+        raise ValueError(f"The dataset at '{dataset_path}' has no 'image' column.")
+    dataset = dataset.cast_column("image", HfImage(decode=False))
+    shards = plan_shards(dataset, convert_file_size_to_int(max_shard_size), max_shard_samples)
+    print(f"[INFO] 🧩 Exporting {len(dataset)} samples to {len(shards)} shards of at most {max_shard_size}.")
+
+    os.makedirs(output_path, exist_ok=True)
+    for old_shard in glob.glob(os.path.join(output_path, f"{prefix}-*.tar")):
+        os.remove(old_shard)
+    shard_files = [os.path.join(output_path, f"{prefix}-{k:05d}.tar") for k in range(len(shards))]
+
+    if num_proc is not None and num_proc <= 1:
+        entries = [write_shard(dataset_path, indices, shard_file) for indices, shard_file in tqdm(zip(shards, shard_files), total=len(shards), desc="🧩 Writing shards")]
+    else:
+        with ProcessPoolExecutor(max_workers=num_proc) as executor:
+            entries = list(tqdm(
+                executor.map(write_shard, [dataset_path] * len(shards), shards, shard_files),
+                total=len(shards),
+                desc="🧩 Writing shards"
+            ))
+
+    index_file = write_index(
+        output_path,
+        entries,
+        source=os.path.abspath(dataset_path),
+        fields=[column for column in dataset.column_names if column != "image"]
+    )
+    print(f"[INFO] 💾 {sum(entry['samples'] for entry in entries)} samples exported → {index_file}")
+    return index_file
+
+if __name__ == '__main__':
+    # Dataset and shard paths come from the `export` section of configs/pipeline.yaml
+    from scripts.cli import main
+    import sys
+
+    main(["export", *sys.argv[1:]])
@@ -1,127 +1,147 @@
-from datasets import load_from_disk
+from datasets import load_from_disk, Image as HfImage
 from tqdm import tqdm
 import json
 import csv
 from PIL import Image
-from utils.call_openai_api import describe_image
-from utils import checkpoint
+from utils.call_openai_api import describe_image, describe_images, get_client, get_deployment, build_image_payload, build_messages, check_packing_support, MAX_TOKENS, API_VERSION, STRUCTURED_API_VERSION
+from utils import batch
+from utils.dedup import dedup_dataset
+from utils import checkpoint, caption_log, caption_table
+from utils.caption_cache import CaptionCache, DEFAULT_CACHE_PATH
+from utils.metrics import Metrics, stage
 from loguru import logger
 import sys
 import os
-from glob import glob
-from collections import Counter
-
-
-# --------------------------- LOGGER SETUP ---------------------------
-os.makedirs("logs", exist_ok=True)
-logger.remove()
-logger.add(
-    sys.stdout,
-    level="INFO",
-    colorize=True,
-    enqueue=True,
-    backtrace=True,
-    diagnose=False
-)
-logger.add(
-    "logs/generate_caption_error.log",
-    level="ERROR",
-    rotation="10 MB",
-    encoding="utf-8",
-    enqueue=True,
-    backtrace=True,
-    diagnose=False
-)
-logger.add(
-    "logs/generate_caption.log",
-    level="WARNING",
-    rotation="10 MB",
-    encoding="utf-8",
-    enqueue=True,
-    backtrace=True,
-    diagnose=False
-)
+import random
+import time
+from collections import Counter, deque
+from contextlib import nullcontext
+from itertools import chain, islice
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
 
 # --------------------------- PROMPT LOGIC ---------------------------
+# Prompt of each category, with the image label in place of {label}
+PROMPT_TEMPLATES = {
+    "fashion": (
+        "In this image, briefly describe the person or group wearing '{label}' clothing. "
+        "Indicate whether it's a man, woman, child, or group, and focus on their clothing style, colors, and patterns. "
+        "Mention any visible accessories, fabrics (like wax or vlisco), and cultural hints if they are visually obvious. "
+        "Do not explain what the label means. Only describe what can be seen."
+        "Do not be too long, just describe the image in a few sentences."
+        "If the image is not clear, say that you cannot see the person or clothing clearly."
+    ),
+    "food": (
+        "In this image, briefly describe the African dish labeled '{label}'. "
+        "Mention the visible ingredients, how it's served, and any accompaniments. "
+        "If the dish is part of a meal or has a certain presentation style, describe it. "
+        "Do not explain the label; stay focused on what is visible."
+        "Do not be too long, just describe the image in a few sentences."
+        "If the image is not clear, say that you cannot see the dish clearly."
+    )
+}
+DEFAULT_PROMPT = "Briefly describe what is happening in the image, focusing only on visual details."
+
 def get_prompt(category, label):
     """
     Returns a refined, contextual, image-grounded prompt.
     """
-    if category == "fashion":
-        return (
-            f"In this image, briefly describe the person or group wearing '{label}' clothing. "
-            "Indicate whether it's a man, woman, child, or group, and focus on their clothing style, colors, and patterns. "
-            "Mention any visible accessories, fabrics (like wax or vlisco), and cultural hints if they are visually obvious. "
-            "Do not explain what the label means. Only describe what can be seen."
-            "Do not be too long, just describe the image in a few sentences."
-            "If the image is not clear, say that you cannot see the person or clothing clearly."
-        )
-    elif category == "food":
-        return (
-            f"In this image, briefly describe the African dish labeled '{label}'. "
-            "Mention the visible ingredients, how it's served, and any accompaniments. "
-            "If the dish is part of a meal or has a certain presentation style, describe it. "
-            "Do not explain the label; stay focused on what is visible."
-            "Do not be too long, just describe the image in a few sentences."
-            "If the image is not clear, say that you cannot see the dish clearly."
-        )
-    else:
-        return (
-            "Briefly describe what is happening in the image, focusing only on visual details."
-        )
-# --------------------------- SAVE PARTIAL CAPTIONS ---------------------------
-def save_partial(output_path, part_index, prompt, results):
-    part_file = f"{output_path}.part{part_index}.json"
-    os.makedirs(os.path.dirname(part_file), exist_ok=True)
-    with open(part_file, 'w', encoding='utf-8') as f:
-        json.dump({
-            "prompt": prompt,
-            "captions": results
-        }, f, ensure_ascii=False, indent=2)
-    logger.info(f"💾 Saved part {part_index} with {len(results)} captions → {part_file}")
+    template = PROMPT_TEMPLATES.get(category)
+    return template.format(label=label) if template is not None else DEFAULT_PROMPT
+
+# Extension of the merged caption file of each output format
+CAPTION_FORMATS = {"json": ".json", "parquet": ".parquet", "arrow": ".arrow"}
+
+def caption_file_path(output_path, output_format="json"):
+    """
+    Returns the merged caption file of an output path.
+    """
+    if output_format not in CAPTION_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}'. Must be one of {list(CAPTION_FORMATS)}.")
+    return output_path + CAPTION_FORMATS[output_format]
 
 # --------------------------- MERGE FINAL PARTS ---------------------------
-def merge_caption_parts(base_path, output_file, delete_parts=True, save_csv=False, save_summary=True):
-    part_files = sorted(glob(f"{base_path}.part*.json"))
-    all_captions = []
-    prompt_ref = None
-
-    for part_file in part_files:
-        with open(part_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            if prompt_ref is None:
-                prompt_ref = data.get("prompt")
-            all_captions.extend(data.get("captions", []))
-
-    merged = {
-        "prompt": prompt_ref,
-        "captions": all_captions
-    }
+def merge_caption_parts(base_path, output_file, delete_parts=True, save_csv=False, save_summary=True, part_files=None):
+    """
+    Merges the caption log segments of a run into the final caption file.
+
+    Segments are k-way merged in id order and streamed to the caption file,
+    CSV and summary outputs in a single pass, so memory use does not grow
+    with the number of captions. An id logged several times keeps its last caption.
+
+    A ".json" output file keeps the original layout. A ".parquet" or ".arrow"
+    file stores the records as a table whose label and prompt columns are
+    dictionary-encoded, with the prompt templates in its schema metadata (see
+    utils/caption_table.py); it is much smaller and loads memory-mapped.
+
+    Args:
+        base_path (str): The output path the segments were written for.
+        output_file (str): Path of the merged caption file.
+        delete_parts (bool): Whether to delete the segments once merged.
+        save_csv (bool): Whether to also write a CSV version.
+        save_summary (bool): Whether to also write a label summary.
+        part_files (List[str], optional): The segments to merge. Defaults to
+            the segments of `base_path`.
+    """
+    if part_files is None:
+        part_files = caption_log.list_segments(base_path)
+    records = caption_log.merge_segments(part_files)
+    first = next(records, None)
+    prompt_ref = first.get("prompt") if first is not None else None
 
-    # Save merged JSON
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(merged, f, ensure_ascii=False, indent=2)
-    logger.success(f"✅ Final merged file saved → {output_file}")
+    output_base = os.path.splitext(output_file)[0]
+    csv_path = output_base + ".csv"
+    label_counter = Counter()
+    num_captions = 0
 
-    # Optional: Save CSV version
-    if save_csv:
-        csv_path = output_file.replace(".json", ".csv")
-        with open(csv_path, 'w', encoding='utf-8', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=["id", "label", "caption"])
+    is_json = caption_table.table_format(output_file) is None
+    if not is_json:
+        output = caption_table.CaptionTableWriter(
+            output_file,
+            metadata={"prompt_templates": json.dumps(PROMPT_TEMPLATES, ensure_ascii=False)}
+        )
+    else:
+        output = open(output_file, 'w', encoding='utf-8')
+    with output as f, \
+            (open(csv_path, 'w', encoding='utf-8', newline='') if save_csv else nullcontext()) as csv_file:
+        if save_csv:
+            writer = csv.DictWriter(csv_file, fieldnames=["id", "label", "caption"])
             writer.writeheader()
-            for item in all_captions:
+
+        # Same layout as json.dump(..., indent=2), written one record at a time
+        if is_json:
+            f.write("{\n")
+            f.write(f'  "prompt": {json.dumps(prompt_ref, ensure_ascii=False)},\n')
+            f.write('  "captions": [')
+        for item in chain([first], records) if first is not None else ():
+            if is_json:
+                item_json = json.dumps(item, ensure_ascii=False, indent=2).replace("\n", "\n    ")
+                f.write(("," if num_captions else "") + "\n    " + item_json)
+            else:
+                f.write(item)
+            num_captions += 1
+
+            # Optional: CSV version
+            if save_csv:
                 writer.writerow({
                     "id": item["id"],
                     "label": item["label"],
                     "caption": item["caption"]
                 })
+
+            # Optional: label summary
+            if item["caption"]:
+                label_counter[item["label"]] += 1
+        if is_json:
+            f.write("\n  ]\n}" if num_captions else "]\n}")
+    logger.success(f"✅ Final merged file saved with {num_captions} captions → {output_file}")
+    if save_csv:
         logger.info(f"📄 CSV file saved → {csv_path}")
 
     # Optional: Save label summary
     if save_summary:
-        label_counter = Counter([item["label"] for item in all_captions if item["caption"]])
-        summary_path = output_file.replace(".json", "_summary.txt")
+        summary_path = output_base + "_summary.txt"
         with open(summary_path, 'w', encoding='utf-8') as f:
             f.write("📊 Label summary:\n")
             for label, count in label_counter.most_common():
@@ -134,8 +154,803 @@ def merge_caption_parts(base_path, output_file, delete_parts=True, save_csv=Fals
             os.remove(part_file)
         logger.info(f"🧹 Deleted {len(part_files)} part files.")
         
+# --------------------------- CAPTION ONE EXAMPLE ---------------------------
+def caption_example(example, category, features, client=None, **describe_kwargs):
+    """
+    Captions a single dataset example and returns its caption record.
+    Extra keyword arguments are passed to `describe_image`.
+
+    Failures are logged and recorded with `caption: None`; they are retried
+    by `generate_captions`.
+    """
+    id = example['id']
+    image = image_source(example['image'])
+    label_str, prompt = example_prompt(example, category, features)
+
+    try:
+        caption = describe_image(
+            prompt,
+            image=image,
+            label=label_str,
+            show_image=False,
+            client=client,
+            raise_errors=True,
+            **describe_kwargs
+        )
+    except Exception as e:
+        logger.error(f"❌ Failed to generate caption for image ID={id}: {e}")
+        caption = None
+
+    return {
+        "id": id,
+        "label": label_str,
+        "prompt": prompt,
+        "caption": caption
+    }
+
+def image_source(image):
+    """
+    Returns the stored bytes (or file path) of an undecoded dataset image, a
+    dict with 'bytes' and 'path', so that `build_image_payload` can send them
+    without a decode/re-encode round-trip. Other images are returned as they are.
+    """
+    if isinstance(image, dict):
+        return image['bytes'] if image.get('bytes') is not None else image['path']
+    return image
+
+def undecoded(dataset):
+    """
+    Returns the dataset with its image column left undecoded, when it is an Image feature.
+    """
+    if isinstance(dataset.features.get('image'), HfImage):
+        return dataset.cast_column('image', HfImage(decode=False))
+    return dataset
+
+def label_name(features, label):
+    """
+    Returns the name of a label: string labels as they are, class ids through
+    the dataset's `label` ClassLabel feature.
+    """
+    return label if isinstance(label, str) else features['label'].int2str(label)
+
+def example_prompt(example, category, features):
+    """
+    Returns the label string and the prompt of an example.
+    """
+    label_str = label_name(features, example['label'])
+    return label_str, get_prompt(category, label_str)
+
+# --------------------------- PREFETCH PIPELINE ---------------------------
+# Arguments of `describe_image` that shape the image payload
+ENCODE_KWARGS = ("detail", "max_image_bytes", "payload_cache_dir")
+
+def _encode_kwargs(describe_kwargs):
+    """
+    Returns the image encoding settings among the `describe_image` arguments.
+    """
+    return {k: describe_kwargs[k] for k in ENCODE_KWARGS if k in describe_kwargs}
+
+def encode_example_image(image, detail="auto", max_image_bytes=None, payload_cache_dir=None):
+    """
+    Builds the image payload of an undecoded dataset image (a dict with
+    'bytes' and 'path'). Runs in the encode processes of `iter_captions`.
+
+    Returns:
+        Tuple[dict, float]: The image content part and the encoding time, in seconds.
+    """
+    start = time.perf_counter()
+    image_payload = build_image_payload(
+        image=image_source(image),
+        detail=detail,
+        max_image_bytes=max_image_bytes,
+        payload_cache_dir=payload_cache_dir
+    )
+    return image_payload, time.perf_counter() - start
+
+def caption_encoded_example(example, encoded, category, features, client=None, **describe_kwargs):
+    """
+    Captions an example whose image was encoded in the encode stage, given
+    the finished future of `encode_example_image`.
+    """
+    try:
+        image_payload, seconds = encoded.result()
+    except Exception as e:
+        logger.error(f"❌ Failed to encode image ID={example['id']}: {e}")
+        label_str, prompt = example_prompt(example, category, features)
+        return {"id": example['id'], "label": label_str, "prompt": prompt, "caption": None}
+
+    metrics = describe_kwargs.get("metrics")
+    if metrics is not None:
+        metrics.observe_stage("encode", seconds)
+    return caption_example({**example, 'image': None}, category, features, client, image_payload=image_payload, **describe_kwargs)
+
+def iter_captions_pipelined(dataset, category, concurrency=1, encode_workers=None, prefetch=None, client=None, **describe_kwargs):
+    """
+    Yields one caption record per example, in dataset order, encoding images
+    and calling the API in overlapping stages.
+
+    Undecoded images go to a pool of `encode_workers` processes, which resize
+    and base64-encode them. Each finished payload is handed to a pool of
+    `concurrency` network threads, and the records come back to the caller
+    (the writer) in dataset order. At most `concurrency + prefetch` examples
+    are between the reader and the writer, so a slow API stops the reading and
+    encoding instead of piling up payloads in memory, and a slow encoder never
+    holds a network thread. On exit (including errors and interrupts) pending
+    work is cancelled and both pools are shut down.
+
+    Args:
+        dataset (Dataset): Dataset with `id`, `image` (an Image feature) and `label` columns.
+        category (str): Category of the dataset ("fashion" or "food").
+        concurrency (int): Maximum number of concurrent API calls.
+        encode_workers (int, optional): Number of encode processes. Defaults to the CPU count.
+        prefetch (int, optional): Examples read ahead of the network threads.
+            Defaults to `2 * max(concurrency, encode_workers)`.
+        client (AzureOpenAI, optional): Client shared by every call.
+        **describe_kwargs: Extra arguments passed to `describe_image`.
+
+    Yields:
+        dict: The caption record of each example.
+    """
+    encode_workers = encode_workers or os.cpu_count() or 1
+    concurrency = max(1, concurrency)
+    if prefetch is None:
+        prefetch = 2 * max(concurrency, encode_workers)
+    encode_kwargs = _encode_kwargs(describe_kwargs)
+    features = dataset.features
+    dataset = undecoded(dataset)
+
+    encoders = ProcessPoolExecutor(max_workers=encode_workers)
+    senders = ThreadPoolExecutor(max_workers=concurrency)
+    closed = False
+
+    def send(example, encoded, result):
+        # Runs when the encoding finishes: queue the request on the network threads
+        if closed:
+            result.cancel()
+            return
+        try:
+            request = senders.submit(caption_encoded_example, example, encoded, category, features, client, **describe_kwargs)
+        except RuntimeError:
+            result.cancel()
+            return
+        request.add_done_callback(lambda request: _copy_future(request, result))
+
+    pending = deque()
+    try:
+        for example in iter_examples(dataset, describe_kwargs.get("metrics")):
+            result = Future()
+            encoded = encoders.submit(encode_example_image, example['image'], **encode_kwargs)
+            encoded.add_done_callback(lambda encoded, example=example, result=result: send(example, encoded, result))
+            pending.append(result)
+            if len(pending) >= concurrency + prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        closed = True
+        encoders.shutdown(wait=True, cancel_futures=True)
+        senders.shutdown(wait=True, cancel_futures=True)
+
+def _copy_future(source, target):
+    """
+    Resolves `target` with the outcome of the finished future `source`.
+    """
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+# --------------------------- PACKED REQUESTS ---------------------------
+# Examples grouped together by label, in multiples of the pack size
+PACK_WINDOW = 16
+
+def iter_packed_groups(examples, pack_size, window=None):
+    """
+    Splits examples into windows of consecutive examples, and every window
+    into groups of at most `pack_size` examples with the same label.
+
+    Args:
+        examples (Iterable[dict]): The examples, in dataset order.
+        pack_size (int): Maximum number of examples per group.
+        window (int, optional): Examples per window. Defaults to `PACK_WINDOW * pack_size`.
+
+    Yields:
+        List[List[Tuple[int, dict]]]: The groups of each window, with the
+        position of every example in its window.
+    """
+    window = window or PACK_WINDOW * pack_size
+    examples = iter(examples)
+    while True:
+        chunk = list(islice(examples, window))
+        if not chunk:
+            return
+        by_label = {}
+        for position, example in enumerate(chunk):
+            by_label.setdefault(example['label'], []).append((position, example))
+        yield [
+            members[k:k + pack_size]
+            for members in by_label.values()
+            for k in range(0, len(members), pack_size)
+        ]
+
+def caption_group(examples, category, features, client=None, encoded=None, **describe_kwargs):
+    """
+    Captions a group of examples sharing a label with one packed request,
+    then captions the ids the answer missed with single-image requests.
+
+    Images are encoded once and reused by the single-image retries: `encoded`
+    holds the futures of their encodes, submitted to the encode processes
+    before the group was queued, so that this thread only waits for them.
+    Without it, images are encoded in the calling thread.
+
+    Returns:
+        List[dict]: The caption records of the group, in order.
+    """
+    label_str, prompt = example_prompt(examples[0], category, features)
+    if len(examples) == 1 and encoded is None:
+        return [caption_example(examples[0], category, features, client, **describe_kwargs)]
+    metrics = describe_kwargs.get("metrics")
+    encode_kwargs = _encode_kwargs(describe_kwargs)
+
+    # Encode the images of the group
+    payloads = {}
+    if encoded is not None:
+        for id, future in encoded.items():
+            try:
+                payloads[id], seconds = future.result()
+            except Exception as e:
+                logger.error(f"❌ Failed to encode image ID={id}: {e}")
+                continue
+            if metrics is not None:
+                metrics.observe_stage("encode", seconds)
+    else:
+        for example in examples:
+            try:
+                with stage(metrics, "encode"):
+                    payloads[example['id']] = build_image_payload(image=image_source(example['image']), **encode_kwargs)
+            except Exception as e:
+                logger.error(f"❌ Failed to encode image ID={example['id']}: {e}")
+
+    captions = {}
+    if len(payloads) > 1:
+        try:
+            captions = describe_images(
+                prompt,
+                payloads,
+                label=label_str,
+                client=client,
+                raise_errors=True,
+                **describe_kwargs
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Packed request for {len(payloads)} images failed, captioning them one by one: {e}")
+
+    records = []
+    for example in examples:
+        id = example['id']
+        if captions.get(id) is None and id in payloads:
+            # Missing from the packed answer: fall back to a single-image request
+            records.append(caption_example({**example, 'image': None}, category, features, client, image_payload=payloads[id], **describe_kwargs))
+        else:
+            records.append({"id": id, "label": label_str, "prompt": prompt, "caption": captions.get(id)})
+    return records
+
+def iter_captions_packed(dataset, category, pack_size, concurrency=1, encode_workers=None, client=None, **describe_kwargs):
+    """
+    Yields one caption record per example, in dataset order, captioning up to
+    `pack_size` examples with the same label per request.
+
+    Examples are grouped by label within windows of consecutive examples (see
+    `iter_packed_groups`), and the records of a window are yielded in dataset
+    order once its groups are done. Up to `concurrency` packed requests are in
+    flight at once, with about as many groups queued behind them. With
+    `encode_workers` other than 0, images are encoded in a process pool.
+
+    Args:
+        dataset (Dataset): Dataset with `id`, `image` and `label` columns.
+        category (str): Category of the dataset ("fashion" or "food").
+        pack_size (int): Maximum number of images per request.
+        concurrency (int): Maximum number of concurrent API calls.
+        encode_workers (int, optional): Number of encode processes. Defaults to the CPU count.
+        client (AzureOpenAI, optional): Client shared by every call.
+        **describe_kwargs: Extra arguments passed to `describe_images` and `describe_image`.
+
+    Yields:
+        dict: The caption record of each example.
+    """
+    check_packing_support(client, describe_kwargs.get("pool"))
+    features = dataset.features
+    concurrency = max(1, concurrency)
+    dataset = undecoded(dataset)
+    encode_kwargs = _encode_kwargs(describe_kwargs)
+    encoder = None
+    if encode_workers != 0 and isinstance(features.get('image'), HfImage):
+        encoder = ProcessPoolExecutor(max_workers=encode_workers or os.cpu_count() or 1)
+    senders = ThreadPoolExecutor(max_workers=concurrency)
+
+    def submit_group(group):
+        examples = [example for _, example in group]
+        # Encodes are queued now, ahead of the group's turn for a sender thread
+        encoded = None
+        if encoder is not None:
+            encoded = {example['id']: encoder.submit(encode_example_image, example['image'], **encode_kwargs) for example in examples}
+        return senders.submit(caption_group, examples, category, features, client, encoded, **describe_kwargs)
+
+    def window_records(window):
+        records = [None] * sum(len(positions) for positions, _ in window)
+        for positions, future in window:
+            for position, record in zip(positions, future.result()):
+                records[position] = record
+        return records
+
+    # Windows of (example positions, caption_group future) pairs
+    pending = deque()
+    try:
+        for groups in iter_packed_groups(iter_examples(dataset, describe_kwargs.get("metrics")), pack_size):
+            pending.append([([position for position, _ in group], submit_group(group)) for group in groups])
+            while sum(len(window) for window in pending) >= 2 * concurrency and len(pending) > 1:
+                yield from window_records(pending.popleft())
+        while pending:
+            yield from window_records(pending.popleft())
+    finally:
+        senders.shutdown(wait=True, cancel_futures=True)
+        if encoder is not None:
+            encoder.shutdown(wait=True, cancel_futures=True)
+
+# Rows read from the dataset at a time
+READ_BATCH_SIZE = 64
+
+def iter_examples(dataset, metrics=None, batch_size=READ_BATCH_SIZE):
+    """
+    Iterates over a dataset, reading it `batch_size` rows at a time and timing
+    each read as the "decode" stage. Undecoded images (see `undecoded`) come
+    out as their stored bytes; any decoding happens in the "encode" stage.
+    """
+    iterator = dataset.iter(batch_size=batch_size)
+    while True:
+        with stage(metrics, "decode"):
+            batch = next(iterator, None)
+        if batch is None:
+            return
+        columns = list(batch)
+        for row in zip(*batch.values()):
+            yield dict(zip(columns, row))
+
+def iter_captions_backend(dataset, category, backend, metrics=None):
+    """
+    Yields one caption record per example, in dataset order, captioning
+    `backend.batch_size` examples per `caption_batch` call (see utils/backends.py).
+
+    Images are read as their stored bytes and prepared by the backend (e.g.,
+    decoded for a local model) in the "encode" stage; the batch call is timed
+    as the "model" stage. A failed batch gives None captions, retried later.
+
+    Args:
+        dataset (Dataset): Dataset with `id`, `image` and `label` columns.
+        category (str): Category of the dataset ("fashion" or "food").
+        backend (CaptionBackend): The captioning backend.
+        metrics (Metrics, optional): Receives the stage timings.
+
+    Yields:
+        dict: The caption record of each example.
+    """
+    features = dataset.features
+    examples = iter_examples(undecoded(dataset), metrics)
+    while True:
+        group = list(islice(examples, backend.batch_size))
+        if not group:
+            return
+        records, prompts = [], []
+        for example in group:
+            label_str, prompt = example_prompt(example, category, features)
+            records.append({"id": example['id'], "label": label_str, "prompt": backend.stored_prompt(prompt), "caption": None})
+            prompts.append(prompt)
+
+        # Prepare the images, leaving out the ones that cannot be read
+        images, batch, batch_prompts = [], [], []
+        with stage(metrics, "encode"):
+            for example, record, prompt in zip(group, records, prompts):
+                try:
+                    images.append(backend.prepare_image(image_source(example['image'])))
+                    batch.append(record)
+                    batch_prompts.append(prompt)
+                except Exception as e:
+                    logger.error(f"❌ Failed to read image ID={record['id']}: {e}")
+
+        if batch:
+            try:
+                with stage(metrics, "model"):
+                    captions = backend.caption_batch(images, batch_prompts, [r["label"] for r in batch])
+                for record, caption in zip(batch, captions):
+                    record["caption"] = caption
+            except Exception as e:
+                logger.error(f"❌ {backend.name} backend failed on a batch of {len(batch)} images: {e}")
+        yield from records
+
+def iter_captions(dataset, category, concurrency=1, client=None, encode_workers=None, prefetch=None, pack_size=1, backend=None, **describe_kwargs):
+    """
+    Yields one caption record per example, in dataset order.
+
+    With `pack_size > 1`, images are captioned in packed requests (see
+    `iter_captions_packed`). By default, images are encoded in a process pool
+    ahead of the API calls (see `iter_captions_pipelined`). With `encode_workers=0`, each request
+    encodes its own image in the calling thread: with `concurrency > 1`, up to `concurrency` requests are in flight at once
+    on a thread pool. Records are still yielded in dataset order, so parts and
+    checkpoints are identical to the sequential path. At most
+    `2 * concurrency` examples are buffered ahead of the writer.
+
+    Args:
+        dataset (Dataset): Dataset with `id`, `image` and `label` columns.
+        category (str): Category of the dataset ("fashion" or "food").
+        concurrency (int): Maximum number of concurrent API calls.
+        client (AzureOpenAI, optional): Client shared by every call.
+        encode_workers (int, optional): Number of encode processes. Defaults to
+            the CPU count; 0 encodes in the request threads.
+        prefetch (int, optional): Examples read ahead of the network threads
+            in the pipelined path.
+        pack_size (int): Maximum number of images per request.
+        backend (CaptionBackend, optional): Captions the images instead of
+            the API (see `iter_captions_backend`).
+        **describe_kwargs: Extra arguments passed to `describe_image`.
+
+    Yields:
+        dict: The caption record of each example.
+    """
+    if backend is not None:
+        yield from iter_captions_backend(dataset, category, backend, metrics=describe_kwargs.get("metrics"))
+        return
+    if pack_size > 1:
+        yield from iter_captions_packed(
+            dataset, category, pack_size, concurrency=concurrency,
+            encode_workers=encode_workers, client=client, **describe_kwargs
+        )
+        return
+    if encode_workers != 0 and isinstance(dataset.features.get('image'), HfImage):
+        yield from iter_captions_pipelined(
+            dataset, category, concurrency=concurrency, encode_workers=encode_workers,
+            prefetch=prefetch, client=client, **describe_kwargs
+        )
+        return
+
+    features = dataset.features
+    examples = iter_examples(undecoded(dataset), describe_kwargs.get("metrics"))
+    if concurrency <= 1:
+        for example in examples:
+            yield caption_example(example, category, features, client, **describe_kwargs)
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for example in examples:
+            pending.append(executor.submit(caption_example, example, category, features, client, **describe_kwargs))
+            if len(pending) >= 2 * concurrency:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# --------------------------- PROGRESS TRACKING ---------------------------
+def load_progress(output_path, dataset):
+    """
+    Loads the completed and failed dataset indices of a run.
+
+    The checkpoint is reconciled with the caption log, which is flushed on
+    every record and can therefore be ahead of the checkpoint after a crash.
+
+    Args:
+        output_path (str): Path the captions are saved to.
+        dataset (Dataset): The dataset being captioned.
+
+    Returns:
+        Tuple[IndexSet, IndexSet]: The completed and failed indices.
+    """
+    completed, failed = checkpoint.load_state(output_path)
+    if caption_log.list_segments(output_path):
+        index_of = {id: i for i, id in enumerate(dataset['id'])}
+        for record in caption_log.iter_records(output_path):
+            i = index_of.get(record["id"])
+            if i is None:
+                continue
+            if record["caption"] is not None:
+                completed.add(i)
+            else:
+                failed.add(i)
+    return completed, failed - completed
+
+def caption_pass(dataset, indices, output_path, category, completed, failed, save_every=500, fsync="batch", desc=None, **caption_kwargs):
+    """
+    Captions the given dataset indices into a new caption log segment.
+
+    Progress is merged into the checkpoint every `save_every` records and at
+    the end of the pass.
+
+    Args:
+        dataset (Dataset): The dataset being captioned.
+        indices (List[int]): Sorted dataset indices to caption.
+        output_path (str): Path the captions are saved to.
+        category (str): Category of the dataset ("fashion" or "food").
+        completed (IndexSet): Completed indices, updated in place.
+        failed (IndexSet): Failed indices, updated in place.
+        save_every (int): Number of captions between checkpoints.
+        fsync (str): fsync policy of the caption log.
+        desc (str, optional): Progress bar description.
+        **caption_kwargs: Extra arguments passed to `iter_captions`.
+
+    Returns:
+        List[int]: The indices whose caption failed.
+    """
+    pass_failed = []
+    segment_file = caption_log.segment_path(output_path, caption_log.next_segment_index(output_path))
+    logger.info(f"💾 Logging {len(indices)} captions → {segment_file}")
+
+    metrics = caption_kwargs.get("metrics")
+    records = iter_captions(dataset.select(indices), category, **caption_kwargs)
+    with caption_log.CaptionWriter(segment_file, fsync=fsync) as writer:
+        for n, (i, record) in enumerate(tqdm(zip(indices, records), desc=desc, total=len(indices)), start=1):
+            with stage(metrics, "write"):
+                writer.write(record)
+            if record["caption"] is not None:
+                completed.add(i)
+                failed.discard(i)
+            else:
+                failed.add(i)
+                pass_failed.append(i)
+
+            if n % save_every == 0:
+                checkpoint.update_state(output_path, completed, failed)
+                logger.info(f"📝 Logged {n} captions and checkpoint updated.")
+
+    checkpoint.update_state(output_path, completed, failed)
+    return pass_failed
+
+# --------------------------- BATCH API MODE ---------------------------
+def iter_batch_requests(dataset, indices, category, model, detail="auto", max_image_bytes=None, payload_cache_dir=None):
+    """
+    Yields one Batch API request per dataset index, with `custom_id` set to the dataset `id`.
+    """
+    examples = iter_examples(undecoded(dataset.select(indices)))
+    for example in tqdm(examples, desc=f"{category.title()} Batch requests", total=len(indices)):
+        label_str = label_name(dataset.features, example['label'])
+        image_payload = build_image_payload(
+            image=image_source(example['image']),
+            detail=detail,
+            max_image_bytes=max_image_bytes,
+            payload_cache_dir=payload_cache_dir
+        )
+        messages = build_messages(get_prompt(category, label_str), image_payload, label=label_str)
+        yield batch.batch_request(example['id'], messages, model, MAX_TOKENS)
+
+def ingest_batch_results(dataset, output_path, category, batch_dir, completed, failed, fsync="batch"):
+    """
+    Ingests Batch API result files into the caption log and the checkpoint.
+
+    Results are read from `results-XXXXX.jsonl` files in `batch_dir`, however
+    they got there (downloaded with `batch.download_batch_results` or written
+    by a local stand-in). Ids that are already completed are skipped.
+
+    Args:
+        dataset (Dataset): The dataset being captioned.
+        output_path (str): Path the captions are saved to.
+        category (str): Category of the dataset ("fashion" or "food").
+        batch_dir (str): Directory with the result files.
+        completed (IndexSet): Completed indices, updated in place.
+        failed (IndexSet): Failed indices, updated in place.
+        fsync (str): fsync policy of the caption log.
+
+    Returns:
+        int: The number of ingested results.
+    """
+    index_of = {id: i for i, id in enumerate(dataset['id'])}
+    captions = {}
+    for custom_id, caption, error in batch.iter_batch_results(batch.list_result_files(batch_dir)):
+        i = index_of.get(custom_id)
+        if i is None or i in completed:
+            continue
+        if error is not None:
+            logger.error(f"❌ Batch request failed for image ID={custom_id}: {error}")
+        if caption is not None or i not in captions:
+            captions[i] = caption
+    if not captions:
+        return 0
+
+    # Write the records in dataset order, like an online pass
+    indices = sorted(captions)
+    segment_file = caption_log.segment_path(output_path, caption_log.next_segment_index(output_path))
+    labels = dataset.select_columns(['id', 'label']).select(indices)
+    with caption_log.CaptionWriter(segment_file, fsync=fsync) as writer:
+        for i, example in zip(indices, labels):
+            label_str = label_name(dataset.features, example['label'])
+            writer.write({
+                "id": example['id'],
+                "label": label_str,
+                "prompt": get_prompt(category, label_str),
+                "caption": captions[i]
+            })
+            if captions[i] is not None:
+                completed.add(i)
+                failed.discard(i)
+            else:
+                failed.add(i)
+    checkpoint.update_state(output_path, completed, failed)
+    logger.info(f"📥 Ingested {len(indices)} batch results → {segment_file}")
+    return len(indices)
+
+def copy_duplicate_captions(dataset, output_path, category, duplicates, completed, failed, fsync="batch"):
+    """
+    Gives every near-duplicate the caption of its cluster representative,
+    without any API call, once the representative is captioned.
+
+    Args:
+        dataset (Dataset): The dataset being captioned.
+        output_path (str): Path the captions are saved to.
+        category (str): Category of the dataset ("fashion" or "food").
+        duplicates (Dict[int, int]): The representative index of every duplicate.
+        completed (IndexSet): Completed indices, updated in place.
+        failed (IndexSet): Failed indices, updated in place.
+        fsync (str): fsync policy of the caption log.
+
+    Returns:
+        int: The number of copied captions.
+    """
+    pending = {i: rep for i, rep in duplicates.items() if i not in completed and rep in completed}
+    if not pending:
+        return 0
+    ids = dataset['id']
+    rep_ids = {ids[rep] for rep in pending.values()}
+    captions = {
+        record["id"]: record["caption"] for record in caption_log.iter_records(output_path)
+        if record["id"] in rep_ids and record["caption"] is not None
+    }
+
+    # Each duplicate keeps its own id, label and prompt
+    indices = [i for i in sorted(pending) if ids[pending[i]] in captions]
+    segment_file = caption_log.segment_path(output_path, caption_log.next_segment_index(output_path))
+    labels = dataset.select_columns(['id', 'label']).select(indices)
+    with caption_log.CaptionWriter(segment_file, fsync=fsync) as writer:
+        for i, example in zip(indices, labels):
+            label_str = label_name(dataset.features, example['label'])
+            writer.write({
+                "id": example['id'],
+                "label": label_str,
+                "prompt": get_prompt(category, label_str),
+                "caption": captions[ids[pending[i]]]
+            })
+            completed.add(i)
+            failed.discard(i)
+    checkpoint.update_state(output_path, completed, failed)
+    logger.info(f"🔁 Copied {len(indices)} representative captions to their near-duplicates → {segment_file}")
+    return len(indices)
+
+# --------------------------- SHARDED RUNS ---------------------------
+def shard_path(output_path, shard_index, num_shards):
+    """
+    Returns the output path of one shard of a sharded run.
+    """
+    return f"{output_path}.shard{shard_index:03d}-of-{num_shards:03d}"
+
+def shard_status_path(path):
+    """
+    Returns the status file of a shard, written when its run finishes.
+    """
+    return f"{path}.status.json"
+
+def load_shard_status(path):
+    """
+    Loads the status of a shard (its sample, missing and failed counts), or
+    None if no run of the shard has finished.
+    """
+    status_file = shard_status_path(path)
+    if not os.path.exists(status_file):
+        return None
+    with open(status_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_shard_status(path, samples, missing, failed):
+    """
+    Saves the status of a shard at the end of its run.
+    """
+    status_file = shard_status_path(path)
+    with open(f"{status_file}.tmp", 'w', encoding='utf-8') as f:
+        json.dump({"samples": samples, "missing": missing, "failed": failed}, f)
+    os.replace(f"{status_file}.tmp", status_file)
+
+def combine_shards(output_path, num_shards, delete_parts=True, save_csv=False, save_summary=True, output_format="json"):
+    """
+    Combines the caption logs of every shard into the final JSON file.
+
+    The merge is id-ordered, so the result is the same as a single-process
+    run over the whole dataset, whatever the number of shards.
+
+    A shard is incomplete until a run of it finished with no caption missing
+    from its index range. Incomplete shards are reported, and while any
+    remains, every shard log and checkpoint is kept (whatever `delete_parts`)
+    so that the missing captions can be generated and combined later.
+
+    Args:
+        output_path (str): The output path given to every shard.
+        num_shards (int): The number of shards of the run.
+        delete_parts (bool): Whether to delete the shard logs and checkpoints
+            once every shard is complete.
+        save_csv (bool): Whether to also write a CSV version.
+        save_summary (bool): Whether to also write a label summary.
+        output_format (str): Format of the merged file ("json", "parquet" or "arrow").
+
+    Returns:
+        List[int]: The indices of the incomplete shards.
+    """
+    shard_paths = [shard_path(output_path, k, num_shards) for k in range(num_shards)]
+    statuses = [load_shard_status(path) for path in shard_paths]
+    incomplete = [k for k, status in enumerate(statuses) if status is None or status["missing"]]
+    missing = sum(status["missing"] for status in statuses if status is not None)
+    failed = sum(status["failed"] for status in statuses if status is not None)
+    not_run = [k for k in incomplete if statuses[k] is None]
+    if incomplete:
+        logger.warning(
+            f"⚠️ {len(incomplete)}/{num_shards} shards are incomplete: {incomplete}. "
+            f"{len(not_run)} never finished a run{f' ({not_run})' if not_run else ''}, and the others "
+            f"still miss {missing} captions ({failed} failed). Shard logs and checkpoints are kept; "
+            f"re-run the incomplete shards, then combine again."
+        )
+
+    part_files = [part for path in shard_paths for part in caption_log.list_segments(path)]
+    logger.info(f"🧩 Combining {len(part_files)} caption logs from {num_shards} shards.")
+    delete_parts = delete_parts and not incomplete
+    merge_caption_parts(
+        base_path=output_path,
+        output_file=caption_file_path(output_path, output_format),
+        delete_parts=delete_parts,
+        save_csv=save_csv,
+        save_summary=save_summary,
+        part_files=part_files
+    )
+
+    if delete_parts:
+        for path in shard_paths:
+            for file in (checkpoint.get_path(path), f"{checkpoint.get_path(path)}.lock", shard_status_path(path)):
+                if os.path.exists(file):
+                    os.remove(file)
+        logger.info("🧹 Shard checkpoints deleted.")
+    return incomplete
+
 # --------------------------- MAIN GENERATION FUNCTION ---------------------------
-def generate_captions(dataset_path, output_path, category="fashion", max_samples=None, save_every=500):
+def generate_captions(
+    dataset_path,
+    output_path,
+    category="fashion",
+    max_samples=None,
+    save_every=500,
+    concurrency=1,
+    detail="auto",
+    max_image_bytes=None,
+    payload_cache_dir=None,
+    cache_path=DEFAULT_CACHE_PATH,
+    cache_max_bytes=None,
+    fsync="batch",
+    max_retries=3,
+    retry_base_delay=2.0,
+    retry_max_delay=60.0,
+    mode="online",
+    batch_dir=None,
+    batch_deployment=None,
+    batch_submit=True,
+    batch_force=False,
+    batch_max_requests=batch.BATCH_MAX_REQUESTS,
+    batch_max_bytes=batch.BATCH_MAX_BYTES,
+    shard_index=0,
+    num_shards=1,
+    skip_duplicates=True,
+    dedup_threshold=None,
+    trace_path=None,
+    prometheus_path=None,
+    deployments_config=None,
+    encode_workers=None,
+    prefetch=None,
+    pack_size=1,
+    output_format="json",
+    backend="azure",
+    backend_options=None
+):
     """
     Generates image captions using GPT-4o for a HuggingFace dataset.
     The dataset should contain images and labels.
@@ -145,95 +960,315 @@ def generate_captions(dataset_path, output_path, category="fashion", max_samples
         output_path (str): Path to save the generated captions.
         category (str): Category of the dataset ("fashion" or "food").
         max_samples (int): Maximum number of samples to process.
+        save_every (int): Number of captions between checkpoints.
+        concurrency (int): Maximum number of API calls in flight at once.
+            Defaults to 1 (sequential).
+        detail (str): The `detail` level images are sent with ("low", "high"
+            or "auto"); images are resized to match it before upload.
+        max_image_bytes (int): Size budget for each encoded image.
+        payload_cache_dir (str): Directory caching encoded images by content.
+        cache_path (str): SQLite caption cache consulted before every API call,
+            keyed by image content and request settings. None disables it.
+        cache_max_bytes (int): Size budget of the caption cache.
+        fsync (str): fsync policy of the caption log ("always", "batch" or "never").
+            Every caption is flushed as soon as it is written.
+        max_retries (int): Number of retry rounds for failed captions.
+        retry_base_delay (float): Delay before the first retry round, in seconds.
+            It doubles on every round, with jitter.
+        retry_max_delay (float): Maximum delay between retry rounds, in seconds.
+        mode (str): "online" calls the chat endpoint for every image. "batch"
+            writes Batch API request files for the missing ids (and submits them
+            if `batch_submit`). "ingest" downloads finished batch results and
+            ingests every result file into the captions and checkpoint.
+        batch_dir (str): Directory of the batch request and result files.
+            Defaults to `{output_path}.batch`.
+        batch_deployment (str): The batch deployment the requests target.
+            Defaults to the AZURE_OPENAI_DEPLOYMENT environment variable.
+        batch_submit (bool): Whether "batch" mode uploads and submits the files.
+        batch_force (bool): Whether "batch" mode requests ids again even though
+            an earlier request file holds them and its results were not
+            ingested yet. By default, those ids are left out.
+        batch_max_requests (int): Maximum number of requests per batch file.
+        batch_max_bytes (int): Maximum size of each batch file, in bytes.
+        shard_index (int): Index of the shard captioned by this process.
+        num_shards (int): Number of shards. With more than one shard, this
+            process only captions the examples whose index is `shard_index`
+            modulo `num_shards`, with its own caption log and checkpoint under
+            `shard_path(output_path, ...)`. Run `combine_shards` once every
+            shard has finished.
+        skip_duplicates (bool): Whether to caption only one image per
+            near-duplicate cluster. Clusters come from the dataset's
+            'duplicate_of' field (see build_full_dataset.py), or are computed
+            here when `dedup_threshold` is set. Each duplicate gets the caption
+            of its representative, so the output still has every example.
+            Images whose label differs from their representative's are
+            captioned on their own, since the caption follows the label's prompt.
+        dedup_threshold (int): Maximum Hamming distance between perceptual hashes
+            of duplicates, used when the dataset has no 'duplicate_of' field.
+        trace_path (str): JSONL file receiving one metrics event per request
+            (latency, time to first byte, payload bytes, token usage, retries,
+            error class).
+        prometheus_path (str): Prometheus textfile with the aggregated request
+            metrics and the decode/encode/network/write stage timings, rewritten
+            as the run progresses.
+        deployments_config (str): JSON file of the deployment pool online
+            requests are routed across, with failover (see utils/deployments.py).
+            Defaults to the AZURE_OPENAI_DEPLOYMENTS environment variable;
+            without it, every request goes to the default deployment.
+        encode_workers (int): Number of processes decoding, resizing and
+            base64-encoding images ahead of the API calls, so that image work
+            overlaps with network waits. Defaults to the CPU count; 0 encodes
+            each image in its request thread.
+        prefetch (int): Examples read ahead of the API calls. Defaults to
+            `2 * max(concurrency, encode_workers)`.
+        pack_size (int): Maximum number of images sharing a label captioned by
+            one request, with a JSON-schema answer mapping each id to its
+            caption. Ids missing from the answer are captioned one by one.
+            Packing sends the instructions once per request, cutting the
+            request count and prompt tokens. Defaults to 1 (one image per request).
+        output_format (str): Format of the merged caption file: "json", or
+            "parquet"/"arrow" for a compact table with dictionary-encoded label
+            and prompt columns, which `prepare_hf_dataset` reads memory-mapped.
+        backend (str or CaptionBackend): What captions the images: "azure"
+            (GPT-4o, with every option above), or a batched backend of
+            utils/backends.py, e.g., "local" to pre-caption bulk data offline
+            on local cores and keep the API quota for the hard cases, or
+            "fake" for tests and benchmarks. Only "online" mode applies to
+            the other backends, without the caption cache.
+        backend_options (dict): Keyword arguments of the backend (e.g.,
+            `model_dir`, `runtime`, `threads` and `batch_size` for "local").
 
     Returns:
         None
     """
+    if mode not in ("online", "batch", "ingest"):
+        raise ValueError(f"Unknown mode '{mode}'. Must be 'online', 'batch' or 'ingest'.")
+    if backend != "azure" and mode != "online":
+        raise ValueError(f"Mode '{mode}' needs the 'azure' backend.")
+    if output_format not in CAPTION_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}'. Must be one of {list(CAPTION_FORMATS)}.")
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Shard index {shard_index} is out of range for {num_shards} shards.")
+    if num_shards > 1:
+        output_path = shard_path(output_path, shard_index, num_shards)
+        # The shard is incomplete until this run finishes
+        if os.path.exists(shard_status_path(output_path)):
+            os.remove(shard_status_path(output_path))
+    if batch_dir is None:
+        batch_dir = f"{output_path}.batch"
+    if batch_deployment is None:
+        batch_deployment = get_deployment()
+
     logger.info(f"📦 Loading dataset from: {dataset_path}")
     dataset = load_from_disk(dataset_path)
     logger.info(f"✅ Dataset loaded successfully.")
 
     if max_samples is not None:
         dataset = dataset.select(range(min(max_samples, len(dataset))))
-    logger.info(f"🎯 Processing {len(dataset)} samples in '{category}' category.")
+    shard = range(shard_index, len(dataset), num_shards)
+    duplicates = {}
+    if skip_duplicates:
+        representatives = None
+        if "duplicate_of" in dataset.column_names:
+            index_of = {id: i for i, id in enumerate(dataset['id'])}
+            # Representatives left out by max_samples stand for themselves
+            representatives = [index_of.get(rep, i) for i, rep in enumerate(dataset['duplicate_of'])]
+        elif dedup_threshold is not None:
+            logger.info("🔍 Hashing images to find near-duplicates...")
+            representatives = dedup_dataset(dataset, threshold=dedup_threshold)
+        if representatives is not None:
+            # Captions follow the label's prompt: clusters never span labels
+            labels = dataset['label']
+            duplicates = {
+                i: int(rep) for i, rep in enumerate(representatives)
+                if i != rep and labels[i] == labels[int(rep)]
+            }
+        if duplicates:
+            logger.info(f"🔁 {len(duplicates)} near-duplicate images will reuse the caption of their cluster representative.")
+            # A cluster belongs to the shard of its representative
+            shard = [i for i in range(len(dataset)) if duplicates.get(i, i) % num_shards == shard_index]
+    if num_shards > 1:
+        logger.info(f"🎯 Processing shard {shard_index + 1}/{num_shards}: {len(shard)} of {len(dataset)} samples in '{category}' category.")
+    else:
+        logger.info(f"🎯 Processing {len(dataset)} samples in '{category}' category.")
     
-    start_index = checkpoint.load(output_path)
-    if start_index > 0:
-        logger.warning(f"⏩ Checkpoint detected! Resuming from index {start_index}")
-        dataset = dataset.select(range(start_index, len(dataset)))
+    completed, failed = load_progress(output_path, dataset)
+    todo = [i for i in shard if i not in completed and i not in duplicates]
+    if len(completed) > 0:
+        logger.warning(
+            f"⏩ Checkpoint detected! {len(completed)} captions done, "
+            f"{len(todo)} remaining (including {len(failed)} failed)."
+        )
     else:
         logger.info("🚀 Starting from the beginning.")
+    captioner = None
+    if backend != "azure":
+        from utils.backends import load_backend
+
+        captioner = backend if not isinstance(backend, str) else load_backend(backend, **(backend_options or {}))
+        logger.info(f"🧠 Captioning with the {captioner.name} backend, {captioner.batch_size} images per batch.")
+    elif concurrency > 1:
+        logger.info(f"⚡ Running with {concurrency} concurrent requests.")
+    if pack_size > 1 and captioner is None:
+        logger.info(f"📦 Packing up to {pack_size} images per request.")
         
-    results = []
-    part_index = start_index // save_every
-    prompt_base = None
+    # One pooled client for the whole run, with a connection per concurrent request
+    client = None
+    if captioner is None:
+        client = get_client(
+            max_connections=max(concurrency, 20),
+            api_version=STRUCTURED_API_VERSION if pack_size > 1 else API_VERSION
+        )
+    # The Files and Batches APIs need a later API version than chat requests
+    batch_client = get_client(api_version=batch.BATCH_API_VERSION) if mode != "online" else None
 
-    for i, example in enumerate(tqdm(dataset, desc=f"{category.title()} Captions", initial=start_index), start=start_index):
-        id = example['id']
-        image = example['image']
-        label = example['label']
-        label_str = str(label) if isinstance(label, str) else dataset.features['label'].int2str(label)
-        prompt = get_prompt(category, label_str)
+    if mode == "batch":
+        pending = batch.pending_ids(batch_dir)
+        if pending and not batch_force:
+            ids = dataset['id']
+            requested = [i for i in todo if ids[i] in pending]
+            if requested:
+                logger.warning(
+                    f"⏳ {len(requested)} ids already have batch requests awaiting ingestion in {batch_dir}; "
+                    f"skipping them (use batch_force=True to request them again)."
+                )
+                requested = set(requested)
+                todo = [i for i in todo if i not in requested]
+        files = batch.write_batch_requests(
+            iter_batch_requests(
+                dataset, todo, category, batch_deployment,
+                detail=detail, max_image_bytes=max_image_bytes, payload_cache_dir=payload_cache_dir
+            ),
+            batch_dir,
+            max_requests=batch_max_requests,
+            max_bytes=batch_max_bytes
+        )
+        logger.success(f"📤 Wrote {len(todo)} batch requests to {len(files)} files → {batch_dir}")
+        if batch_submit:
+            batch_ids = batch.submit_batches(batch_client, batch_dir)
+            logger.info(f"🚚 Submitted {len(batch_ids)} batches. Run again with mode='ingest' once they finish.")
+        return
 
-        if prompt_base is None:
-            prompt_base = prompt
+    pool = None
+    if captioner is None:
+        # Imports openai: only the API backend needs it
+        from utils.deployments import load_pool
 
-        try:
-            caption = describe_image(prompt, image=image, label=label_str, show_image=False)
-            results.append({
-                "id": id,
-                "label": label_str,
-                "prompt": prompt,
-                "caption": caption
-            })
-        except Exception as e:
-            logger.error(f"❌ Failed to generate caption for image ID={id}: {e}")
-            results.append({
-                "id": id,
-                "label": label_str,
-                "prompt": prompt,
-                "caption": None
-            })
+        pool = load_pool(
+            deployments_config,
+            max_connections=max(concurrency, 20),
+            api_version=STRUCTURED_API_VERSION if pack_size > 1 else API_VERSION
+        )
+    if pool is not None:
+        logger.info(f"🌍 Routing requests across {len(pool.deployments)} deployments: {', '.join(d.name for d in pool.deployments)}.")
+    cache = CaptionCache(cache_path, max_bytes=cache_max_bytes) if cache_path is not None and captioner is None else None
+    metrics = None
+    if trace_path is not None or prometheus_path is not None:
+        metrics = Metrics(
+            trace_path=trace_path,
+            prometheus_path=prometheus_path,
+            labels={"category": category, "shard": str(shard_index)}
+        )
+    caption_kwargs = dict(
+        concurrency=concurrency,
+        encode_workers=encode_workers,
+        prefetch=prefetch,
+        pack_size=pack_size,
+        client=client,
+        detail=detail,
+        max_image_bytes=max_image_bytes,
+        payload_cache_dir=payload_cache_dir,
+        cache=cache,
+        metrics=metrics,
+        pool=pool,
+        backend=captioner
+    )
+
+    try:
+        retry_queue = []
+        if mode == "ingest":
+            if os.path.exists(os.path.join(batch_dir, "batches.json")):
+                batch.download_batch_results(batch_client, batch_dir)
+            result_files = batch.list_result_files(batch_dir)
+            ingest_batch_results(dataset, output_path, category, batch_dir, completed, failed, fsync=fsync)
+            if result_files:
+                batch.mark_ingested(batch_dir, result_files)
+        elif todo:
+            retry_queue = caption_pass(
+                dataset, todo, output_path, category, completed, failed,
+                save_every=save_every, fsync=fsync, desc=f"{category.title()} Captions", **caption_kwargs
+            )
+
+        # Retry the failed captions only, with exponential backoff between rounds
+        for attempt in range(1, max_retries + 1):
+            if not retry_queue:
+                break
+            delay = min(retry_max_delay, retry_base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            logger.warning(f"🔁 Retrying {len(retry_queue)} failed captions in {delay:.1f}s (attempt {attempt}/{max_retries}).")
+            time.sleep(delay)
+            retry_queue = caption_pass(
+                dataset, retry_queue, output_path, category, completed, failed,
+                save_every=save_every, fsync=fsync, desc=f"Retry {attempt}", **caption_kwargs
+            )
+    finally:
+        # A backend built here (e.g., a local model and its threads) is released even on errors
+        if captioner is not None and isinstance(backend, str):
+            captioner.close()
 
-        if (i + 1) % save_every == 0:
-            save_partial(output_path, part_index, prompt_base, results)
-            checkpoint.save(output_path, i + 1)
-            logger.info(f"📝 Saved {len(results)} captions to part {part_index} and checkpoint updated.")
-            part_index += 1
-            results = []
+    if duplicates:
+        copy_duplicate_captions(dataset, output_path, category, duplicates, completed, failed, fsync=fsync)
 
-    # Save remaining
-    if results:
-        save_partial(output_path, part_index, prompt_base, results)
-        checkpoint.save(output_path, start_index + len(dataset))
+    if cache is not None:
+        stats = cache.stats()
+        logger.info(
+            f"🗃️ Caption cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"({stats['hit_rate']:.0%}), {stats['entries']} entries."
+        )
+        cache.close()
+
+    if metrics is not None:
+        metrics.close()
+        summary = metrics.snapshot()
+        stages = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in summary["stage_seconds"].items())
+        p95 = f"{summary['p95_latency']:.2f}s" if summary["p95_latency"] is not None else "n/a"
+        logger.info(
+            f"📈 Metrics: {sum(summary['requests'].values())} requests, {summary['retries']} retries, "
+            f"p95 latency {p95}, {summary['payload_bytes'] / 1e6:.1f} MB uploaded; stages: {stages}."
+        )
+
+    if pool is not None:
+        for status in pool.status():
+            latency = f"{status['latency']:.2f}s" if status['latency'] is not None else "n/a"
+            logger.info(f"🌍 Deployment {status['name']}: {status['state']}, {status['error_rate']:.0%} errors, {latency} latency.")
 
-    # Merge parts
+    missing = sum(1 for i in shard if i not in completed)
+    if num_shards > 1:
+        save_shard_status(output_path, len(shard), missing, len(failed))
+        logger.success(f"✅ Shard {shard_index + 1}/{num_shards} finished with {missing} captions missing → {output_path}")
+        return
+
+    # Merge parts, keeping them and the checkpoint if captions are still missing
     merge_caption_parts(
         base_path=output_path,
-        output_file=output_path + ".json"
+        output_file=caption_file_path(output_path, output_format),
+        delete_parts=missing == 0
     )
+    if missing:
+        logger.warning(f"⚠️ {missing} captions still missing ({len(failed)} failed). Re-run to caption only those.")
+        return
     
     # Clean up
     checkpoint_file = checkpoint.get_path(output_path)
     if os.path.exists(checkpoint_file):
         os.remove(checkpoint_file)
         logger.info("🧹 Checkpoint file deleted after successful completion.")
+    lock_file = f"{checkpoint_file}.lock"
+    if os.path.exists(lock_file):
+        os.remove(lock_file)
     
 # --------------------------- RUN ---------------------------
 if __name__ == "__main__":
+    # Same options as `python -m scripts.cli caption`, paths from configs/pipeline.yaml
+    from scripts.cli import main
 
-    # Fashion dataset
-    generate_captions(
-        dataset_path="data/processed/african-fashion",
-        output_path="data/captions/african-fashion-full",
-        category="fashion",
-        max_samples=None
-    )
-
-    # Food dataset
-    generate_captions(
-        dataset_path="data/processed/african-food",
-        output_path="data/captions/african-food-full",
-        category="food",
-        max_samples=None
-    )
\ No newline at end of file
+    main(["caption", *sys.argv[1:]])
@@ -12,12 +12,16 @@ The final dataset's features are:
 
 from datasets import load_from_disk, Dataset, Features, Value, ClassLabel, Image as HfImage
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from PIL import Image
 import os
 import json
-from typing import List, Dict
+from typing import List, Dict, Tuple
 from tqdm import tqdm
 
+from utils.caption_table import read_caption_table, table_format
+
 def load_caption_file(caption_file: str) -> Dict[str, List[Dict]]:
     """
     Load the caption file and return the prompt and captions.
@@ -32,18 +36,134 @@ def load_caption_file(caption_file: str) -> Dict[str, List[Dict]]:
         data = json.load(f)
     return data
 
+def _has_caption(ids: List[str], captions_index: Dict[str, Tuple[str, str]]) -> List[bool]:
+    """
+    Batched filter keeping the examples that have a caption record.
+    """
+    return [id in captions_index for id in ids]
+
+def _join_captions(ids: List[str], captions_index: Dict[str, Tuple[str, str]]) -> Dict[str, List]:
+    """
+    Batched map adding the prompt and caption of each example.
+    """
+    return {
+        "prompt": [captions_index[id][0] for id in ids],
+        "caption": [captions_index[id][1] for id in ids]
+    }
+
+def join_caption_table(dataset: Dataset, captions: pa.Table) -> Dataset:
+    """
+    Joins a caption table to a dataset on `id`, in Arrow.
+
+    The caption and prompt columns are gathered with a single `take` and
+    added next to the image column, which is never read, decoded or copied;
+    the examples without a caption record are then left out through an
+    indices mapping, so images are only copied once, when the result is saved.
+
+    Args:
+        dataset (Dataset): Dataset with `id` and `image` columns.
+        captions (pa.Table): Caption table with `id`, `prompt` and `caption` columns.
+
+    Returns:
+        Dataset: The dataset with `image`, `prompt` and `caption` columns.
+    """
+    ids = dataset.with_format("arrow")['id']
+    positions = pc.index_in(ids, value_set=captions.column('id').combine_chunks())
+    columns = {
+        name: pc.take(captions.column(name), positions).cast(pa.string()).combine_chunks()
+        for name in ("prompt", "caption")
+    }
+
+    hf_dataset = dataset.select_columns(["image"])
+    for name, column in columns.items():
+        hf_dataset = hf_dataset.add_column(name, column, feature=Value(dtype="string"))
+    keep = pc.is_valid(positions)
+    if not pc.all(keep).as_py():
+        # Python ints: `select` fails on NumPy ones when the rows are contiguous
+        hf_dataset = hf_dataset.select(pc.indices_nonzero(keep).to_pylist())
+    return hf_dataset
+
+def join_caption_file(dataset: Dataset, caption_file: str, num_proc: int = None, batch_size: int = 1000) -> Dataset:
+    """
+    Joins a JSON caption file to a dataset on `id`, through a hash index, in batched Arrow maps.
+
+    Args:
+        dataset (Dataset): Dataset with `id` and `image` columns.
+        caption_file (str): Path to the JSON caption file.
+        num_proc (int, optional): Number of worker processes.
+        batch_size (int): Number of examples per batch.
+
+    Returns:
+        Dataset: The dataset with `image`, `prompt` and `caption` columns.
+    """
+    # Load the caption file
+    print(f"[INFO] 📜 Loading captions from: {caption_file}")
+    captions_data = load_caption_file(caption_file)
+    prompt = captions_data['prompt']
+
+    # Index the prompt and caption of each record by id; prompts are per label,
+    # the top-level one only stands in for records written without their own
+    captions_index = {
+        item['id']: (item.get('prompt', prompt), item['caption'])
+        for item in captions_data['captions']
+    }
+    
+    # Prepare the features, with images kept as encoded bytes during the join
+    features = Features({
+        "image": HfImage(decode=False),
+        "prompt": Value(dtype="string"),
+        "caption": Value(dtype="string")
+    })
+    dataset = dataset.cast_column("image", HfImage(decode=False))
+
+    # Keep the examples with a caption, then join their prompt and caption
+    dataset = dataset.filter(
+        _has_caption,
+        input_columns="id",
+        batched=True,
+        batch_size=batch_size,
+        fn_kwargs={"captions_index": captions_index},
+        num_proc=num_proc,
+        desc="🔎 Matching captions"
+    )
+    hf_dataset = dataset.map(
+        _join_captions,
+        input_columns="id",
+        batched=True,
+        batch_size=batch_size,
+        fn_kwargs={"captions_index": captions_index},
+        remove_columns=[column for column in dataset.column_names if column != "image"],
+        features=features,
+        num_proc=num_proc,
+        desc="🛠️ Preparing dataset"
+    )
+    hf_dataset = hf_dataset.cast_column("image", HfImage())
+    return hf_dataset
+
 def prepare_hf_dataset(
     dataset_path: str,
     caption_file: str,
-    output_path: str
+    output_path: str,
+    num_proc: int = None,
+    batch_size: int = 1000,
+    max_shard_size: str = "500MB"
 ) -> Dataset:
     """
     Prepare the Hugging Face dataset by loading images and captions.
+
+    Captions are joined on `id` through a hash index, in batched Arrow maps.
+    Images are kept as their encoded bytes and never decoded, so memory use
+    does not grow with the dataset size. A ".parquet" or ".arrow" caption file
+    (see `generate_captions(output_format=...)`) is read memory-mapped and
+    joined in Arrow instead (see `join_caption_table`).
     
     Args:
         dataset_path (str): Path to the dataset.
         caption_file (str): Path to the caption file.
         output_path (str): Path to save the prepared dataset.
+        num_proc (int, optional): Number of worker processes for the join and the save.
+        batch_size (int): Number of examples per batch.
+        max_shard_size (str): Maximum size of each saved shard.
         
     Returns:
         Dataset: Prepared Hugging Face dataset.
@@ -51,62 +171,26 @@ def prepare_hf_dataset(
     # Load the dataset
     print(f"[INFO] 📦 Loading dataset from: {dataset_path}")
     dataset = load_from_disk(dataset_path)
-    
-    # Load the caption file
-    print(f"[INFO] 📜 Loading captions from: {caption_file}")
-    captions_data = load_caption_file(caption_file)
-    
-    # Prepare the features
-    features = Features({
-        "image": HfImage(),
-        "prompt": Value(dtype="string"),
-        "caption": Value(dtype="string")
-    })
-    
-    # Create a new dataset with images, prompts and captions
-    new_dataset = []
-    
-    for example in tqdm(dataset, desc="🛠️ Preparing dataset"):
-        id = example['id']
-        image = example['image']
-        label = example['label']
-        
-        # Get the corresponding caption and prompt
-        caption_info = next((item for item in captions_data['captions'] if item['id'] == id), None)
-        
-        if caption_info:
-            prompt = captions_data['prompt']
-            caption = caption_info['caption']
-            
-            new_dataset.append({
-                "image": image,
-                "prompt": prompt,
-                "caption": caption
-            })
-    
-    # Convert to Hugging Face Dataset
-    hf_dataset = Dataset.from_list(new_dataset, features=features)
+
+    if table_format(caption_file):
+        # Columnar caption file: memory-mapped and joined in Arrow
+        print(f"[INFO] 📜 Mapping captions from: {caption_file}")
+        captions = read_caption_table(caption_file, columns=["id", "prompt", "caption"])
+        hf_dataset = join_caption_table(dataset, captions)
+    else:
+        hf_dataset = join_caption_file(dataset, caption_file, num_proc=num_proc, batch_size=batch_size)
     
     # Save the prepared dataset
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    hf_dataset.save_to_disk(output_path)
+    hf_dataset.save_to_disk(output_path, max_shard_size=max_shard_size, num_proc=num_proc)
     
     print(f"[INFO] 💾 Prepared dataset saved to: {output_path}")
     
     return hf_dataset
 
 if __name__ == '__main__':
-    
-    # For fashion dataset
-    prepare_hf_dataset(
-        dataset_path="data/processed/african-fashion",
-        caption_file="data/captions/african-fashion-04.json",
-        output_path="data/processed/african-fashion-hf"
-    )
+    # Dataset and caption paths come from the `prepare` section of configs/pipeline.yaml
+    from scripts.cli import main
+    import sys
 
-    # For food dataset
-    prepare_hf_dataset(
-        dataset_path="data/processed/african-food",
-        caption_file="data/captions/african-food-04.json",
-        output_path="data/processed/african-food-hf"
-    )
+    main(["prepare", *sys.argv[1:]])
@@ -0,0 +1,91 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+from datasets import load_from_disk
+
+from benchmarks.synthetic import make_image_dataset
+from scripts.generate_caption import generate_captions, iter_captions_backend
+from utils import backends
+from utils.backends import CaptionBackend, FakeBackend, LocalBackend, load_backend
+
+
+@pytest.fixture(scope="module")
+def dataset_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("data") / "dataset")
+    make_image_dataset(path, num_images=5, size=(16, 16))
+    return path
+
+
+class PromptlessBackend(FakeBackend):
+    name = "promptless"
+
+    def stored_prompt(self, prompt):
+        return ""
+
+
+class InterruptedBackend(FakeBackend):
+    name = "interrupted"
+    closed = False
+
+    def caption_batch(self, images, prompts, labels=None):
+        raise KeyboardInterrupt
+
+    def close(self):
+        InterruptedBackend.closed = True
+
+
+def test_backends_must_implement_caption_batch():
+    with pytest.raises(TypeError):
+        CaptionBackend()
+
+    class Incomplete(CaptionBackend):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_fake_backend_is_deterministic(dataset_path):
+    dataset = load_from_disk(dataset_path)
+    first = list(iter_captions_backend(dataset, "fashion", FakeBackend(batch_size=2)))
+    second = list(iter_captions_backend(dataset, "fashion", FakeBackend(batch_size=3)))
+    assert first == second
+    assert [r["id"] for r in first] == [f"img_{i:05d}" for i in range(5)]
+    assert all(r["caption"].startswith(f"A photo of {r['label']}") for r in first)
+    assert all(r["prompt"] for r in first)
+
+
+def test_ignored_prompts_are_not_stored(dataset_path):
+    records = list(iter_captions_backend(load_from_disk(dataset_path), "fashion", PromptlessBackend()))
+    assert all(r["prompt"] == "" and r["caption"] for r in records)
+
+    # Without loading a model: only `use_prompts` matters
+    local = LocalBackend.__new__(LocalBackend)
+    local.use_prompts = False
+    assert local.stored_prompt("Describe this image.") == ""
+    local.use_prompts = True
+    assert local.stored_prompt("Describe this image.") == "Describe this image."
+
+
+def test_backend_is_closed_when_the_run_fails(dataset_path, tmp_path, monkeypatch):
+    monkeypatch.setitem(backends.BACKENDS, "interrupted", InterruptedBackend)
+    assert isinstance(load_backend("interrupted"), InterruptedBackend)
+    with pytest.raises(KeyboardInterrupt):
+        generate_captions(dataset_path, str(tmp_path / "captions"), backend="interrupted", skip_duplicates=False)
+    assert InterruptedBackend.closed
+
+
+def test_local_backends_do_not_import_openai(dataset_path, tmp_path):
+    # A fresh interpreter: the test session has imported openai already
+    code = (
+        "import json, sys\n"
+        "from scripts.generate_caption import generate_captions\n"
+        f"generate_captions({dataset_path!r}, {str(tmp_path / 'captions')!r}, backend='fake', cache_path=None)\n"
+        "print(json.dumps([m for m in ('openai', 'utils.deployments') if m in sys.modules]))\n"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+    assert json.loads(result.stdout.splitlines()[-1]) == []
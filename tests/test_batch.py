@@ -0,0 +1,91 @@
+import json
+import os
+
+import pytest
+
+from benchmarks.mock_server import MockOpenAIServer
+from benchmarks.synthetic import make_image_dataset
+from scripts.generate_caption import generate_captions
+from utils import batch
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with MockOpenAIServer() as srv:
+        monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", srv.url)
+        monkeypatch.setenv("AZURE_OPENAI_KEY", "k")
+        monkeypatch.setenv("AZURE_OPENAI_DEPLOYMENT", "gpt-4o")
+        yield srv
+
+
+@pytest.fixture
+def dataset_path(tmp_path):
+    path = str(tmp_path / "dataset")
+    make_image_dataset(path, num_images=10, size=(32, 32))
+    return path
+
+
+def run(dataset_path, output_path, mode, **kwargs):
+    generate_captions(
+        dataset_path, output_path, mode=mode, cache_path=None,
+        encode_workers=0, max_retries=0, skip_duplicates=False, **kwargs
+    )
+
+
+def test_write_records_custom_ids(tmp_path):
+    requests = [batch.batch_request(f"img_{i}", [], "m", 10) for i in range(5)]
+    paths = batch.write_batch_requests(requests, str(tmp_path), max_requests=2)
+    assert len(paths) == 3
+    assert batch.pending_ids(str(tmp_path)) == {f"img_{i}" for i in range(5)}
+
+    batch.mark_ingested(str(tmp_path), [batch.result_path(str(tmp_path), 0)])
+    assert batch.pending_ids(str(tmp_path)) == {"img_2", "img_3", "img_4"}
+
+
+def test_write_submit_ingest(server, dataset_path, tmp_path):
+    output_path = str(tmp_path / "captions")
+    batch_dir = f"{output_path}.batch"
+
+    run(dataset_path, output_path, "batch")
+    assert len(batch.list_request_files(batch_dir)) == 1
+    with open(os.path.join(batch_dir, "batches.json")) as f:
+        assert json.load(f)["requests-00000.jsonl"]["batch_id"]
+
+    # Pending ids are neither written nor submitted again
+    run(dataset_path, output_path, "batch")
+    assert len(batch.list_request_files(batch_dir)) == 1
+
+    run(dataset_path, output_path, "ingest")
+    with open(f"{output_path}.json") as f:
+        captions = json.load(f)["captions"]
+    assert len(captions) == 10
+    assert all(c["caption"].startswith("Mock caption") for c in captions)
+    assert batch.pending_ids(batch_dir) == set()
+
+
+def test_batch_force_requests_pending_ids_again(server, dataset_path, tmp_path):
+    output_path = str(tmp_path / "captions")
+    batch_dir = f"{output_path}.batch"
+    run(dataset_path, output_path, "batch", batch_submit=False)
+    run(dataset_path, output_path, "batch", batch_submit=False, batch_force=True)
+    assert len(batch.list_request_files(batch_dir)) == 2
+
+
+def test_batch_calls_use_the_batch_api_version(server, dataset_path, tmp_path, monkeypatch):
+    versions = []
+    for name in ("submit_batches", "download_batch_results"):
+        original = getattr(batch, name)
+
+        def spy(client, batch_dir, original=original, name=name, **kwargs):
+            versions.append((name, client._api_version))
+            return original(client, batch_dir, **kwargs)
+
+        monkeypatch.setattr(batch, name, spy)
+
+    output_path = str(tmp_path / "captions")
+    run(dataset_path, output_path, "batch")
+    run(dataset_path, output_path, "ingest")
+    assert versions == [
+        ("submit_batches", batch.BATCH_API_VERSION),
+        ("download_batch_results", batch.BATCH_API_VERSION)
+    ]
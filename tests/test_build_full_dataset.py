@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+from datasets import ClassLabel, Dataset, DatasetDict, Features, Value, load_from_disk
+from datasets import Image as HfImage
+
+from benchmarks.synthetic import label_names, make_image
+from data import build_full_dataset
+from data.build_full_dataset import (
+    allocate_ids, convert_class_labels_to_strings, fingerprint_source, merge_sources, save_merged_datasets
+)
+
+
+def labeled(labels, names=("a", "b", "c")):
+    return Dataset.from_dict(
+        {"row": list(range(len(labels))), "label": labels},
+        features=Features({"row": Value("int64"), "label": ClassLabel(names=list(names))})
+    )
+
+
+def test_missing_labels_become_none():
+    converted = convert_class_labels_to_strings(labeled([0, -1, 2, -1]))
+    assert converted["label"] == ["a", None, "c", None]
+    assert converted.features["label"] == Value("string")
+
+
+@pytest.mark.parametrize("reorder", [
+    lambda dataset: dataset.select([4, 0, 3]),
+    lambda dataset: dataset.shuffle(seed=0),
+    lambda dataset: dataset.filter(lambda example: example["label"] != 1),
+])
+def test_labels_follow_the_indices_mapping(reorder):
+    dataset = reorder(labeled([0, 1, 2, -1, 1, 0]))
+    expected = [None if label < 0 else dataset.features["label"].int2str(label) for label in dataset["label"]]
+    converted = convert_class_labels_to_strings(dataset)
+    assert converted["label"] == expected
+    assert converted["row"] == dataset["row"]
+
+
+def test_allocate_ids_keeps_ids_of_existing_rows():
+    registry = {"next_id": 0, "sources": {}}
+    assert allocate_ids(registry, "a", 3).tolist() == [0, 1, 2]
+    assert allocate_ids(registry, "b", 2).tolist() == [3, 4]
+    # Rows appended to the first source are numbered after every id in use
+    assert allocate_ids(registry, "a", 5).tolist() == [0, 1, 2, 5, 6]
+    assert allocate_ids(registry, "b", 2).tolist() == [3, 4]
+    # A source that shrank is renumbered
+    assert allocate_ids(registry, "b", 1).tolist() == [7]
+
+
+def save_source(path, num_rows, seed, num_labels=None, split=None):
+    rng = np.random.default_rng(seed)
+    columns = {"image": [{"bytes": make_image(rng, (16, 16)), "path": None} for _ in range(num_rows)]}
+    features = {"image": HfImage()}
+    if num_labels is not None:
+        columns["label"] = [i % num_labels for i in range(num_rows)]
+        features["label"] = ClassLabel(names=label_names(num_labels))
+    dataset = Dataset.from_dict(columns, features=Features(features))
+    (DatasetDict({split: dataset}) if split else dataset).save_to_disk(str(path))
+
+
+@pytest.fixture
+def raw_sources(tmp_path, monkeypatch):
+    # The build reads `data/raw/...` and writes `data/processed` relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    save_source("data/raw/fashion/african-atire", 4, seed=0, num_labels=2, split="train")
+    save_source("data/raw/fashion/african-wax-patterns", 3, seed=1, split="train")
+    save_source("data/raw/food/nigeria-foods", 4, seed=2, num_labels=2)
+    save_source("data/raw/food/ghana-cameroun-foods", 4, seed=3, num_labels=3)
+    return tmp_path
+
+
+def images_by_id(name):
+    dataset = load_from_disk(f"data/processed/{name}").cast_column("image", HfImage(decode=False))
+    return {row["id"]: (row["label"], row["image"]["bytes"]) for row in dataset}
+
+
+def test_unchanged_source_hits_the_cache(raw_sources, capsys):
+    source = build_full_dataset.FOOD_SOURCES[0]
+    fingerprint = fingerprint_source(source["path"])
+    merge_sources([source], cache_dir="cache")
+    capsys.readouterr()
+
+    assert fingerprint_source(source["path"]) == fingerprint
+    merged = merge_sources([source], cache_dir="cache")
+    assert "Reusing cached source 'nigeria-foods'" in capsys.readouterr().out
+    assert merged["id"] == [f"img_{i:05d}" for i in range(4)]
+
+
+def test_incremental_rebuild_keeps_ids_stable(raw_sources, capsys):
+    save_merged_datasets(dedup=False, cache_dir="cache")
+    fashion, food = images_by_id("african-fashion"), images_by_id("african-food")
+    assert list(food) == [f"img_{i:05d}" for i in range(8)]
+    capsys.readouterr()
+
+    # Rows are appended to the first food source
+    save_source("data/raw/food/nigeria-foods", 6, seed=2, num_labels=2)
+    save_merged_datasets(dedup=False, cache_dir="cache")
+    out = capsys.readouterr().out
+    assert "Building source 'nigeria-foods'" in out
+    for name in ("african-atire", "african-wax-patterns", "ghana-cameroun-foods"):
+        assert f"Reusing cached source '{name}'" in out
+
+    assert images_by_id("african-fashion") == fashion
+    rebuilt = images_by_id("african-food")
+    # Existing images keep their ids, the new rows get the next free ones
+    assert list(rebuilt) == [f"img_{i:05d}" for i in range(10)]
+    assert {id: rebuilt[id] for id in food} == food
@@ -0,0 +1,107 @@
+import io
+import sqlite3
+
+import pytest
+from PIL import Image
+
+from benchmarks.mock_server import MockOpenAIServer
+from utils.call_openai_api import (
+    STRUCTURED_API_VERSION, build_image_payload, close_clients, describe_image, describe_images, get_client
+)
+from utils.caption_cache import CaptionCache, make_key
+from utils.deployments import Deployment, DeploymentPool
+
+
+def test_make_key_depends_on_request_only():
+    key = make_key("data:image/jpeg;base64,AAAA", "Describe", "gpt-4o", 300, "2024-05-01-preview", detail="auto")
+    assert key == make_key("data:image/jpeg;base64,AAAA", "Describe", "gpt-4o", 300, "2024-05-01-preview", detail="auto")
+    assert key != make_key("data:image/jpeg;base64,AAAA", "Describe", "gpt-4o", 300, "2024-05-01-preview", detail="low")
+
+
+def test_get_put_and_stats(tmp_path):
+    cache = CaptionCache(str(tmp_path / "cache.sqlite"))
+    assert cache.get("a") is None
+    cache.put("a", "caption a")
+    assert cache.get("a") == "caption a"
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+    assert stats["size_bytes"] == len("caption a")
+    cache.close()
+
+
+def test_running_total_follows_replace_and_eviction(tmp_path):
+    cache = CaptionCache(str(tmp_path / "cache.sqlite"), max_bytes=100)
+    for i in range(10):
+        cache.put(f"k{i}", "x" * 10)
+    assert cache.total_bytes() == 100
+    cache.put("k0", "x" * 20)
+    # Over budget: the least recently used entries go, down to 90% of the budget
+    assert cache.total_bytes() <= 90
+    assert cache.get("k1") is None
+    assert cache.get("k0") == "x" * 20
+    conn = sqlite3.connect(str(tmp_path / "cache.sqlite"))
+    assert cache.total_bytes() == conn.execute("SELECT SUM(size) FROM captions").fetchone()[0]
+    conn.close()
+    cache.close()
+
+
+def test_total_is_seeded_for_existing_caches(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = CaptionCache(path)
+    cache.put("a", "abc")
+    cache._conn.execute("DROP TABLE cache_size")
+    cache.close()
+    cache = CaptionCache(path, max_bytes=1000)
+    assert cache.total_bytes() == 3
+    cache.close()
+
+
+@pytest.fixture
+def server():
+    with MockOpenAIServer() as srv:
+        yield srv
+    close_clients()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = CaptionCache(str(tmp_path / "cache.sqlite"))
+    yield cache
+    cache.close()
+
+
+def payload(color):
+    buffered = io.BytesIO()
+    Image.new("RGB", (16, 16), color=color).save(buffered, format="JPEG")
+    return build_image_payload(image=buffered.getvalue())
+
+
+def test_packed_and_single_answers_are_cached_apart(server, cache):
+    client = get_client(azure_endpoint=server.url, api_key="k", api_version=STRUCTURED_API_VERSION)
+    images = {"a": payload((255, 0, 0)), "b": payload((0, 0, 255))}
+    packed = describe_images("Describe.", images, label="l", client=client, cache=cache, raise_errors=True)
+    assert describe_images("Describe.", images, label="l", client=client, cache=cache, raise_errors=True) == packed
+    assert server.stats()["requests"] == 1
+
+    single = describe_image("Describe.", image_payload=images["a"], label="l", client=client, cache=cache, raise_errors=True)
+    assert server.stats()["requests"] == 2
+    assert single != packed["a"]
+    assert describe_image("Describe.", image_payload=images["a"], label="l", client=client, cache=cache, raise_errors=True) == single
+    assert server.stats()["requests"] == 2
+
+
+def test_pool_keys_use_the_deployment_api_version(server, cache):
+    def pool(api_version):
+        return DeploymentPool([Deployment("d", server.url, "gpt-4o", api_key="k", api_version=api_version)])
+
+    image = payload((0, 255, 0))
+    for api_version in ("2024-05-01-preview", "2024-05-01-preview", "2024-10-21"):
+        describe_image("Describe.", image_payload=image, pool=pool(api_version), cache=cache, raise_errors=True)
+    # The same version hits the cache, another one is sent again
+    assert server.stats()["requests"] == 2
+
+    mixed = DeploymentPool([
+        Deployment("old", server.url, "gpt-4o", api_key="k", api_version="2024-05-01-preview"),
+        Deployment("new", server.url, "gpt-4o", api_key="k", api_version="2024-10-21")
+    ])
+    assert mixed.api_version == "2024-05-01-preview,2024-10-21"
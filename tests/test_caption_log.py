@@ -0,0 +1,73 @@
+import json
+import os
+
+from utils import caption_log
+
+
+def write_segment(path, records, truncated=None):
+    with caption_log.CaptionWriter(str(path), fsync="never") as writer:
+        for record in records:
+            writer.write(record)
+    if truncated is not None:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(truncated)
+
+
+def record(id, caption):
+    return {"id": id, "label": "l", "prompt": "p", "caption": caption}
+
+
+def test_list_segments_in_numeric_order(tmp_path):
+    base = tmp_path / "captions"
+    for index in (10, 2, 0):
+        write_segment(caption_log.segment_path(str(base), index), [])
+    names = [os.path.basename(p) for p in caption_log.list_segments(str(base))]
+    assert names == ["captions.part0.jsonl", "captions.part2.jsonl", "captions.part10.jsonl"]
+    assert caption_log.next_segment_index(str(base)) == 11
+
+
+def test_truncated_last_line_is_skipped(tmp_path):
+    path = tmp_path / "c.part0.jsonl"
+    write_segment(path, [record("img_1", "a")], truncated='{"id": "img_2", "cap')
+    assert [r["id"] for r in caption_log.iter_segment(str(path))] == ["img_1"]
+
+
+def test_merge_in_natural_id_order(tmp_path):
+    a = tmp_path / "c.part0.jsonl"
+    b = tmp_path / "c.part1.jsonl"
+    write_segment(a, [record("img_2", "a2"), record("img_10", "a10")])
+    write_segment(b, [record("img_9", "b9"), record("img_11", "b11")])
+    merged = list(caption_log.merge_segments([str(a), str(b)]))
+    assert [r["id"] for r in merged] == ["img_2", "img_9", "img_10", "img_11"]
+
+
+def test_duplicates_keep_the_last_caption(tmp_path):
+    first = tmp_path / "c.part0.jsonl"
+    retry = tmp_path / "c.part1.jsonl"
+    later_failure = tmp_path / "c.part2.jsonl"
+    write_segment(first, [record("img_1", None), record("img_2", "old"), record("img_3", "kept")])
+    write_segment(retry, [record("img_1", "retried"), record("img_2", "new")])
+    write_segment(later_failure, [record("img_3", None)])
+    merged = {r["id"]: r["caption"] for r in caption_log.merge_segments([str(first), str(retry), str(later_failure)])}
+    # A success replaces a failure, a later success replaces an earlier one, a failure never replaces a success
+    assert merged == {"img_1": "retried", "img_2": "new", "img_3": "kept"}
+
+
+def test_unordered_segments_are_sorted_externally(tmp_path):
+    path = tmp_path / "c.part0.jsonl"
+    ids = [f"img_{i}" for i in (5, 3, 9, 1, 7, 3)]
+    write_segment(path, [record(id, f"{id}-{k}") for k, id in enumerate(ids)])
+    assert not caption_log.is_id_ordered(str(path))
+    merged = list(caption_log.merge_segments([str(path)], chunk_size=2))
+    assert [r["id"] for r in merged] == ["img_1", "img_3", "img_5", "img_7", "img_9"]
+    # The later of two records of the same id wins, as in ordered segments
+    assert merged[1]["caption"] == "img_3-5"
+    # The temporary sort runs are removed
+    assert os.listdir(tmp_path) == ["c.part0.jsonl"]
+
+
+def test_legacy_json_parts_are_merged(tmp_path):
+    legacy = tmp_path / "c.part0.json"
+    legacy.write_text(json.dumps({"prompt": "p", "captions": [{"id": "img_1", "label": "l", "caption": "x"}]}))
+    merged = list(caption_log.merge_segments(caption_log.list_segments(str(tmp_path / "c"))))
+    assert merged == [{"id": "img_1", "label": "l", "caption": "x", "prompt": "p"}]
@@ -0,0 +1,52 @@
+from utils import checkpoint
+from utils.checkpoint import IndexSet
+
+
+def test_index_set_membership_and_order():
+    s = IndexSet([9, 0, 3, 17])
+    assert 3 in s and 17 in s and 4 not in s and 1000 not in s
+    assert list(s) == [0, 3, 9, 17]
+    assert len(s) == 4
+    s.discard(3)
+    s.discard(1000)
+    assert list(s) == [0, 9, 17]
+
+
+def test_index_set_operators():
+    a = IndexSet([1, 2, 3, 40])
+    b = IndexSet([3, 4])
+    assert list(a | b) == [1, 2, 3, 4, 40]
+    assert list(a - b) == [1, 2, 40]
+    assert list(b - a) == [4]
+
+
+def test_index_set_prefix_length():
+    assert IndexSet().prefix_length() == 0
+    assert IndexSet(range(16)).prefix_length() == 16
+    assert IndexSet([0, 1, 2, 4]).prefix_length() == 3
+
+
+def test_index_set_encode_round_trip():
+    s = IndexSet(range(0, 100_000, 7))
+    assert list(IndexSet.decode(s.encode())) == list(s)
+    # A fully completed run compresses to a few bytes
+    assert len(IndexSet(range(100_000)).encode()) < 100
+
+
+def test_update_state_merges_workers(tmp_path):
+    output_path = str(tmp_path / "captions")
+    checkpoint.update_state(output_path, IndexSet([0, 1]), IndexSet([2, 3]))
+    completed, failed = checkpoint.update_state(output_path, IndexSet([2]), IndexSet([5]))
+    assert list(completed) == [0, 1, 2]
+    assert list(failed) == [3, 5]
+    completed, failed = checkpoint.load_state(output_path)
+    assert (list(completed), list(failed)) == ([0, 1, 2], [3, 5])
+
+
+def test_legacy_integer_checkpoint(tmp_path):
+    output_path = str(tmp_path / "captions")
+    with open(checkpoint.get_path(output_path), 'w') as f:
+        f.write("5")
+    assert checkpoint.load(output_path) == 5
+    completed, failed = checkpoint.load_state(output_path)
+    assert list(completed) == [0, 1, 2, 3, 4] and len(failed) == 0
@@ -0,0 +1,156 @@
+import inspect
+import os
+import subprocess
+import sys
+
+import pytest
+
+from scripts import cli
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG = os.path.join(ROOT, "configs", "pipeline.yaml")
+HEAVY_MODULES = {"datasets", "openai", "torch", "pyarrow", "PIL"}
+
+
+def imported_modules(*args):
+    # `-X importtime` lists every module the command imports, on stderr
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "scripts.cli", *args],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    assert "usage: python -m scripts.cli" in result.stdout
+    return {
+        line.rsplit("|", 1)[1].strip().split(".")[0]
+        for line in result.stderr.splitlines() if line.startswith("import time:")
+    }
+
+
+@pytest.mark.parametrize("args", [["--help"], ["caption", "--help"], ["export", "--help"]])
+def test_help_does_not_import_heavy_modules(args):
+    modules = imported_modules(*args)
+    assert "scripts" in modules
+    assert not HEAVY_MODULES & modules
+
+
+@pytest.fixture
+def calls(monkeypatch, tmp_path):
+    """
+    Replaces the step functions with recorders, and runs the CLI with the repository config.
+    """
+    import data.build_full_dataset
+    import scripts.download_data
+    import scripts.export_shards
+    import scripts.generate_caption
+    import scripts.prepare_dataset
+    import utils.log
+
+    recorded = []
+
+    def recorder(function):
+        # Records the arguments by name, as the function would bind them
+        signature = inspect.signature(function)
+        return lambda *args, **kwargs: recorded.append((function.__name__, dict(signature.bind(*args, **kwargs).arguments)))
+
+    for module, name in [
+        (scripts.download_data, "download_categories"),
+        (data.build_full_dataset, "save_merged_datasets"),
+        (scripts.generate_caption, "generate_captions"),
+        (scripts.generate_caption, "merge_caption_parts"),
+        (scripts.generate_caption, "combine_shards"),
+        (scripts.prepare_dataset, "prepare_hf_dataset"),
+        (scripts.export_shards, "export_shards"),
+    ]:
+        monkeypatch.setattr(module, name, recorder(getattr(module, name)))
+    monkeypatch.setattr(utils.log, "setup_logging", lambda name, **kwargs: recorded.append(("setup_logging", {"name": name, **kwargs})))
+    monkeypatch.chdir(tmp_path)
+    return recorded
+
+
+def run(*argv):
+    cli.main([*argv, "--config", CONFIG])
+
+
+def test_crawl(calls):
+    run("crawl", "--max-num", "5")
+    assert calls[0] == ("setup_logging", {"name": "download_data", "log_dir": "logs", "level": "INFO"})
+    [(name, kwargs)] = calls[1:]
+    assert name == "download_categories"
+    assert kwargs["base_path"] == "data" and kwargs["max_num"] == 5
+    assert list(kwargs["categories"]) == ["fashion", "markets", "rural_landscapes", "african_cuisine"]
+
+
+def test_build(calls):
+    run("build", "--full", "--num-proc", "2")
+    assert calls[1:] == [("save_merged_datasets", {"dedup": True, "dedup_threshold": 4, "incremental": False, "num_proc": 2})]
+
+
+def test_caption_runs_every_job(calls):
+    run("caption", "--concurrency", "8", "--log-level", "DEBUG")
+    assert calls[0][1]["level"] == "DEBUG"
+    assert [kwargs["category"] for _, kwargs in calls[1:]] == ["fashion", "food"]
+    for name, kwargs in calls[1:]:
+        assert name == "generate_captions"
+        assert kwargs["concurrency"] == 8 and kwargs["backend"] == "azure"
+
+
+def test_caption_selected_job_with_overrides(calls):
+    run("caption", "--job", "food", "--shard-index", "1", "--num-shards", "4", "--set", "detail=low")
+    assert calls[1:] == [("generate_captions", {
+        "concurrency": 1, "backend": "azure", "dataset_path": "data/processed/african-food",
+        "output_path": "data/captions/african-food-full", "category": "food",
+        "shard_index": 1, "num_shards": 4, "detail": "low"
+    })]
+
+
+def test_caption_path_replaces_the_jobs(calls):
+    run("caption", "--dataset-path", "other", "--output-path", "out", "--category", "food")
+    [(_, kwargs)] = calls[1:]
+    assert kwargs["dataset_path"] == "other" and kwargs["output_path"] == "out"
+
+
+def test_unknown_job(calls):
+    with pytest.raises(SystemExit, match="Unknown job"):
+        run("caption", "--job", "music")
+
+
+def test_merge(calls):
+    run("merge", "--job", "fashion")
+    assert calls[0][1]["name"] == "generate_caption"
+    assert calls[1:] == [("merge_caption_parts", {
+        "delete_parts": True, "save_csv": False, "save_summary": True,
+        "base_path": "data/captions/african-fashion-full",
+        "output_file": "data/captions/african-fashion-full.json"
+    })]
+
+
+@pytest.mark.parametrize("argv", [["merge"], ["caption", "--combine"]])
+def test_merge_shards(calls, argv):
+    run(*argv, "--num-shards", "4", "--output-format", "parquet")
+    assert [name for name, _ in calls[1:]] == ["combine_shards", "combine_shards"]
+    assert calls[1][1] == {
+        "delete_parts": True, "save_csv": False, "save_summary": True,
+        "output_path": "data/captions/african-fashion-full", "num_shards": 4, "output_format": "parquet"
+    }
+
+
+def test_prepare(calls):
+    run("prepare", "--set", "num_proc=4")
+    assert calls[1:] == [
+        ("prepare_hf_dataset", {
+            "dataset_path": f"data/processed/african-{name}",
+            "caption_file": f"data/captions/african-{name}-04.json",
+            "output_path": f"data/processed/african-{name}-hf",
+            "num_proc": 4
+        })
+        for name in ("fashion", "food")
+    ]
+
+
+def test_export(calls):
+    run("export", "--job", "fashion", "--max-shard-size", "1GB")
+    assert calls[0][1]["name"] == "export_shards"
+    assert calls[1:] == [("export_shards", {
+        "max_shard_size": "1GB",
+        "dataset_path": "data/processed/african-fashion-hf",
+        "output_path": "data/shards/african-fashion"
+    })]
@@ -0,0 +1,133 @@
+import io
+import json
+import os
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from icrawler.builtin import UrlListCrawler
+from PIL import Image
+
+from utils.crawler import MANIFEST_NAME, Manifest, crawl_keywords
+
+
+def encode(color, size=(32, 24)):
+    buffered = io.BytesIO()
+    Image.new("RGB", size, color=color).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+# Distinct images, a copy of the first under another URL and a file that is not an image
+FILES = {
+    **{f"/img_{i}.png": encode((40 * i, 0, 0)) for i in range(4)},
+    "/copy.png": encode((0, 0, 0)),
+    "/broken.jpg": b"not an image",
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    hits = Counter()
+
+    def do_GET(self):
+        self.hits[self.path] += 1
+        data = FILES.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def reset_hits():
+    Handler.hits.clear()
+
+
+def url_list(tmp_path, name, server, paths):
+    # Keywords of the local stand-in are files listing the "search result" URLs
+    path = tmp_path / f"{name}.txt"
+    path.write_text("".join(f"{server}{p}\n" for p in paths))
+    return str(path)
+
+
+def crawl(keywords_by_dir, max_num=100):
+    return crawl_keywords(
+        keywords_by_dir, max_num=max_num, crawler_cls=UrlListCrawler, query_arg="url_list",
+        downloader_threads=1, min_host_interval=0.0, num_proc=1
+    )
+
+
+def read_manifest(save_dir):
+    with open(os.path.join(save_dir, MANIFEST_NAME)) as f:
+        return {entry["url"].rsplit("/", 1)[1]: entry for entry in map(json.loads, f)}
+
+
+def test_crawl_dedups_and_records_outcomes(tmp_path, server):
+    save_dir = str(tmp_path / "raw")
+    keyword = url_list(tmp_path, "k", server, ["/img_0.png", "/img_1.png", "/copy.png", "/broken.jpg", "/missing.png"])
+    assert crawl({save_dir: [keyword]}) == {save_dir: 2}
+
+    manifest = read_manifest(save_dir)
+    assert manifest["img_0.png"]["status"] == "ok"
+    assert manifest["copy.png"]["status"] == "duplicate"
+    assert manifest["copy.png"]["path"] == manifest["img_0.png"]["path"]
+    assert manifest["broken.jpg"]["status"] == "invalid"
+    # 404s are not recorded, so that they are retried
+    assert "missing.png" not in manifest
+    assert all(entry["keyword"] == keyword for entry in manifest.values())
+    # Images are stored once, under their content hash
+    assert sorted(f for f in os.listdir(save_dir) if f != MANIFEST_NAME) == sorted(
+        f"{manifest[name]['sha256']}.png" for name in ("img_0.png", "img_1.png")
+    )
+
+
+def test_recrawl_resumes_from_the_manifest(tmp_path, server):
+    save_dir = str(tmp_path / "raw")
+    keyword = url_list(tmp_path, "k", server, ["/img_0.png", "/broken.jpg", "/missing.png"])
+    crawl({save_dir: [keyword]})
+    Handler.hits.clear()
+
+    assert crawl({save_dir: [keyword]}) == {save_dir: 1}
+    # Only the URL without a manifest entry is fetched again
+    assert Handler.hits == Counter({"/missing.png": 1})
+
+
+def test_max_num_counts_resumed_images(tmp_path, server):
+    save_dir = str(tmp_path / "raw")
+    keyword = url_list(tmp_path, "k", server, ["/img_0.png", "/img_1.png", "/img_2.png", "/img_3.png"])
+    assert crawl({save_dir: [keyword]}, max_num=2) == {save_dir: 2}
+    # Both images already fetched count towards max_num
+    assert crawl({save_dir: [keyword]}, max_num=2) == {save_dir: 2}
+    assert crawl({save_dir: [keyword]}, max_num=3) == {save_dir: 3}
+
+
+def test_max_num_is_per_keyword(tmp_path, server):
+    save_dir = str(tmp_path / "raw")
+    first = url_list(tmp_path, "first", server, ["/img_0.png", "/img_1.png"])
+    crawl({save_dir: [first]})
+
+    # The images of another keyword in the directory do not count towards max_num
+    second = url_list(tmp_path, "second", server, ["/img_0.png", "/img_1.png", "/img_2.png", "/img_3.png"])
+    assert crawl({save_dir: [second]}, max_num=2) == {save_dir: 4}
+
+    manifest = Manifest(os.path.join(save_dir, MANIFEST_NAME))
+    assert manifest.count("ok", keyword=first) == 2
+    assert manifest.count("ok", keyword=second) == 2
+    manifest.close()
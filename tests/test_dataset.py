@@ -0,0 +1,109 @@
+import os
+
+import pandas as pd
+import pytest
+from datasets import ClassLabel, Dataset, Features, Value
+from datasets import Image as HfImage
+
+from benchmarks.synthetic import make_image_folders
+from utils import dataset as dataset_module
+from utils.dataset import build_image_dataset_from_folders, scan_image_folders
+
+
+@pytest.fixture
+def root_dir(tmp_path):
+    root = str(tmp_path / "images")
+    make_image_folders(root, partitions=("train", "test"), num_classes=3, images_per_class=4, size=(8, 8))
+    # Files the scanner must skip
+    open(os.path.join(root, "train", "label_0", "notes.txt"), 'w').close()
+    os.makedirs(os.path.join(root, "train", "label_1", "nested"))
+    return root
+
+
+def baseline_build(root_dir, partitions, keep_splits=True):
+    """
+    The original pandas-based builder, with its folder listings sorted (`os.listdir`
+    order is up to the filesystem).
+    """
+    all_labels = set()
+    data_by_split = {}
+    for split in partitions:
+        split_path = os.path.join(root_dir, split)
+        data = []
+        for class_name in sorted(d for d in os.listdir(split_path) if os.path.isdir(os.path.join(split_path, d))):
+            class_dir = os.path.join(split_path, class_name)
+            for fname in sorted(os.listdir(class_dir)):
+                if fname.lower().endswith(('.jpg', '.jpeg', '.png')):
+                    data.append({"image": os.path.join(class_dir, fname), "label": class_name})
+                    all_labels.add(class_name)
+        data_by_split[split] = data
+
+    label_names = sorted(all_labels)
+    features = Features({"image": Value("string"), "label": ClassLabel(names=label_names)})
+
+    def build(data):
+        df = pd.DataFrame(data)
+        df["label"] = df["label"].apply(lambda x: label_names.index(x))
+        return Dataset.from_pandas(df, features=features).cast_column("image", HfImage())
+
+    if keep_splits:
+        return {split: build(data) for split, data in data_by_split.items()}
+    return build([row for data in data_by_split.values() for row in data]).shuffle(seed=42)
+
+
+def rows(dataset):
+    dataset = dataset.cast_column("image", HfImage(decode=False))
+    return [(row["image"]["path"], row["label"]) for row in dataset]
+
+
+def test_splits_match_the_baseline(root_dir):
+    built = build_image_dataset_from_folders(root_dir, ["train", "test"], num_workers=4)
+    expected = baseline_build(root_dir, ["train", "test"])
+    assert list(built) == ["train", "test"]
+    for split in ("train", "test"):
+        assert built[split].features == expected[split].features
+        assert rows(built[split]) == rows(expected[split])
+        assert len(built[split]) == 12
+
+
+def test_merged_dataset_matches_the_baseline_shuffle(root_dir):
+    built = build_image_dataset_from_folders(root_dir, ["train", "test"], keep_splits=False, num_workers=4)
+    expected = baseline_build(root_dir, ["train", "test"], keep_splits=False)
+    assert built.features == expected.features
+    assert rows(built) == rows(expected)
+    assert built._indices is None
+
+
+def test_embedded_images(root_dir):
+    built = build_image_dataset_from_folders(root_dir, ["test"], embed_images=True)
+    for row in built["test"].cast_column("image", HfImage(decode=False)):
+        with open(row["image"]["path"], 'rb') as f:
+            assert row["image"]["bytes"] == f.read()
+
+
+def test_rescan_only_reads_changed_folders(root_dir, tmp_path, monkeypatch):
+    cache_path = str(tmp_path / "scan.json")
+    first = scan_image_folders(root_dir, ["train", "test"], cache_path=cache_path)
+
+    scanned = []
+    scan_class_dir = dataset_module._scan_class_dir
+
+    def spy(class_dir):
+        scanned.append(class_dir)
+        return scan_class_dir(class_dir)
+
+    monkeypatch.setattr(dataset_module, "_scan_class_dir", spy)
+    assert scan_image_folders(root_dir, ["train", "test"], cache_path=cache_path) == first
+    assert scanned == []
+
+    class_dir = os.path.join(root_dir, "test", "label_2")
+    new_file = os.path.join(class_dir, "label_2_99999.png")
+    open(new_file, 'wb').close()
+    # Filesystems with coarse timestamps may not move the folder mtime on their own
+    stat = os.stat(class_dir)
+    os.utime(class_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    rescanned = scan_image_folders(root_dir, ["train", "test"], cache_path=cache_path)
+    assert scanned == [class_dir]
+    assert rescanned["train"] == first["train"]
+    assert rescanned["test"] == first["test"] + [(new_file, "label_2")]
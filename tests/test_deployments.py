@@ -0,0 +1,142 @@
+import json
+from types import SimpleNamespace
+
+import dotenv
+import httpx
+import openai
+import pytest
+
+from benchmarks.mock_server import MockOpenAIServer
+from utils import call_openai_api
+from utils.call_openai_api import close_clients
+from utils.deployments import Deployment, DeploymentPool, load_pool
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+@pytest.fixture(autouse=True)
+def clients():
+    yield
+    close_clients()
+
+
+def api_error(cls, status):
+    response = httpx.Response(status, request=httpx.Request("POST", "http://mock/chat/completions"))
+    return cls(f"error {status}", response=response, body=None)
+
+
+class StubClient:
+    """
+    Chat client answering from a list of outcomes: an exception to raise or a response.
+    """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def make_pool(*clients, **pool_kwargs):
+    deployments = []
+    for k, client in enumerate(clients):
+        deployment = Deployment(f"d{k}", "http://127.0.0.1:9", f"deployment-{k}", api_key="k")
+        deployment.client = client
+        deployments.append(deployment)
+    return DeploymentPool(deployments, **pool_kwargs)
+
+
+@pytest.mark.parametrize("error", [
+    api_error(openai.AuthenticationError, 401),
+    api_error(openai.PermissionDeniedError, 403),
+    api_error(openai.NotFoundError, 404)
+])
+def test_misconfigured_deployment_opens_and_fails_over(error):
+    broken, healthy = StubClient(error), StubClient("ok")
+    pool = make_pool(broken, healthy)
+    # Routing is random: enough requests for the broken deployment to be drawn
+    for _ in range(50):
+        assert pool.complete(MESSAGES) == "ok"
+    assert broken.calls == 1
+    assert pool.deployments[0].state == "open"
+    assert list(pool.deployments[0].outcomes) == [False]
+
+
+def test_throttled_deployment_opens_for_retry_after():
+    error = api_error(openai.RateLimitError, 429)
+    error.response.headers["retry-after"] = "30"
+    pool = make_pool(StubClient(error), StubClient("ok"))
+    pool.report(pool.deployments[0], ok=False, retry_after=30, throttled=True)
+    assert pool.deployments[0].state == "open"
+    assert pool.choose() is pool.deployments[1]
+
+
+def test_failed_probe_reopens_with_longer_cooldown():
+    pool = make_pool(StubClient(api_error(openai.InternalServerError, 500)), cooldown=0.01)
+    deployment = pool.deployments[0]
+    pool._open(deployment)
+    deployment.open_until = 0
+    with pytest.raises(openai.InternalServerError):
+        pool.complete(MESSAGES, max_attempts=1)
+    assert deployment.state == "open"
+    assert deployment.cooldown == 0.02
+
+
+def test_successful_probe_closes_breaker():
+    pool = make_pool(StubClient("ok"), cooldown=0.01)
+    deployment = pool.deployments[0]
+    pool._open(deployment)
+    deployment.open_until = 0
+    assert pool.complete(MESSAGES) == "ok"
+    assert deployment.state == "closed"
+    assert deployment.cooldown is None
+
+
+def test_request_error_releases_probe_without_success():
+    pool = make_pool(StubClient(api_error(openai.BadRequestError, 400)), cooldown=0.01)
+    deployment = pool.deployments[0]
+    pool._open(deployment)
+    deployment.open_until = 0
+    outcomes = list(deployment.outcomes)
+    with pytest.raises(openai.BadRequestError):
+        pool.complete(MESSAGES)
+    assert deployment.state == "half-open"
+    assert not deployment.probing
+    assert list(deployment.outcomes) == outcomes
+    # The slot is free for the next probe
+    assert pool.choose() is deployment
+
+
+def test_failover_between_mock_servers():
+    with MockOpenAIServer(error_rate=1.0) as failing, MockOpenAIServer() as healthy:
+        pool = DeploymentPool(
+            [Deployment("failing", failing.url, "d", api_key="k"), Deployment("healthy", healthy.url, "d", api_key="k")],
+            min_requests=2
+        )
+        for _ in range(10):
+            response = pool.complete(MESSAGES)
+            assert response.choices[0].message.content.startswith("Mock caption")
+        assert failing.stats()["requests"] <= 2
+        assert healthy.stats()["requests"] == 10
+        assert pool.deployments[0].state == "open"
+
+
+def test_load_pool_reads_the_env_file(tmp_path, monkeypatch):
+    config = tmp_path / "deployments.json"
+    config.write_text(json.dumps({"deployments": [
+        {"name": "eastus", "azure_endpoint": "http://eastus", "azure_deployment": "gpt-4o", "api_key": "k"}
+    ]}))
+    monkeypatch.delenv("AZURE_OPENAI_DEPLOYMENTS", raising=False)
+    assert load_pool() is None
+
+    # The variable is only set in the .env file
+    monkeypatch.setattr(call_openai_api, "_env_loaded", False)
+    monkeypatch.setattr(dotenv, "load_dotenv", lambda: monkeypatch.setenv("AZURE_OPENAI_DEPLOYMENTS", str(config)))
+    pool = load_pool()
+    assert [d.name for d in pool.deployments] == ["eastus"]
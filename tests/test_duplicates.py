@@ -0,0 +1,69 @@
+import json
+
+import pytest
+from datasets import Image as HfImage, load_from_disk
+
+from benchmarks.synthetic import make_image_dataset
+from scripts.generate_caption import combine_shards, generate_captions
+
+# Index of the representative of each duplicate
+DUPLICATES = {1: 0, 3: 2, 4: 2}
+
+
+@pytest.fixture
+def dataset_path(tmp_path):
+    path = str(tmp_path / "dataset")
+    make_image_dataset(path, num_images=6, size=(32, 32), num_labels=1)
+    dataset = load_from_disk(path)
+    ids = dataset["id"]
+    dataset = dataset.add_column("duplicate_of", [ids[DUPLICATES.get(i, i)] for i in range(len(ids))])
+    dataset.save_to_disk(f"{path}-dedup")
+    return f"{path}-dedup"
+
+
+def load_captions(output_path):
+    with open(f"{output_path}.json") as f:
+        return {c["id"]: c["caption"] for c in json.load(f)["captions"]}
+
+
+def check_captions(captions):
+    assert len(captions) == 6
+    assert all(captions.values())
+    for i, rep in DUPLICATES.items():
+        assert captions[f"img_{i:05d}"] == captions[f"img_{rep:05d}"]
+    assert len(set(captions.values())) == 3
+
+
+def test_duplicates_reuse_representative_caption(dataset_path, tmp_path):
+    output_path = str(tmp_path / "captions")
+    generate_captions(dataset_path, output_path, backend="fake", max_retries=0)
+    check_captions(load_captions(output_path))
+
+
+def test_duplicates_follow_representative_shard(dataset_path, tmp_path):
+    output_path = str(tmp_path / "captions")
+    for k in range(2):
+        generate_captions(dataset_path, output_path, backend="fake", shard_index=k, num_shards=2, max_retries=0)
+    assert combine_shards(output_path, 2) == []
+    check_captions(load_captions(output_path))
+
+
+
+@pytest.mark.parametrize("kwargs, duplicate_of", [({"dedup_threshold": 4}, None), ({}, ["img_00000", "img_00000"])])
+def test_duplicates_across_labels_are_captioned_separately(tmp_path, kwargs, duplicate_of):
+    # The same image under two labels
+    path = str(tmp_path / "dataset")
+    make_image_dataset(path, num_images=2, size=(32, 32), num_labels=2)
+    dataset = load_from_disk(path).cast_column("image", HfImage(decode=False))
+    image = dataset[0]["image"]
+    dataset = dataset.map(lambda example: {"image": image})
+    if duplicate_of is not None:
+        dataset = dataset.add_column("duplicate_of", duplicate_of)
+    dataset.save_to_disk(f"{path}-same")
+
+    output_path = str(tmp_path / "captions")
+    generate_captions(f"{path}-same", output_path, backend="fake", max_retries=0, **kwargs)
+    with open(f"{output_path}.json") as f:
+        captions = {c["id"]: c for c in json.load(f)["captions"]}
+    assert captions["img_00001"]["label"] == "label_1"
+    assert captions["img_00001"]["caption"].startswith("A photo of label_1")
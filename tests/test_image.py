@@ -0,0 +1,133 @@
+import base64
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils.call_openai_api import build_image_payload
+from utils.image import encode_image, image_tokens, image_to_base64, raw_image_base64, target_size
+
+
+def encode(size=(64, 48), format="JPEG", mode="RGB", **save_kwargs):
+    buffered = io.BytesIO()
+    Image.new(mode, size, color=0).save(buffered, format=format, **save_kwargs)
+    return buffered.getvalue()
+
+
+@pytest.mark.parametrize("format, mime", [("JPEG", "image/jpeg"), ("PNG", "image/png"), ("WEBP", "image/webp")])
+def test_accepted_formats_pass_through_unchanged(format, mime):
+    data = encode(format=format)
+    base64_str, mime_type = raw_image_base64(data)
+    assert base64.b64decode(base64_str) == data
+    assert mime_type == mime
+
+
+def test_file_path_input(tmp_path):
+    path = tmp_path / "image.jpg"
+    path.write_bytes(encode())
+    assert base64.b64decode(raw_image_base64(str(path))[0]) == path.read_bytes()
+
+
+@pytest.mark.parametrize("data, kwargs", [
+    (encode(format="BMP"), {}),                                   # format the API does not take
+    (encode(format="GIF", mode="P", save_all=True,
+            append_images=[Image.new("P", (64, 48), 1)]), {}),    # animation
+    (encode(mode="CMYK"), {}),                                    # JPEG the API cannot read
+    (encode(size=(1200, 400)), {"detail": "low"}),                # larger than the low detail size
+    (encode(size=(3000, 1000)), {}),                              # larger than the high detail size
+    (encode(size=(400, 300)), {"max_edge": 200}),                 # larger than max_edge
+    (encode(), {"max_bytes": 10}),                                # over the size budget
+    (b"not an image", {}),                                        # unreadable header
+])
+def test_images_that_need_transcoding(data, kwargs):
+    assert raw_image_base64(data, **kwargs) is None
+
+
+def test_payload_passes_bytes_through_and_transcodes_otherwise():
+    small = encode()
+    payload = build_image_payload(image=small, detail="low")
+    assert payload["image_url"]["url"] == "data:image/jpeg;base64," + base64.b64encode(small).decode()
+
+    large = encode(size=(1200, 400))
+    url = build_image_payload(image=large, detail="low")["image_url"]["url"]
+    resized = Image.open(io.BytesIO(base64.b64decode(url.split(",", 1)[1])))
+    assert resized.size == (512, 171)
+
+    disabled = build_image_payload(image=small, detail="low", passthrough=False)["image_url"]["url"]
+    assert disabled != payload["image_url"]["url"]
+
+
+@pytest.mark.parametrize("size, detail, expected", [
+    ((2000, 1000), "low", (512, 256)),
+    ((1000, 2000), "low", (256, 512)),
+    ((4096, 2048), "high", (1536, 768)),
+    ((4096, 1024), "high", (2048, 512)),
+    ((3000, 1500), "auto", (1536, 768)),
+    # Never upscaled
+    ((300, 200), "low", (300, 200)),
+    ((700, 500), "high", (700, 500)),
+])
+def test_target_size(size, detail, expected):
+    assert target_size(*size, detail=detail) == expected
+
+
+def test_target_size_max_edge():
+    assert target_size(3000, 1500, max_edge=1000) == (1000, 500)
+    assert target_size(300, 200, max_edge=1000) == (300, 200)
+
+
+@pytest.mark.parametrize("size, detail, expected", [
+    ((4096, 4096), "low", 85),
+    ((512, 512), "high", 85 + 170),
+    ((1024, 1024), "high", 85 + 170 * 4),
+    # Sized like the model sees it: 2048x4096 becomes 768x1536, 2x3 tiles
+    ((2048, 4096), "auto", 85 + 170 * 6),
+])
+def test_image_tokens(size, detail, expected):
+    assert image_tokens(*size, detail=detail) == expected
+
+
+def noise(size=(512, 512), seed=0):
+    pixels = np.random.default_rng(seed).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    return Image.fromarray(pixels)
+
+
+def test_encode_image_lowers_quality_to_fit():
+    image = noise()
+    full, lowest = len(encode_image(image)), len(encode_image(image, quality=40))
+    max_bytes = (full + lowest) // 2
+    data = encode_image(image, max_bytes=max_bytes)
+    assert len(data) <= max_bytes
+    assert Image.open(io.BytesIO(data)).size == image.size
+
+
+def test_encode_image_downscales_when_quality_is_not_enough():
+    image = noise()
+    max_bytes = len(encode_image(image, quality=40)) // 4
+    data = encode_image(image, max_bytes=max_bytes)
+    assert len(data) <= max_bytes
+    width, height = Image.open(io.BytesIO(data)).size
+    assert width < image.width and width / height == image.width / image.height
+
+
+def test_payload_cache_is_keyed_by_settings(tmp_path):
+    data = encode(size=(1200, 400))
+    cache_dir = str(tmp_path / "payloads")
+
+    def cache_files():
+        return sorted((tmp_path / "payloads").rglob("*.b64"))
+
+    low = image_to_base64(data, detail="low", cache_dir=cache_dir)
+    assert low == image_to_base64(data, detail="low")
+    [cached] = cache_files()
+
+    # A hit is served from the cache file
+    cached.write_text("cached")
+    assert image_to_base64(data, detail="low", cache_dir=cache_dir) == "cached"
+
+    # Other settings or another image miss
+    assert image_to_base64(data, detail="high", cache_dir=cache_dir) != "cached"
+    assert image_to_base64(data, detail="low", max_bytes=10_000, cache_dir=cache_dir) != "cached"
+    assert image_to_base64(encode(size=(1200, 401)), detail="low", cache_dir=cache_dir) != "cached"
+    assert len(cache_files()) == 4
@@ -0,0 +1,105 @@
+import json
+import threading
+
+import pytest
+from datasets import load_from_disk
+
+from benchmarks.mock_server import MockOpenAIServer
+from benchmarks.synthetic import make_image_dataset
+from scripts import generate_caption
+from scripts.generate_caption import generate_captions, iter_captions
+from utils.call_openai_api import close_clients, get_client
+
+NUM_IMAGES = 24
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # Random latencies, so that requests finish out of order
+    with MockOpenAIServer(jitter=0.02) as srv:
+        monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", srv.url)
+        monkeypatch.setenv("AZURE_OPENAI_KEY", "k")
+        monkeypatch.delenv("AZURE_OPENAI_DEPLOYMENTS", raising=False)
+        monkeypatch.delenv("AZURE_OPENAI_RPM", raising=False)
+        monkeypatch.delenv("AZURE_OPENAI_TPM", raising=False)
+        yield srv
+    close_clients()
+
+
+@pytest.fixture(scope="module")
+def dataset_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("data") / "dataset")
+    return make_image_dataset(path, num_images=NUM_IMAGES, size=(32, 32), num_labels=3)
+
+
+class InFlight:
+    """
+    Counts the examples read from the dataset and the API calls in flight.
+    """
+
+    def __init__(self, monkeypatch):
+        self.lock = threading.Lock()
+        self.read = 0
+        self.calls = 0
+        self.max_calls = 0
+        iter_examples, describe_image = generate_caption.iter_examples, generate_caption.describe_image
+
+        def counted_examples(*args, **kwargs):
+            for example in iter_examples(*args, **kwargs):
+                with self.lock:
+                    self.read += 1
+                yield example
+
+        def counted_describe(*args, **kwargs):
+            with self.lock:
+                self.calls += 1
+                self.max_calls = max(self.max_calls, self.calls)
+            try:
+                return describe_image(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.calls -= 1
+
+        monkeypatch.setattr(generate_caption, "iter_examples", counted_examples)
+        monkeypatch.setattr(generate_caption, "describe_image", counted_describe)
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"concurrency": 4, "encode_workers": 0},
+    {"concurrency": 4, "encode_workers": 2},
+    {"concurrency": 1, "encode_workers": 2, "prefetch": 1},
+])
+def test_parallel_paths_match_sequential(server, dataset_path, tmp_path, kwargs):
+    logs = {}
+    for name, run_kwargs in (("sequential", {"concurrency": 1, "encode_workers": 0}), ("parallel", kwargs)):
+        output_path = str(tmp_path / name / "captions")
+        generate_captions(
+            dataset_path, output_path, cache_path=None, max_retries=0, skip_duplicates=False,
+            save_every=5, **run_kwargs
+        )
+        with open(f"{output_path}.json") as f:
+            logs[name] = json.load(f)
+
+    assert [c["id"] for c in logs["sequential"]["captions"]] == [f"img_{i:05d}" for i in range(NUM_IMAGES)]
+    assert all(c["caption"] for c in logs["sequential"]["captions"])
+    assert logs["parallel"] == logs["sequential"]
+
+
+@pytest.mark.parametrize("kwargs, window", [
+    ({"concurrency": 3, "encode_workers": 0}, 6),
+    ({"concurrency": 3, "encode_workers": 1, "prefetch": 2}, 5),
+    ({"concurrency": 1, "encode_workers": 2, "prefetch": 1}, 2),
+])
+def test_pending_window_applies_backpressure(server, dataset_path, monkeypatch, kwargs, window):
+    counts = InFlight(monkeypatch)
+    dataset = load_from_disk(dataset_path)
+    records = iter_captions(dataset, "fashion", client=get_client(), **kwargs)
+
+    ids = []
+    for record in records:
+        ids.append(record["id"])
+        # The reader never gets more than the window ahead of the writer
+        assert counts.read - len(ids) < window
+    assert ids == dataset["id"]
+    assert counts.read == NUM_IMAGES
+    assert counts.max_calls <= kwargs["concurrency"]
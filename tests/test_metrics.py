@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+from benchmarks.mock_server import MockOpenAIServer
+from benchmarks.synthetic import make_image_dataset
+from scripts.generate_caption import generate_captions
+from utils.call_openai_api import close_clients
+from utils.metrics import METRIC_PREFIX, Histogram, Metrics
+
+
+def test_histogram_buckets_are_cumulative_and_inclusive():
+    histogram = Histogram((1, 2, 5))
+    for value in (0.5, 1, 1.5, 2, 4, 9):
+        histogram.observe(value)
+    assert histogram.counts == [2, 2, 1, 1]
+    assert histogram.lines("h") == [
+        'h_bucket{le="1"} 2',
+        'h_bucket{le="2"} 4',
+        'h_bucket{le="5"} 5',
+        'h_bucket{le="+Inf"} 6',
+        "h_sum 18",
+        "h_count 6",
+    ]
+
+
+@pytest.mark.parametrize("q, expected", [
+    (0.125, 0.5),  # halfway through the [0, 1] bucket
+    (0.25, 1.0),
+    (0.375, 1.5),  # halfway through the (1, 2] bucket
+    (0.625, 3.5),  # halfway through the (2, 5] bucket
+    (1.0, 5),      # the +Inf bucket returns the highest finite bound
+])
+def test_histogram_quantiles(q, expected):
+    histogram = Histogram((1, 2, 5))
+    for value in (0.2, 0.8, 1.2, 1.8, 3, 4, 9, 10):
+        histogram.observe(value)
+    assert histogram.quantile(q) == pytest.approx(expected)
+
+
+def test_empty_histogram_has_no_quantile():
+    assert Histogram((1, 2)).quantile(0.5) is None
+
+
+def test_prometheus_textfile(tmp_path):
+    path = str(tmp_path / "metrics.prom")
+    metrics = Metrics(prometheus_path=path, flush_every=2, labels={"shard": "0"})
+    metrics.record_request({"latency": 0.3, "attempts": 2, "statuses": [429, 200], "usage": {"prompt": 10, "completion": 5}, "payload_bytes": 20_000})
+    metrics.record_request({"latency": 1.5, "attempts": 1, "statuses": [500], "error": "InternalServerError"})
+    metrics.observe_stage("encode", 0.25)
+
+    # Flushed every `flush_every` requests, before the stage was observed
+    with open(path) as f:
+        flushed = f.read()
+    assert f'{METRIC_PREFIX}_stage_calls_total{{shard="0",stage="encode"}}' not in flushed
+
+    metrics.close()
+    with open(path) as f:
+        lines = set(f.read().splitlines())
+    p = METRIC_PREFIX
+    assert {
+        f'{p}_requests_total{{shard="0",outcome="ok"}} 1',
+        f'{p}_requests_total{{shard="0",outcome="error"}} 1',
+        f'{p}_request_errors_total{{shard="0",error_class="InternalServerError"}} 1',
+        f'{p}_http_responses_total{{shard="0",status="429"}} 1',
+        f'{p}_request_retries_total{{shard="0"}} 1',
+        f'{p}_payload_bytes_total{{shard="0"}} 20000',
+        f'{p}_tokens_total{{shard="0",kind="prompt"}} 10',
+        f'{p}_stage_calls_total{{shard="0",stage="encode"}} 1',
+        f"# TYPE {p}_request_duration_seconds histogram",
+        f'{p}_request_duration_seconds_bucket{{le="0.5",shard="0"}} 1',
+        f'{p}_request_duration_seconds_bucket{{le="+Inf",shard="0"}} 2',
+        f'{p}_request_duration_seconds_count{{shard="0"}} 2',
+    } <= lines
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with MockOpenAIServer() as srv:
+        monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", srv.url)
+        monkeypatch.setenv("AZURE_OPENAI_KEY", "k")
+        monkeypatch.delenv("AZURE_OPENAI_DEPLOYMENTS", raising=False)
+        yield srv
+    close_clients()
+
+
+@pytest.mark.parametrize("encode_workers", [0, 1])
+def test_trace_has_one_record_per_request(server, tmp_path, encode_workers):
+    dataset_path = make_image_dataset(str(tmp_path / "dataset"), num_images=5, size=(32, 32))
+    trace_path, prometheus_path = str(tmp_path / "trace.jsonl"), str(tmp_path / "metrics.prom")
+    generate_captions(
+        dataset_path, str(tmp_path / "captions"), cache_path=None, max_retries=0, skip_duplicates=False,
+        encode_workers=encode_workers, concurrency=2, trace_path=trace_path, prometheus_path=prometheus_path
+    )
+
+    with open(trace_path) as f:
+        events = [json.loads(line) for line in f]
+    assert len(events) == 5
+    for event in events:
+        assert event["category"] == "fashion" and event["shard"] == "0"
+        assert event["error"] is None and not event["cached"]
+        assert event["attempts"] == 1 and event["statuses"] == [200]
+        assert event["payload_bytes"] > 0 and event["usage"]["image"] == 85
+        assert event["ttfb"] <= event["latency"]
+
+    # Every stage shows up in the textfile
+    with open(prometheus_path) as f:
+        text = f.read()
+    for name in ("decode", "encode", "network", "write"):
+        assert f'{METRIC_PREFIX}_stage_calls_total{{category="fashion",shard="0",stage="{name}"}}' in text
+    assert f'{METRIC_PREFIX}_stage_calls_total{{category="fashion",shard="0",stage="network"}} 5' in text
@@ -0,0 +1,101 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from loguru import logger
+
+from benchmarks.mock_server import MockOpenAIServer
+from benchmarks.synthetic import make_image_dataset
+from scripts.generate_caption import generate_captions
+from utils.call_openai_api import (
+    API_VERSION, STRUCTURED_API_VERSION, build_image_payload, check_packing_support, close_clients,
+    describe_image, describe_images, get_client, parse_packed_response
+)
+from utils.deployments import Deployment, DeploymentPool
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with MockOpenAIServer() as srv:
+        monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", srv.url)
+        monkeypatch.setenv("AZURE_OPENAI_KEY", "k")
+        monkeypatch.delenv("AZURE_OPENAI_DEPLOYMENTS", raising=False)
+        yield srv
+    close_clients()
+
+
+@pytest.mark.parametrize("content, expected", [
+    ('{"a": " first ", "b": "second"}', {"a": "first", "b": "second"}),
+    ('{"a": "first", "b": "", "c": 3}', {"a": "first"}),
+    ('{"a": "first", "x": "unexpected"}', {"a": "first"}),
+    ('{"a": "first", "b": "trunc', {}),
+    ('["a", "b"]', {}),
+    (None, {}),
+])
+def test_parse_packed_response(content, expected):
+    assert parse_packed_response(content, ["a", "b", "c"]) == expected
+
+
+def test_packing_rejects_old_api_versions(server):
+    check_packing_support(get_client(api_version=STRUCTURED_API_VERSION))
+    with pytest.raises(ValueError, match="client"):
+        check_packing_support(get_client(api_version=API_VERSION))
+
+    pool = DeploymentPool([
+        Deployment("new", server.url, "d", api_key="k", api_version="2024-10-21"),
+        Deployment("old", server.url, "d", api_key="k", api_version=API_VERSION)
+    ])
+    with pytest.raises(ValueError, match="old"):
+        check_packing_support(pool=pool)
+
+
+@pytest.mark.parametrize("encode_workers", [0, 1])
+def test_packed_run_captions_every_image(server, tmp_path, encode_workers):
+    dataset_path = str(tmp_path / "dataset")
+    make_image_dataset(dataset_path, num_images=12, size=(32, 32), num_labels=2)
+    output_path = str(tmp_path / "captions")
+    generate_captions(
+        dataset_path, output_path, pack_size=4, concurrency=2, encode_workers=encode_workers,
+        cache_path=None, max_retries=0, skip_duplicates=False
+    )
+    with open(f"{output_path}.json") as f:
+        captions = json.load(f)["captions"]
+    assert [c["id"] for c in captions] == [f"img_{i:05d}" for i in range(12)]
+    # Packed answers end with the id they caption
+    assert all(c["caption"].endswith(f"({c['id']})") for c in captions)
+    # 6 images per label: groups of 4 and 2
+    assert server.stats()["requests"] == 4
+
+
+def test_packed_run_through_pool_uses_structured_version(server, tmp_path):
+    dataset_path = str(tmp_path / "dataset")
+    make_image_dataset(dataset_path, num_images=4, size=(32, 32), num_labels=1)
+    config = tmp_path / "deployments.json"
+    config.write_text(json.dumps({"deployments": [{"name": "a", "azure_endpoint": server.url, "azure_deployment": "d"}]}))
+    output_path = str(tmp_path / "captions")
+    generate_captions(
+        dataset_path, output_path, pack_size=4, encode_workers=0, deployments_config=str(config),
+        cache_path=None, max_retries=0, skip_duplicates=False
+    )
+    with open(f"{output_path}.json") as f:
+        assert len(json.load(f)["captions"]) == 4
+    assert server.stats()["requests"] == 1
+
+
+def test_swallowed_errors_are_logged():
+    def create(**kwargs):
+        raise RuntimeError("boom")
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    payloads = {"a": build_image_payload(image_url="https://a"), "b": build_image_payload(image_url="https://b")}
+    messages = []
+    sink = logger.add(messages.append, level="ERROR", format="{message}")
+    try:
+        assert describe_images("Describe.", payloads, client=client) == {"a": None, "b": None}
+        assert describe_image("Describe.", image_payload=payloads["a"], client=client, show_image=False) is None
+    finally:
+        logger.remove(sink)
+    assert [message.strip() for message in messages] == [
+        "❌ Packed description of 2 images failed: RuntimeError: boom",
+        "❌ Image description failed: RuntimeError: boom",
+    ]
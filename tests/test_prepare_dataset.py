@@ -0,0 +1,71 @@
+import pyarrow as pa
+import pytest
+from datasets import Image as HfImage
+from datasets import load_from_disk
+
+from benchmarks.synthetic import make_image_dataset
+from scripts.generate_caption import caption_file_path, generate_captions
+from scripts.prepare_dataset import join_caption_table, prepare_hf_dataset
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("data") / "dataset")
+    make_image_dataset(path, num_images=6, size=(16, 16))
+    return load_from_disk(path).cast_column("image", HfImage(decode=False))
+
+
+def caption_table(ids):
+    return pa.table({
+        "id": ids,
+        "label": ["l"] * len(ids),
+        "prompt": pa.array([f"prompt {id}" for id in ids]).dictionary_encode(),
+        "caption": [f"caption {id}" for id in ids]
+    })
+
+
+def test_join_in_dataset_order(dataset):
+    # Caption records in any order, with an id that is not in the dataset
+    ids = ["img_00003", "img_00000", "img_00005", "img_00001", "img_00004", "img_00002", "img_99999"]
+    joined = join_caption_table(dataset, caption_table(ids))
+    assert joined.column_names == ["image", "prompt", "caption"]
+    assert joined["caption"] == [f"caption img_{i:05d}" for i in range(6)]
+    assert joined["prompt"] == [f"prompt img_{i:05d}" for i in range(6)]
+
+
+def test_uncaptioned_examples_are_left_out(dataset):
+    joined = join_caption_table(dataset, caption_table(["img_00004", "img_00001"]))
+    assert joined["caption"] == ["caption img_00001", "caption img_00004"]
+    # Images follow their example
+    assert joined[0]["image"]["bytes"] == dataset[1]["image"]["bytes"]
+    assert joined[1]["image"]["bytes"] == dataset[4]["image"]["bytes"]
+
+
+def test_chunked_caption_table(dataset):
+    table = pa.concat_tables([caption_table(["img_00000", "img_00001"]), caption_table(["img_00002"])])
+    joined = join_caption_table(dataset, table)
+    assert joined["caption"] == [f"caption img_{i:05d}" for i in range(3)]
+
+
+def test_contiguous_captioned_prefix(dataset):
+    joined = join_caption_table(dataset, caption_table(["img_00000", "img_00001", "img_00002"]))
+    assert len(joined) == 3
+
+
+def test_json_and_parquet_prepare_identically(tmp_path):
+    dataset_path = str(tmp_path / "dataset")
+    make_image_dataset(dataset_path, num_images=6, size=(16, 16), num_labels=2)
+    prepared = {}
+    for output_format in ("json", "parquet"):
+        output_path = str(tmp_path / output_format / "captions")
+        generate_captions(
+            dataset_path, output_path, backend="fake", cache_path=None, max_retries=0,
+            skip_duplicates=False, output_format=output_format
+        )
+        prepared[output_format] = prepare_hf_dataset(
+            dataset_path, caption_file_path(output_path, output_format), str(tmp_path / output_format / "prepared")
+        )
+    assert prepared["json"]["caption"] == prepared["parquet"]["caption"]
+    assert prepared["json"]["prompt"] == prepared["parquet"]["prompt"]
+    # Each label keeps its own prompt
+    assert len(set(prepared["json"]["prompt"])) == 2
@@ -0,0 +1,112 @@
+import base64
+import io
+import json
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from benchmarks.mock_server import MockOpenAIServer
+from utils import rate_limit
+from utils.call_openai_api import _create_with_backoff, close_clients, get_client
+from utils.image import image_tokens
+from utils.rate_limit import RateLimiter, estimate_request_tokens, get_rate_limiter
+
+
+@pytest.fixture(autouse=True)
+def fresh_limiters(monkeypatch):
+    monkeypatch.setattr(rate_limit, "_limiters", {})
+    monkeypatch.delenv("AZURE_OPENAI_RPM", raising=False)
+    monkeypatch.delenv("AZURE_OPENAI_TPM", raising=False)
+    yield
+    close_clients()
+
+
+def test_acquire_waits_for_refill():
+    limiter = RateLimiter(rpm=600, burst_seconds=0.1)
+    assert limiter.acquire() == 0.0
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_429_pauses_and_lowers_rate_once_per_episode():
+    limiter = RateLimiter(rpm=600, decrease=0.5)
+    limiter.on_response(429, {"retry-after-ms": "200"})
+    limiter.on_response(429, {"retry-after-ms": "200"})
+    assert limiter.scale == 0.5
+    assert limiter.throttled == 2
+    assert limiter.blocked_until - time.monotonic() >= 0.15
+
+    limiter.on_response(200, {})
+    assert limiter.scale == pytest.approx(0.52)
+
+
+def test_remaining_headers_cap_the_buckets():
+    limiter = RateLimiter(rpm=600, tpm=60000)
+    limiter.on_response(200, {"x-ratelimit-remaining-requests": "3", "x-ratelimit-remaining-tokens": "10"})
+    assert limiter.requests.level <= 3
+    assert limiter.tokens.level <= 10
+
+
+def test_plain_call_keeps_earlier_quota():
+    limiter = get_rate_limiter("https://e", "d", rpm=100, tpm=1000)
+    assert get_rate_limiter("https://e", "d") is limiter
+    assert limiter.quota() == (100, 1000)
+
+    get_rate_limiter("https://e", "d", rpm=50)
+    assert limiter.quota() == (50, 1000)
+
+
+def test_environment_quota_applies_to_new_limiters(monkeypatch):
+    monkeypatch.setenv("AZURE_OPENAI_RPM", "30")
+    assert get_rate_limiter("https://e", "other").quota() == (30, None)
+
+
+def test_estimate_request_tokens():
+    body = json.dumps({
+        "max_tokens": 100,
+        "messages": [
+            {"role": "system", "content": "x" * 40},
+            {"role": "user", "content": [{"type": "image_url", "image_url": {"url": "https://i", "detail": "low"}}]}
+        ]
+    }).encode()
+    assert estimate_request_tokens(body) == 100 + 4 + 11 + 4 + 85
+
+
+def image_request(image, **save_kwargs):
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", **save_kwargs)
+    url = "data:image/jpeg;base64," + base64.b64encode(buffered.getvalue()).decode()
+    return json.dumps({"messages": [{"role": "user", "content": [{"type": "image_url", "image_url": {"url": url, "detail": "high"}}]}]}).encode()
+
+
+def test_image_tokens_are_read_from_the_header_only(monkeypatch):
+    pixels = np.random.default_rng(0).integers(0, 256, (2048, 1024, 3), dtype=np.uint8)
+    body = image_request(Image.fromarray(pixels), quality=95)
+    assert len(body) > 20 * rate_limit.HEADER_BASE64_CHARS
+
+    decoded = []
+    b64decode = base64.b64decode
+    monkeypatch.setattr(base64, "b64decode", lambda data: decoded.append(len(data)) or b64decode(data))
+    assert estimate_request_tokens(body) == 4 + image_tokens(1024, 2048, "high")
+    assert decoded == [rate_limit.HEADER_BASE64_CHARS]
+
+
+def test_image_header_past_the_prefix():
+    # A large ICC profile pushes the size marker past the decoded prefix
+    body = image_request(Image.new("RGB", (1024, 512)), icc_profile=b"\0" * 2 * rate_limit.HEADER_BASE64_CHARS)
+    assert estimate_request_tokens(body) == 4 + image_tokens(1024, 512, "high")
+
+
+def test_rate_limited_requests_are_retried_by_one_layer_only():
+    with MockOpenAIServer(rate_limit_rate=1.0, retry_after=0.01) as server:
+        client = get_client(azure_endpoint=server.url, azure_deployment="d", api_key="k")
+        client.rate_limiter.max_retries = 2
+        client.rate_limiter.base_delay = 0.01
+        from openai import RateLimitError
+
+        with pytest.raises(RateLimitError):
+            _create_with_backoff(client, [{"role": "user", "content": "hi"}])
+        assert server.stats()["requests"] == 3
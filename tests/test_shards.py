@@ -0,0 +1,64 @@
+import json
+import os
+
+import pytest
+
+from benchmarks.synthetic import make_image_dataset
+from scripts.generate_caption import combine_shards, generate_captions, shard_path
+from utils import caption_log, checkpoint
+
+
+@pytest.fixture
+def dataset_path(tmp_path):
+    path = str(tmp_path / "dataset")
+    make_image_dataset(path, num_images=10, size=(32, 32))
+    return path
+
+
+def run_shard(dataset_path, output_path, shard_index, num_shards=2):
+    generate_captions(
+        dataset_path, output_path, backend="fake", shard_index=shard_index, num_shards=num_shards,
+        max_retries=0, skip_duplicates=False
+    )
+
+
+def load_captions(output_path):
+    with open(f"{output_path}.json") as f:
+        return json.load(f)["captions"]
+
+
+def test_missing_shard_keeps_parts(dataset_path, tmp_path):
+    output_path = str(tmp_path / "captions")
+    run_shard(dataset_path, output_path, 0)
+
+    assert combine_shards(output_path, 2) == [1]
+    assert len(load_captions(output_path)) == 5
+    first = shard_path(output_path, 0, 2)
+    assert caption_log.list_segments(first)
+    assert os.path.exists(checkpoint.get_path(first))
+
+
+def test_complete_shards_are_combined_and_cleaned(dataset_path, tmp_path):
+    output_path = str(tmp_path / "captions")
+    for k in range(2):
+        run_shard(dataset_path, output_path, k)
+
+    assert combine_shards(output_path, 2) == []
+    captions = load_captions(output_path)
+    assert [c["id"] for c in captions] == [f"img_{i:05d}" for i in range(10)]
+    assert all(c["caption"] for c in captions)
+    for k in range(2):
+        path = shard_path(output_path, k, 2)
+        assert not caption_log.list_segments(path)
+        assert not os.path.exists(checkpoint.get_path(path))
+
+
+def test_interrupted_shard_is_incomplete(dataset_path, tmp_path):
+    output_path = str(tmp_path / "captions")
+    for k in range(2):
+        run_shard(dataset_path, output_path, k)
+    # A later run of shard 1 that never finished
+    os.remove(f"{shard_path(output_path, 1, 2)}.status.json")
+
+    assert combine_shards(output_path, 2) == [1]
+    assert caption_log.list_segments(shard_path(output_path, 0, 2))
@@ -0,0 +1,88 @@
+import io
+import os
+
+import pytest
+from datasets import load_from_disk
+from PIL import Image
+
+from benchmarks.synthetic import make_image_dataset
+from scripts.export_shards import export_shards
+from utils.webdataset import TarShardWriter, iter_webdataset, load_index, sample_fields, tar_file_size, tar_member_size
+
+MAX_SHARD_SIZE = 20_000
+
+
+@pytest.fixture(scope="module")
+def dataset_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("data") / "dataset")
+    make_image_dataset(path, num_images=24, size=(48, 32))
+    dataset = load_from_disk(path)
+    dataset = dataset.add_column("prompt", ["Describe this image."] * len(dataset))
+    dataset = dataset.add_column("caption", [f"caption é {i}" for i in range(len(dataset))])
+    dataset.save_to_disk(f"{path}-prepared")
+    return f"{path}-prepared"
+
+
+@pytest.fixture(scope="module")
+def export_path(dataset_path, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("export"))
+    export_shards(dataset_path, path, max_shard_size=MAX_SHARD_SIZE, num_proc=1)
+    return path
+
+
+def keys(samples):
+    return [sample["__key__"] for sample in samples]
+
+
+def test_round_trip(dataset_path, export_path):
+    dataset = load_from_disk(dataset_path)
+    samples = list(iter_webdataset(export_path, shuffle=0))
+    assert len(samples) == len(dataset)
+    for sample, example in zip(samples, dataset):
+        assert sample["id"] == example["id"]
+        assert sample["caption"] == example["caption"]
+        assert sample["image"].size == example["image"].size
+
+
+def test_shards_fit_the_size_budget(export_path):
+    index = load_index(export_path)
+    assert len(index["shards"]) > 2
+    for shard in index["shards"]:
+        assert shard["bytes"] == os.path.getsize(shard["path"]) <= MAX_SHARD_SIZE
+
+
+def test_tar_size_is_exact(tmp_path):
+    buffered = io.BytesIO()
+    Image.new("RGB", (20, 10)).save(buffered, format="JPEG")
+    samples = [(buffered.getvalue(), {"caption": "x" * n}) for n in (0, 511, 512, 2000)]
+    path = str(tmp_path / "shard.tar")
+    with TarShardWriter(path) as writer:
+        for k, (image, fields) in enumerate(samples):
+            writer.write(f"{k:09d}", image, fields)
+    members = sum(tar_member_size(len(image)) + tar_member_size(len(sample_fields(fields))) for image, fields in samples)
+    assert os.path.getsize(path) == tar_file_size(members)
+
+
+@pytest.mark.parametrize("seed", [7, None])
+def test_ranks_split_the_shards(export_path, seed):
+    expected = sorted(keys(iter_webdataset(export_path, shuffle=0, decode=False)))
+    assignments = []
+    for epoch in range(4):
+        per_rank = [keys(iter_webdataset(export_path, seed=seed, epoch=epoch, rank=rank, world_size=2, decode=False)) for rank in range(2)]
+        assert not set(per_rank[0]) & set(per_rank[1])
+        assert sorted(per_rank[0] + per_rank[1]) == expected
+        assignments.append(frozenset(per_rank[0]))
+    # Ranks get other shards on other epochs
+    assert len(set(assignments)) > 1
+
+
+def test_same_seed_and_epoch_give_the_same_order(export_path):
+    first = keys(iter_webdataset(export_path, shuffle=8, seed=3, epoch=1, decode=False))
+    assert first == keys(iter_webdataset(export_path, shuffle=8, seed=3, epoch=1, decode=False))
+    assert first != keys(iter_webdataset(export_path, shuffle=8, seed=3, epoch=2, decode=False))
+
+
+def test_more_readers_than_shards(export_path):
+    num_shards = len(load_index(export_path)["shards"])
+    with pytest.raises(ValueError, match="readers"):
+        next(iter_webdataset(export_path, rank=0, world_size=num_shards + 1))
@@ -0,0 +1,224 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from PIL import Image
+import hashlib
+import io
+import os
+import time
+
+class CaptionBackend(ABC):
+    """
+    A captioning backend: captions a batch of images, one prompt per image.
+
+    `generate_captions` reads the dataset `batch_size` examples at a time,
+    turns each stored image (bytes or file path) into the backend's input with
+    `prepare_image`, then calls `caption_batch`. A None caption marks a
+    failure, retried by `generate_captions` like any other. Subclasses must
+    implement `caption_batch`.
+    """
+
+    name = None
+    batch_size = 1
+
+    def prepare_image(self, image):
+        """
+        Turns a stored image (bytes or file path) into the input of `caption_batch`.
+        """
+        return image
+
+    def stored_prompt(self, prompt: str) -> str:
+        """
+        Returns the prompt recorded with a caption: the prompt itself, or an
+        empty string when the backend does not condition on it.
+        """
+        return prompt
+
+    @abstractmethod
+    def caption_batch(self, images: List, prompts: List[str], labels: Optional[List[str]] = None) -> List[Optional[str]]:
+        """
+        Captions a batch of images.
+
+        Args:
+            images (List): The images, as returned by `prepare_image`.
+            prompts (List[str]): The prompt of each image.
+            labels (List[str], optional): The label of each image.
+
+        Returns:
+            List[Optional[str]]: The caption of each image, None when it failed.
+        """
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class AzureBackend(CaptionBackend):
+    """
+    Captions images with Azure OpenAI GPT-4o, one `describe_image` request per
+    image, `concurrency` requests at a time. Stored bytes are sent without
+    being decoded when the API accepts them.
+
+    Args:
+        client (AzureOpenAI, optional): The client. Defaults to the shared client.
+        pool (DeploymentPool, optional): Routes the requests across deployments.
+        concurrency (int): Maximum number of requests in flight at once.
+        batch_size (int, optional): Images per batch. Defaults to `2 * concurrency`.
+        **describe_kwargs: Extra `describe_image` arguments (e.g., detail, cache, metrics).
+    """
+
+    name = "azure"
+
+    def __init__(self, client=None, pool=None, concurrency: int = 8, batch_size: Optional[int] = None, **describe_kwargs):
+        from utils.call_openai_api import get_client
+
+        self.client = client if client is not None or pool is not None else get_client(max_connections=max(concurrency, 20))
+        self.pool = pool
+        self.batch_size = batch_size or 2 * concurrency
+        self.describe_kwargs = describe_kwargs
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def _describe(self, image, prompt, label):
+        from utils.call_openai_api import describe_image
+
+        return describe_image(
+            prompt,
+            image=image,
+            label=label,
+            show_image=False,
+            client=self.client,
+            pool=self.pool,
+            **self.describe_kwargs
+        )
+
+    def caption_batch(self, images, prompts, labels=None):
+        labels = labels or [None] * len(images)
+        return list(self._executor.map(self._describe, images, prompts, labels))
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+class LocalBackend(CaptionBackend):
+    """
+    Captions images on the local CPU with an image-to-text model (e.g., BLIP)
+    from a local model directory, run with transformers or ONNX Runtime.
+
+    Each batch goes through the processor and `generate` as one tensor batch,
+    so the model's matrix products run on `threads` cores at once.
+
+    Args:
+        model_dir (str): Directory of the model and its processor
+            (`save_pretrained` output, or an optimum ONNX export for "onnx").
+        runtime (str): "transformers" (PyTorch) or "onnx" (ONNX Runtime, via optimum).
+        batch_size (int): Images per forward pass.
+        threads (int, optional): Intra-op threads. Defaults to the CPU count.
+        max_new_tokens (int): Maximum caption length, in tokens.
+        num_beams (int): Beam search width (1 is greedy decoding).
+        use_prompts (bool): Whether to condition the model on the prompts.
+            Small captioning models are trained without instructions, so the
+            prompts are ignored by default.
+    """
+
+    name = "local"
+
+    def __init__(
+        self,
+        model_dir: str,
+        runtime: str = "transformers",
+        batch_size: int = 8,
+        threads: Optional[int] = None,
+        max_new_tokens: int = 60,
+        num_beams: int = 1,
+        use_prompts: bool = False
+    ):
+        if runtime not in ("transformers", "onnx"):
+            raise ValueError(f"Unknown runtime '{runtime}'. Must be 'transformers' or 'onnx'.")
+        import torch
+        from transformers import AutoProcessor
+
+        threads = threads or os.cpu_count() or 1
+        torch.set_num_threads(threads)
+        self.batch_size = batch_size
+        self.max_new_tokens = max_new_tokens
+        self.num_beams = num_beams
+        self.use_prompts = use_prompts
+        self.processor = AutoProcessor.from_pretrained(model_dir)
+        if runtime == "onnx":
+            try:
+                import onnxruntime
+                from optimum.onnxruntime import ORTModelForVision2Seq
+            except ImportError as e:
+                raise ImportError("The 'onnx' runtime needs `pip install optimum[onnxruntime]`.") from e
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = threads
+            self.model = ORTModelForVision2Seq.from_pretrained(model_dir, session_options=options, provider="CPUExecutionProvider")
+        else:
+            from transformers import AutoModelForVision2Seq
+
+            self.model = AutoModelForVision2Seq.from_pretrained(model_dir).eval()
+
+    def prepare_image(self, image):
+        image = Image.open(image if isinstance(image, str) else io.BytesIO(image))
+        return image.convert("RGB")
+
+    def stored_prompt(self, prompt):
+        # Unconditional captions were not asked for with the GPT prompt
+        return prompt if self.use_prompts else ""
+
+    def caption_batch(self, images, prompts, labels=None):
+        import torch
+
+        text = prompts if self.use_prompts else None
+        inputs = self.processor(images=images, text=text, return_tensors="pt", padding=True)
+        with torch.inference_mode():
+            outputs = self.model.generate(**inputs, max_new_tokens=self.max_new_tokens, num_beams=self.num_beams)
+        captions = self.processor.batch_decode(outputs, skip_special_tokens=True)
+        if self.use_prompts:
+            # Conditional models echo the prompt before the caption
+            captions = [caption[len(prompt):] if caption.startswith(prompt) else caption for caption, prompt in zip(captions, prompts)]
+        return [caption.strip() or None for caption in captions]
+
+class FakeBackend(CaptionBackend):
+    """
+    Deterministic backend for tests and benchmarks: the caption of an image
+    depends only on its stored bytes, prompt and label. No model, no network.
+
+    Args:
+        batch_size (int): Images per batch.
+        latency (float): Seconds slept per batch, to stand in for a model.
+    """
+
+    name = "fake"
+
+    def __init__(self, batch_size: int = 32, latency: float = 0.0):
+        self.batch_size = batch_size
+        self.latency = latency
+
+    def caption_batch(self, images, prompts, labels=None):
+        if self.latency:
+            time.sleep(self.latency)
+        labels = labels or [None] * len(images)
+        captions = []
+        for image, prompt, label in zip(images, prompts, labels):
+            h = hashlib.sha256(image if isinstance(image, bytes) else str(image).encode())
+            h.update(prompt.encode("utf-8"))
+            captions.append(f"A photo of {label or 'an object'} ({h.hexdigest()[:12]}).")
+        return captions
+
+BACKENDS = {
+    "azure": AzureBackend,
+    "local": LocalBackend,
+    "fake": FakeBackend
+}
+
+def load_backend(name: str, **options) -> CaptionBackend:
+    """
+    Builds a captioning backend by name ("azure", "local" or "fake") with its options.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend '{name}'. Must be one of {list(BACKENDS)}.")
+    return BACKENDS[name](**options)
@@ -0,0 +1,267 @@
+import json
+import os
+import re
+from glob import escape, glob
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+# Azure OpenAI global batch limits are 100k requests and 200 MB per input file
+BATCH_MAX_REQUESTS = 100_000
+BATCH_MAX_BYTES = 190 * 1024 * 1024
+BATCH_ENDPOINT = "/chat/completions"
+# Azure serves the Files (purpose="batch") and Batches APIs from 2024-07-01-preview on
+BATCH_API_VERSION = "2024-10-21"
+
+def request_path(batch_dir: str, index: int) -> str:
+    """
+    Returns the path of the batch request file number `index`.
+    """
+    return os.path.join(batch_dir, f"requests-{index:05d}.jsonl")
+
+def result_path(batch_dir: str, index: int) -> str:
+    """
+    Returns the path of the results of the batch request file number `index`.
+    """
+    return os.path.join(batch_dir, f"results-{index:05d}.jsonl")
+
+def _file_index(path: str) -> int:
+    return int(re.search(r"-(\d+)\.jsonl$", path).group(1))
+
+def list_request_files(batch_dir: str) -> List[str]:
+    """
+    Lists the batch request files of a directory, in order.
+    """
+    return sorted(glob(os.path.join(escape(batch_dir), "requests-*.jsonl")), key=_file_index)
+
+def list_result_files(batch_dir: str) -> List[str]:
+    """
+    Lists the batch result files of a directory, in order.
+    """
+    return sorted(glob(os.path.join(escape(batch_dir), "results-*.jsonl")), key=_file_index)
+
+def batch_request(custom_id: str, messages: List[Dict], model: str, max_tokens: int) -> Dict:
+    """
+    Builds one line of a Batch API request file.
+
+    Args:
+        custom_id (str): Id used to match the result back (the dataset `id`).
+        messages (List[Dict]): The chat messages.
+        model (str): The batch deployment (Azure) or model (OpenAI) name.
+        max_tokens (int): The completion token limit.
+
+    Returns:
+        Dict: The request line.
+    """
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens
+        }
+    }
+
+def write_batch_requests(
+    requests: Iterable[Dict],
+    batch_dir: str,
+    max_requests: int = BATCH_MAX_REQUESTS,
+    max_bytes: int = BATCH_MAX_BYTES
+) -> List[str]:
+    """
+    Writes batch requests to JSONL files, starting a new file whenever the
+    request count or the file size would exceed the limits.
+
+    The `custom_id`s of every written file are recorded in `batches.json`, so
+    that later runs know which ids already have a request awaiting its result
+    (see `pending_ids`).
+
+    Args:
+        requests (Iterable[Dict]): Request lines from `batch_request`.
+        batch_dir (str): Directory to write `requests-XXXXX.jsonl` files to.
+            New files are numbered after the existing ones.
+        max_requests (int): Maximum number of requests per file.
+        max_bytes (int): Maximum size of each file, in bytes.
+
+    Returns:
+        List[str]: The paths of the written files.
+    """
+    os.makedirs(batch_dir, exist_ok=True)
+    existing = list_request_files(batch_dir)
+    index = _file_index(existing[-1]) + 1 if existing else 0
+
+    batches = _load_batches(batch_dir)
+    paths = []
+    f = None
+    count = size = 0
+    try:
+        for request in requests:
+            line = (json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8")
+            if len(line) > max_bytes:
+                raise ValueError(f"Batch request '{request['custom_id']}' is larger than {max_bytes} bytes.")
+            if f is None or count >= max_requests or size + len(line) > max_bytes:
+                if f is not None:
+                    f.close()
+                    index += 1
+                paths.append(request_path(batch_dir, index))
+                f = open(paths[-1], 'wb')
+                batches[os.path.basename(paths[-1])] = {"custom_ids": []}
+                count = size = 0
+            f.write(line)
+            batches[os.path.basename(paths[-1])]["custom_ids"].append(request["custom_id"])
+            count += 1
+            size += len(line)
+    finally:
+        if f is not None:
+            f.close()
+        if paths:
+            _save_batches(batch_dir, batches)
+    return paths
+
+def iter_batch_results(result_files: List[str]) -> Iterator[Tuple[str, Optional[str], Optional[str]]]:
+    """
+    Reads Batch API result files.
+
+    Args:
+        result_files (List[str]): Paths of result (or error) JSONL files.
+
+    Yields:
+        Tuple[str, Optional[str], Optional[str]]: The `custom_id`, the caption
+        (None if the request failed) and the error message (None on success).
+    """
+    for path in result_files:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                custom_id = result["custom_id"]
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    error = result.get("error") or response.get("body", {}).get("error")
+                    yield custom_id, None, json.dumps(error, ensure_ascii=False)
+                    continue
+                caption = response["body"]["choices"][0]["message"]["content"]
+                yield custom_id, caption, None
+
+def _load_batches(batch_dir: str) -> Dict[str, Dict]:
+    path = os.path.join(batch_dir, "batches.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _save_batches(batch_dir: str, batches: Dict[str, Dict]) -> None:
+    path = os.path.join(batch_dir, "batches.json")
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(batches, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+def _request_ids(path: str) -> List[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line)["custom_id"] for line in f if line.strip()]
+
+def pending_ids(batch_dir: str) -> Set[str]:
+    """
+    Returns the `custom_id`s written to request files whose results have not
+    been ingested yet: written, submitted or running requests that a new
+    batch run should not request again.
+
+    Args:
+        batch_dir (str): Directory with the request files and `batches.json`.
+
+    Returns:
+        Set[str]: The pending ids.
+    """
+    batches = _load_batches(batch_dir)
+    pending = set()
+    for path in list_request_files(batch_dir):
+        info = batches.get(os.path.basename(path), {})
+        if info.get("ingested"):
+            continue
+        # Files written before ids were recorded are read back
+        pending.update(info["custom_ids"] if "custom_ids" in info else _request_ids(path))
+    return pending
+
+def mark_ingested(batch_dir: str, result_files: List[str]) -> None:
+    """
+    Records that the results of the given result files were ingested, so that
+    their failed ids can be requested again.
+    """
+    batches = _load_batches(batch_dir)
+    for path in result_files:
+        name = os.path.basename(request_path(batch_dir, _file_index(path)))
+        batches.setdefault(name, {})["ingested"] = True
+    _save_batches(batch_dir, batches)
+
+def submit_batches(client, batch_dir: str, completion_window: str = "24h") -> List[str]:
+    """
+    Uploads the request files of a directory and creates one batch job per file.
+
+    Files already submitted (with a batch id in `batches.json`) are never
+    submitted again, so this can be called again after an interruption.
+
+    Args:
+        client (AzureOpenAI): The client, e.g. from
+            `get_client(api_version=BATCH_API_VERSION)`.
+        batch_dir (str): Directory with the request files.
+        completion_window (str): The batch completion window.
+
+    Returns:
+        List[str]: The ids of the batches created by this call.
+    """
+    batches = _load_batches(batch_dir)
+    created = []
+    for path in list_request_files(batch_dir):
+        name = os.path.basename(path)
+        if batches.get(name, {}).get("batch_id"):
+            continue
+        with open(path, 'rb') as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=completion_window
+        )
+        batches[name] = {**batches.get(name, {}), "batch_id": batch.id, "status": batch.status}
+        _save_batches(batch_dir, batches)
+        created.append(batch.id)
+    return created
+
+def download_batch_results(client, batch_dir: str) -> List[str]:
+    """
+    Downloads the results of the finished batch jobs of a directory.
+
+    Results and per-request errors of request file `requests-XXXXX.jsonl` are
+    written to `results-XXXXX.jsonl`. Batches that are still running are left
+    for a later call; requests missing from a result file are simply captioned
+    again by the next run.
+
+    Args:
+        client (AzureOpenAI): The client, e.g. from
+            `get_client(api_version=BATCH_API_VERSION)`.
+        batch_dir (str): Directory with the request files and `batches.json`.
+
+    Returns:
+        List[str]: The result files written by this call.
+    """
+    batches = _load_batches(batch_dir)
+    written = []
+    for name, info in batches.items():
+        out_path = result_path(batch_dir, _file_index(name))
+        if "batch_id" not in info or os.path.exists(out_path):
+            continue
+        batch = client.batches.retrieve(info["batch_id"])
+        info["status"] = batch.status
+        # Expired and cancelled batches still return the requests they finished
+        if batch.status not in ("completed", "expired", "cancelled"):
+            continue
+        with open(f"{out_path}.tmp", 'wb') as f:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    content = client.files.content(file_id).read()
+                    f.write(content if content.endswith(b"\n") or not content else content + b"\n")
+        os.replace(f"{out_path}.tmp", out_path)
+        written.append(out_path)
+    _save_batches(batch_dir, batches)
+    return written
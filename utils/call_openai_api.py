@@ -1,21 +1,502 @@
 from PIL import Image
-from openai import AzureOpenAI
-import matplotlib.pyplot as plt
-from dotenv import load_dotenv
+from loguru import logger
 import os
-import requests
+import threading
+import time
 
-from utils.image import image_to_base64
+from utils.image import image_to_base64, raw_image_base64
+from utils.caption_cache import make_key
+from utils.metrics import stage, track_http_attempts, on_http_request, on_http_response
+from utils.rate_limit import get_rate_limiter, parse_retry_after
 
-# Load environment variables from .env file
-load_dotenv()
+# openai, httpx, python-dotenv, requests and matplotlib are imported on first
+# use, so that importing this module is cheap and has no side effects.
 
-# Set the API key from the environment variable
-API_KEY = os.getenv("AZURE_OPENAI_KEY")
-if API_KEY is None:
-    raise ValueError("API key not found. Please set the AZURE_OPENAI_API_KEY environment variable.")
+API_VERSION = "2024-05-01-preview"
+# JSON-schema response formats (packed requests) need a later API version
+STRUCTURED_API_VERSION = "2024-08-01-preview"
+DEFAULT_AZURE_ENDPOINT = "https://instancehackatonpionners01.openai.azure.com"
+DEFAULT_AZURE_DEPLOYMENT = "gpt-4o-pionners27"
 
-def describe_image(prompt, *, image=None, image_format="JPEG", image_url=None, label=None, show_image=True):
+MODEL = "gpt-4o"
+MAX_TOKENS = 100
+SYSTEM_PROMPT = "You are an AI that describes images accurately."
+# Completion tokens of each image of a packed request, JSON syntax included
+PACKED_TOKENS_PER_IMAGE = MAX_TOKENS + 20
+
+_env_loaded = False
+
+def load_env():
+    """
+    Loads environment variables from the .env file, once per process.
+    """
+    global _env_loaded
+    if not _env_loaded:
+        from dotenv import load_dotenv
+        load_dotenv()
+        _env_loaded = True
+
+def get_api_key():
+    """
+    Returns the API key from the AZURE_OPENAI_KEY environment variable.
+    """
+    load_env()
+    api_key = os.getenv("AZURE_OPENAI_KEY")
+    if api_key is None:
+        raise ValueError("API key not found. Please set the AZURE_OPENAI_KEY environment variable.")
+    return api_key
+
+def get_endpoint():
+    """
+    Returns the default endpoint, from the AZURE_OPENAI_ENDPOINT environment variable.
+    """
+    load_env()
+    return os.getenv("AZURE_OPENAI_ENDPOINT", DEFAULT_AZURE_ENDPOINT)
+
+def get_deployment():
+    """
+    Returns the default deployment, from the AZURE_OPENAI_DEPLOYMENT environment variable.
+    """
+    load_env()
+    return os.getenv("AZURE_OPENAI_DEPLOYMENT", DEFAULT_AZURE_DEPLOYMENT)
+
+def __getattr__(name):
+    # Settings that used to be read at import time, now resolved on access
+    getters = {"API_KEY": get_api_key, "AZURE_ENDPOINT": get_endpoint, "AZURE_DEPLOYMENT": get_deployment}
+    if name in getters:
+        return getters[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Shared clients, keyed by process id and settings
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(
+    *,
+    azure_endpoint=None,
+    azure_deployment=None,
+    api_version=API_VERSION,
+    max_connections=20,
+    max_keepalive_connections=None,
+    keepalive_expiry=30.0,
+    timeout=60.0,
+    connect_timeout=10.0,
+    max_retries=0,
+    rpm=None,
+    tpm=None,
+    api_key=None
+):
+    """
+    Returns the shared Azure OpenAI client for the given settings.
+
+    The client is created on first use and then reused by every call in the
+    process, so HTTP connections (and their TLS sessions) are kept alive
+    across requests. It is safe to share across threads. A forked child
+    process gets its own client instead of reusing the parent's sockets.
+
+    Every request of the client, retries included, goes through the rate
+    limiter shared by all clients of the deployment in the process (see
+    `utils.rate_limit`), available as `client.rate_limiter`.
+
+    Args:
+        azure_endpoint (str, optional): The Azure OpenAI endpoint. Defaults to
+            the AZURE_OPENAI_ENDPOINT environment variable.
+        azure_deployment (str, optional): The model deployment name. Defaults
+            to the AZURE_OPENAI_DEPLOYMENT environment variable.
+        api_version (str): The Azure OpenAI API version.
+        max_connections (int): Maximum number of open connections. Should be at
+            least the number of concurrent callers.
+        max_keepalive_connections (int, optional): Maximum number of idle
+            connections kept alive. Defaults to `max_connections`.
+        keepalive_expiry (float): Seconds an idle connection is kept alive.
+        timeout (float): Overall request timeout in seconds.
+        connect_timeout (float): Connection timeout in seconds.
+        max_retries (int): Retries done by the SDK itself. Defaults to 0, as
+            `describe_image` already retries rate-limited, failed and
+            unreachable attempts after the rate limiter's backoff; SDK
+            retries on top of that would multiply the attempts.
+        rpm (float, optional): Requests per minute quota of the deployment.
+            Defaults to the AZURE_OPENAI_RPM environment variable.
+        tpm (float, optional): Tokens per minute quota of the deployment.
+            Defaults to the AZURE_OPENAI_TPM environment variable.
+        api_key (str, optional): The API key of the endpoint. Defaults to AZURE_OPENAI_KEY.
+
+    Returns:
+        AzureOpenAI: The shared client.
+    """
+    if max_keepalive_connections is None:
+        max_keepalive_connections = max_connections
+    if azure_endpoint is None:
+        azure_endpoint = get_endpoint()
+    if azure_deployment is None:
+        azure_deployment = get_deployment()
+    if api_key is None:
+        api_key = get_api_key()
+    key = (
+        os.getpid(), azure_endpoint, azure_deployment, api_version, max_connections,
+        max_keepalive_connections, keepalive_expiry, timeout, connect_timeout, max_retries, api_key
+    )
+    rate_limiter = get_rate_limiter(azure_endpoint, azure_deployment, rpm=rpm, tpm=tpm)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            from openai import AzureOpenAI
+            import httpx
+
+            http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_keepalive_connections,
+                    keepalive_expiry=keepalive_expiry
+                ),
+                timeout=httpx.Timeout(timeout, connect=connect_timeout),
+                # Time to first byte and retries of each request, see `describe_image(metrics=...)`
+                event_hooks={
+                    "request": [rate_limiter.before_request, on_http_request],
+                    "response": [on_http_response, rate_limiter.after_response]
+                }
+            )
+            client = AzureOpenAI(
+                api_key=api_key,
+                api_version=api_version,
+                azure_endpoint=azure_endpoint,
+                azure_deployment=azure_deployment,
+                max_retries=max_retries,
+                http_client=http_client
+            )
+            client.rate_limiter = rate_limiter
+            _clients[key] = client
+    return client
+
+def close_clients():
+    """
+    Closes every shared client created by this process.
+    """
+    with _clients_lock:
+        for key, client in list(_clients.items()):
+            if key[0] == os.getpid():
+                client.close()
+            del _clients[key]
+
+def build_image_payload(image=None, image_url=None, image_format="JPEG", detail="auto", max_image_bytes=None, payload_cache_dir=None, passthrough=True):
+    """
+    Builds the `image_url` content part of a chat request.
+
+    Stored image bytes (or a file path) in a format the API accepts, already
+    within the size the model sees and `max_image_bytes`, are sent as they
+    are, without being decoded and re-encoded (see `raw_image_base64`).
+
+    Args:
+        image (PIL.Image.Image, bytes or str, optional): A local image, sent as a base64 data URL.
+        image_url (str, optional): A direct URL to an image hosted online.
+        image_format (str, optional): The format the local image is encoded in.
+        detail (str, optional): The `detail` level of the image.
+        max_image_bytes (int, optional): Size budget for the encoded image.
+        payload_cache_dir (str, optional): Directory caching encoded images.
+        passthrough (bool, optional): Whether stored bytes may be sent without
+            transcoding. Defaults to True.
+
+    Returns:
+        dict: The image content part.
+    """
+    if image_url is not None:
+        # Case 1: Image provided via URL
+        return {
+            "type": "image_url",
+            "image_url": {"url": image_url, "detail": detail}
+        }
+    elif image is not None:
+        # Case 2: Stored bytes the API accepts as they are
+        raw = None
+        if passthrough and isinstance(image, (bytes, str)):
+            raw = raw_image_base64(image, detail=detail, max_bytes=max_image_bytes)
+        if raw is not None:
+            base64_str, mime_type = raw
+            return {
+                "type": "image_url",
+                "image_url": {"url": f"data:{mime_type};base64,{base64_str}", "detail": detail}
+            }
+        # Case 3: Local image, resized and converted to base64
+        base64_str = image_to_base64(
+            image,
+            format=image_format,
+            detail=detail,
+            max_bytes=max_image_bytes,
+            cache_dir=payload_cache_dir
+        )
+        mime_type = f"image/{image_format.lower()}"
+        return {
+            "type": "image_url",
+            "image_url": {"url": f"data:{mime_type};base64,{base64_str}", "detail": detail}
+        }
+    else:
+        raise ValueError("Either `image` or `image_url` must be provided.")
+
+def build_messages(prompt, image_payload, label=None):
+    """
+    Builds the chat messages sent for one image.
+
+    Args:
+        prompt (str): The prompt to send to the model.
+        image_payload (dict): The image content part from `build_image_payload`.
+        label (str, optional): A label for the image, appended to the prompt.
+
+    Returns:
+        list: The chat messages.
+    """
+    if label is not None:
+        prompt = f"{prompt} The label of the image is {label}."
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": [
+            {"type": "text", "text": prompt},
+            image_payload
+        ]}
+    ]
+
+def cache_key(image_payload, text, client=None, pool=None, **extra):
+    """
+    Builds the caption cache key of a request for one image.
+
+    The model and API version are those of the client, or of the pool
+    deployments (see `DeploymentPool.api_version`), since both change the answer.
+
+    Args:
+        image_payload (dict): The image content part from `build_image_payload`.
+        text (str): The user prompt sent with the image.
+        client (AzureOpenAI, optional): The client sending the request.
+        pool (DeploymentPool, optional): The pool sending the request instead.
+        **extra: Other request settings that change the answer (e.g., detail, packed).
+
+    Returns:
+        str: The cache key, from `make_key`.
+    """
+    if pool is not None:
+        model, api_version = pool.model, pool.api_version
+    else:
+        model = getattr(client, "_azure_deployment", None) or MODEL
+        api_version = getattr(client, "_api_version", API_VERSION)
+    return make_key(image_payload["image_url"]["url"], text, model, MAX_TOKENS, api_version, system=SYSTEM_PROMPT, **extra)
+
+def build_packed_messages(prompt, image_payloads, label=None):
+    """
+    Builds the chat messages of a packed request: the instructions once, then
+    every image preceded by its id.
+
+    Args:
+        prompt (str): The prompt shared by every image.
+        image_payloads (Dict[str, dict]): The image content parts by id.
+        label (str, optional): The label shared by every image.
+
+    Returns:
+        list: The chat messages.
+    """
+    if label is not None:
+        prompt = f"{prompt} The label of every image is {label}."
+    instructions = (
+        f"{prompt}\n\nThere are {len(image_payloads)} images below, each preceded by its id. "
+        "Describe each image separately, following the instructions above for every one of them. "
+        "Answer with a JSON object mapping every id to the description of its image."
+    )
+    content = [{"type": "text", "text": instructions}]
+    for id, image_payload in image_payloads.items():
+        content.append({"type": "text", "text": f"id: {id}"})
+        content.append(image_payload)
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": content}
+    ]
+
+def packed_response_format(ids):
+    """
+    Returns the JSON-schema response format of a packed request: an object
+    with one required string property per id.
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "captions",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {id: {"type": "string"} for id in ids},
+                "required": list(ids),
+                "additionalProperties": False
+            }
+        }
+    }
+
+def supports_structured_outputs(api_version):
+    """
+    Returns whether an API version accepts JSON-schema response formats, i.e.
+    whether it dates from `STRUCTURED_API_VERSION` or later.
+    """
+    return api_version[:10] >= STRUCTURED_API_VERSION[:10]
+
+def check_packing_support(client=None, pool=None):
+    """
+    Raises a ValueError unless the client (or every pool deployment) uses an
+    API version that accepts packed requests, which older versions reject
+    with a 400 on every request.
+    """
+    if pool is not None:
+        outdated = [f"{d.name} ({d.api_version})" for d in pool.deployments if not supports_structured_outputs(d.api_version)]
+    else:
+        version = getattr(client, "_api_version", None)
+        outdated = [f"the client ({version})"] if version is not None and not supports_structured_outputs(version) else []
+    if outdated:
+        raise ValueError(
+            f"Packed requests need API version {STRUCTURED_API_VERSION} or later, "
+            f"but {', '.join(outdated)} use an older one. Set pack_size=1 or upgrade the API version."
+        )
+
+def parse_packed_response(content, ids):
+    """
+    Validates the answer of a packed request.
+
+    Returns:
+        Dict[str, str]: The non-empty captions of the expected ids. Ids that
+        are missing, empty or not strings are left out, as is everything when
+        the answer is not a JSON object (e.g., truncated by `max_tokens`).
+    """
+    import json
+
+    try:
+        captions = json.loads(content) if content else None
+    except ValueError:
+        return {}
+    if not isinstance(captions, dict):
+        return {}
+    return {
+        id: captions[id].strip() for id in ids
+        if isinstance(captions.get(id), str) and captions[id].strip()
+    }
+
+def describe_images(
+    prompt,
+    images,
+    *,
+    label=None,
+    image_format="JPEG",
+    client=None,
+    pool=None,
+    detail="auto",
+    max_image_bytes=None,
+    payload_cache_dir=None,
+    cache=None,
+    metrics=None,
+    raise_errors=False
+):
+    """
+    Describes several images sharing a prompt and label in one packed request.
+
+    The instructions are sent once for all the images, and the model answers
+    with a JSON object (enforced by a JSON schema) mapping each id to its
+    caption. Ids the answer lacks or gets wrong are returned as None, for the
+    caller to retry them with `describe_image`. The client (or the pool
+    deployments) must use `STRUCTURED_API_VERSION` or later; older versions
+    raise a ValueError (see `check_packing_support`).
+
+    Captions are cached per image, under keys flagged `packed=True`: a
+    packed answer is written for several images at once, so it never stands in
+    for a single-image one, nor the other way around.
+
+    Args:
+        prompt (str): The prompt shared by every image.
+        images (Dict[str, Any]): The images by id: PIL images, or image
+            content parts already built with `build_image_payload`.
+        label (str, optional): The label shared by every image.
+        Other arguments: As for `describe_image`.
+
+    Returns:
+        Dict[str, Optional[str]]: The caption of each id, None when missing.
+    """
+    if client is None and pool is None:
+        client = get_client(api_version=STRUCTURED_API_VERSION)
+    check_packing_support(client, pool)
+
+    start = time.perf_counter()
+    event = {"cached": False, "error": None, "images": len(images)}
+    captions = dict.fromkeys(images)
+    try:
+        with stage(metrics, "encode"):
+            image_payloads = {
+                id: image if isinstance(image, dict) else build_image_payload(
+                    image=image,
+                    image_format=image_format,
+                    detail=detail,
+                    max_image_bytes=max_image_bytes,
+                    payload_cache_dir=payload_cache_dir
+                )
+                for id, image in images.items()
+            }
+
+        # Look every image up in the response cache
+        cache_keys = {}
+        if cache is not None:
+            text = build_messages(prompt, None, label=label)[1]["content"][0]["text"]
+            for id, image_payload in image_payloads.items():
+                cache_keys[id] = cache_key(image_payload, text, client, pool, detail=detail, packed=True)
+                captions[id] = cache.get(cache_keys[id])
+        todo = [id for id, caption in captions.items() if caption is None]
+        event["cached"] = not todo
+        if not todo:
+            return captions
+
+        # Send the missing images in one request
+        messages = build_packed_messages(prompt, {id: image_payloads[id] for id in todo}, label=label)
+        request_kwargs = dict(
+            max_tokens=PACKED_TOKENS_PER_IMAGE * len(todo),
+            response_format=packed_response_format(todo)
+        )
+        with stage(metrics, "network"), track_http_attempts() as attempts:
+            try:
+                if pool is not None:
+                    response = pool.complete(messages, model=MODEL, **request_kwargs)
+                else:
+                    response = _create_with_backoff(client, messages, **request_kwargs)
+            finally:
+                _add_attempts(event, attempts)
+        _add_usage(event, response.usage)
+
+        answered = parse_packed_response(response.choices[0].message.content, todo)
+        event["missing"] = len(todo) - len(answered)
+        for id, caption in answered.items():
+            captions[id] = caption
+            if cache is not None:
+                cache.put(cache_keys[id], caption)
+        return captions
+
+    except Exception as e:
+        event["error"] = type(e).__name__
+        if raise_errors:
+            raise
+        logger.error(f"❌ Packed description of {len(images)} images failed: {type(e).__name__}: {e}")
+        return captions
+
+    finally:
+        if metrics is not None:
+            event["latency"] = time.perf_counter() - start
+            metrics.record_request(event)
+
+def describe_image(
+    prompt,
+    *,
+    image=None,
+    image_format="JPEG",
+    image_url=None,
+    label=None,
+    show_image=True,
+    client=None,
+    detail="auto",
+    max_image_bytes=None,
+    payload_cache_dir=None,
+    cache=None,
+    metrics=None,
+    pool=None,
+    image_payload=None,
+    raise_errors=False
+):
     """
     Sends a request to Azure OpenAI's GPT-4o model with a prompt and an image.
 
@@ -32,59 +513,83 @@ def describe_image(prompt, *, image=None, image_format="JPEG", image_url=None, l
         label (str, optional): A label for the image.
         show_image (bool, optional): Whether to display the image using matplotlib.
             Defaults to True. If False, the image will not be displayed.
+        client (AzureOpenAI, optional): The client to use. Defaults to the
+            shared client returned by `get_client()`.
+        detail (str, optional): The `detail` level of the image ("low", "high"
+            or "auto"). Local images are resized to what the model sees at
+            that level before upload. Defaults to "auto".
+        max_image_bytes (int, optional): Size budget for the encoded image.
+        payload_cache_dir (str, optional): Directory caching encoded images,
+            keyed by image content.
+        cache (CaptionCache, optional): Response cache consulted before any
+            network call, keyed by image content and request settings.
+        metrics (Metrics, optional): Receives the request latency, time to
+            first byte, payload bytes, token usage, retries and error class,
+            and the "encode" and "network" stage timings.
+        pool (DeploymentPool, optional): Routes the request across several
+            deployments with failover (see `utils.deployments`). Takes
+            precedence over `client`.
+        image_payload (dict, optional): The image content part, already built
+            with `build_image_payload` (e.g., in another process). Replaces
+            `image` and `image_url`; `detail` should match the one it was built with.
+        raise_errors (bool, optional): Whether to raise errors instead of
+            printing them and returning None. Defaults to False.
 
     Returns:
         str or None: The model's response (image description), or None if an error occurred.
     """
-    client = AzureOpenAI(
-        api_key=API_KEY,
-        api_version="2024-05-01-preview",
-        azure_endpoint="https://instancehackatonpionners01.openai.azure.com",
-        azure_deployment="gpt-4o-pionners27"
-    )
+    if client is None and pool is None:
+        client = get_client()
 
+    start = time.perf_counter()
+    event = {"cached": False, "error": None}
     try:
-        if label is not None:
-            prompt = f"{prompt} The label of the image is {label}."
-        # Build the image payload
-        if image_url is not None:
-            # Case 1: Image provided via URL
-            image_payload = {
-                "type": "image_url",
-                "image_url": {"url": image_url}
-            }
-        elif image is not None:
-            # Case 2: Local image provided via PIL, convert to base64
-            base64_str = image_to_base64(image, format=image_format)
-            mime_type = f"image/{image_format.lower()}"
-            image_payload = {
-                "type": "image_url",
-                "image_url": {"url": f"data:{mime_type};base64,{base64_str}"}
-            }
-       
-        else:
-            raise ValueError("Either `image` or `image_url` must be provided.")
-
-        # Send the request to the API
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are an AI that describes images accurately."},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt},
-                    image_payload
-                ]}
-            ],
-            max_tokens=100
-        )
-        
-        description = response.choices[0].message.content
+        # Build the request
+        if image_payload is None:
+            with stage(metrics, "encode"):
+                image_payload = build_image_payload(
+                    image=image,
+                    image_url=image_url,
+                    image_format=image_format,
+                    detail=detail,
+                    max_image_bytes=max_image_bytes,
+                    payload_cache_dir=payload_cache_dir
+                )
+        messages = build_messages(prompt, image_payload, label=label)
+
+        # Look the request up in the response cache
+        key = None
+        description = None
+        if cache is not None:
+            key = cache_key(image_payload, messages[1]["content"][0]["text"], client, pool, detail=detail)
+            description = cache.get(key)
+            event["cached"] = description is not None
+
+        if description is None:
+            # Send the request to the API
+            with stage(metrics, "network"), track_http_attempts() as attempts:
+                try:
+                    if pool is not None:
+                        response = pool.complete(messages, model=MODEL, max_tokens=MAX_TOKENS)
+                    else:
+                        response = _create_with_backoff(client, messages)
+                finally:
+                    _add_attempts(event, attempts)
+            _add_usage(event, response.usage)
+
+            description = response.choices[0].message.content
+            if cache is not None and description is not None:
+                cache.put(key, description)
         
         # Display the image if requested
-        if show_image:
+        if show_image and (image is not None or image_url is not None):
+            import matplotlib.pyplot as plt
+
             if image is not None:
                 plt.imshow(image)
             else:
+                import requests
+
                 img = Image.open(requests.get(image_url, stream=True).raw)
                 plt.imshow(img)
             plt.axis('off')
@@ -94,8 +599,68 @@ def describe_image(prompt, *, image=None, image_format="JPEG", image_url=None, l
         return description
 
     except Exception as e:
-        print(f"Error: {e}")
+        event["error"] = type(e).__name__
+        if raise_errors:
+            raise
+        logger.error(f"❌ Image description failed: {type(e).__name__}: {e}")
         return None
+
+    finally:
+        if metrics is not None:
+            event["latency"] = time.perf_counter() - start
+            metrics.record_request(event)
+
+def _create_with_backoff(client, messages, max_tokens=MAX_TOKENS, **request_kwargs):
+    """
+    Sends a chat request, retrying rate-limited (429), failed (5xx) and
+    unreachable attempts after the client's rate limiter backoff, so that a
+    429 storm slows the run down instead of failing its captions. This is
+    the only retry layer: clients from `get_client` do no SDK retries.
+    Extra keyword arguments (e.g., `response_format`) are passed to the request.
+    """
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+
+    rate_limiter = getattr(client, "rate_limiter", None)
+    attempt = 0
+    while True:
+        try:
+            return client.chat.completions.create(
+                model=MODEL,
+                messages=messages,
+                max_tokens=max_tokens,
+                **request_kwargs
+            )
+        except (RateLimitError, InternalServerError, APIConnectionError) as e:
+            attempt += 1
+            # Clients built elsewhere keep their own SDK retries
+            if rate_limiter is None or attempt > rate_limiter.max_retries:
+                raise
+            retry_after = parse_retry_after(e.response.headers) if isinstance(e, RateLimitError) else None
+            time.sleep(rate_limiter.backoff(attempt, retry_after))
+
+def _add_attempts(event, attempts):
+    """
+    Adds the HTTP attempts of a request (retries, statuses, first byte, payload) to its metrics event.
+    """
+    event["attempts"] = len(attempts)
+    event["statuses"] = [attempt["status"] for attempt in attempts if attempt["status"] is not None]
+    ttfbs = [attempt["ttfb"] for attempt in attempts if attempt["ttfb"] is not None]
+    event["ttfb"] = ttfbs[-1] if ttfbs else None
+    event["payload_bytes"] = attempts[-1]["request_bytes"] if attempts else None
+
+def _add_usage(event, usage):
+    """
+    Adds the token usage of a response to its metrics event.
+    """
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    event["usage"] = {
+        "prompt": usage.prompt_tokens,
+        "completion": usage.completion_tokens,
+        "cached": getattr(details, "cached_tokens", None),
+        "image": getattr(details, "image_tokens", None)
+    }
     
 if __name__ == '__main__':
     # Example usage
@@ -0,0 +1,178 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+DEFAULT_CACHE_PATH = "data/cache/captions.sqlite"
+
+def make_key(image: str, prompt: str, model: str, max_tokens: int, api_version: str, **extra) -> str:
+    """
+    Builds the content-addressed key of a caption request.
+
+    The key only depends on what is sent to the model, never on dataset ids,
+    so identical images keep hitting the cache after a dataset rebuild.
+
+    Args:
+        image (str): The image sent to the model (data URL or image URL).
+        prompt (str): The full user prompt.
+        model (str): The model or deployment name.
+        max_tokens (int): The completion token limit.
+        api_version (str): The API version.
+        **extra: Any other request setting that changes the response (e.g., detail).
+
+    Returns:
+        str: The hex SHA-256 key.
+    """
+    h = hashlib.sha256()
+    for part in (image, prompt, model, str(max_tokens), api_version):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    for name in sorted(extra):
+        h.update(f"{name}={extra[name]}".encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+class CaptionCache:
+    """
+    Persistent SQLite cache of caption responses, keyed by `make_key`.
+
+    The cache can be shared by every thread of a process and by several
+    processes. When `max_bytes` is set, the least recently used captions are
+    evicted once the stored captions exceed it. The size of the stored
+    captions is kept as a running total next to them, updated in the same
+    transaction as every insert and eviction, so checking the budget costs
+    one row read per put.
+
+    Args:
+        path (str): Path of the SQLite database file.
+        max_bytes (int, optional): Size budget of the stored captions, in bytes.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: Optional[int] = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS captions ("
+            "key TEXT PRIMARY KEY, caption TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS captions_last_access ON captions (last_access)")
+        # Running total of the caption sizes, seeded once for caches created without it
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO cache_size (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM captions")
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the cached caption for `key`, or None on a miss.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT caption FROM captions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE captions SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key: str, caption: str) -> None:
+        """
+        Stores a caption, then evicts old entries if the cache is over budget.
+        """
+        now = time.time()
+        size = len(caption.encode("utf-8"))
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT size FROM captions WHERE key = ?", (key,)).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO captions (key, caption, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, caption, size, now, now)
+                )
+                self._conn.execute("UPDATE cache_size SET total = total + ? WHERE id = 0", (size - (row[0] if row else 0),))
+                if self.max_bytes is not None:
+                    self._evict(self.max_bytes)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def total_bytes(self) -> int:
+        """
+        Returns the size of the stored captions, in bytes.
+        """
+        with self._lock:
+            return self._total()
+
+    def _total(self) -> int:
+        return self._conn.execute("SELECT total FROM cache_size WHERE id = 0").fetchone()[0]
+
+    def _evict(self, max_bytes: int) -> int:
+        total = self._total()
+        if total <= max_bytes:
+            return 0
+        # Evict down to 90% of the budget so that eviction does not run on every put
+        excess = total - int(max_bytes * 0.9)
+        keys = []
+        freed = 0
+        for key, size in self._conn.execute("SELECT key, size FROM captions ORDER BY last_access"):
+            if freed >= excess:
+                break
+            keys.append((key,))
+            freed += size
+        self._conn.executemany("DELETE FROM captions WHERE key = ?", keys)
+        self._conn.execute("UPDATE cache_size SET total = total - ? WHERE id = 0", (freed,))
+        return len(keys)
+
+    def evict(self, max_bytes: Optional[int] = None) -> int:
+        """
+        Evicts the least recently used captions until the cache fits `max_bytes`
+        (defaults to the cache budget).
+
+        Returns:
+            int: The number of evicted entries.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return 0
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                evicted = self._evict(max_bytes)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            return evicted
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns hit/miss counters of this session and the size of the cache.
+        """
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+            size = self._total()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "size_bytes": size
+        }
+
+    def close(self) -> None:
+        """
+        Closes the database connection.
+        """
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,213 @@
+import heapq
+import json
+import os
+import re
+import shutil
+import tempfile
+from glob import escape, glob
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+FSYNC_POLICIES = ("always", "batch", "never")
+
+def segment_path(output_path: str, index: int) -> str:
+    """
+    Returns the path of the caption log segment number `index`.
+    """
+    return f"{output_path}.part{index}.jsonl"
+
+def _segment_index(path: str) -> int:
+    match = re.search(r"\.part(\d+)\.jsonl?$", path)
+    return int(match.group(1)) if match else -1
+
+def list_segments(output_path: str) -> List[str]:
+    """
+    Lists the caption log segments of an output path, in numeric order.
+
+    Legacy `.part{N}.json` part files are listed as well, so that captions
+    written by older runs are still merged.
+
+    Args:
+        output_path (str): The base path the segments were written for.
+
+    Returns:
+        List[str]: The segment paths, `part2` before `part10`.
+    """
+    paths = glob(f"{escape(output_path)}.part*.jsonl") + glob(f"{escape(output_path)}.part*.json")
+    return sorted((p for p in paths if _segment_index(p) >= 0), key=lambda p: (_segment_index(p), p))
+
+def next_segment_index(output_path: str) -> int:
+    """
+    Returns the index of the next segment to create for an output path.
+    """
+    segments = list_segments(output_path)
+    return _segment_index(segments[-1]) + 1 if segments else 0
+
+class CaptionWriter:
+    """
+    Append-only JSONL writer for caption records.
+
+    Every record is flushed as soon as it is written, so a crash loses at most
+    the records still in flight. The fsync policy controls durability against
+    power loss: "always" syncs every record, "batch" every `fsync_every`
+    records and on close, "never" leaves it to the OS.
+
+    Args:
+        path (str): Path of the segment to append to.
+        fsync (str): One of "always", "batch" or "never".
+        fsync_every (int): Records between syncs with the "batch" policy.
+    """
+
+    def __init__(self, path: str, fsync: str = "batch", fsync_every: int = 100):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync}'. Must be one of {FSYNC_POLICIES}.")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.fsync = fsync
+        self.fsync_every = fsync_every
+        self.count = 0
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, record: Dict) -> None:
+        """
+        Appends one record and flushes it.
+        """
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self.count += 1
+        if self.fsync == "always" or (self.fsync == "batch" and self.count % self.fsync_every == 0):
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        """
+        Syncs (unless the policy is "never") and closes the segment.
+        """
+        if self._file.closed:
+            return
+        self._file.flush()
+        if self.fsync != "never":
+            os.fsync(self._file.fileno())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def iter_segment(path: str) -> Iterator[Dict]:
+    """
+    Yields the caption records of a segment, one line at a time.
+
+    A truncated last line, left by a crash in the middle of a write, is skipped.
+    Legacy `.json` part files are loaded whole.
+    """
+    if path.endswith(".json"):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for record in data.get("captions", []):
+            record.setdefault("prompt", data.get("prompt"))
+            yield record
+        return
+
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            yield json.loads(line)
+
+def id_key(id: str) -> Tuple:
+    """
+    Natural sort key of a dataset id, so that `img_9` sorts before `img_10`.
+    """
+    return tuple(int(part) if part.isdigit() else part for part in re.split(r"(\d+)", id))
+
+def is_id_ordered(path: str) -> bool:
+    """
+    Whether a segment's records are in id order, read in one streaming pass.
+    """
+    previous = None
+    for record in iter_segment(path):
+        key = id_key(record["id"])
+        if previous is not None and key < previous:
+            return False
+        previous = key
+    return True
+
+def _write_run(records: List[Dict], directory: str) -> str:
+    fd, run_path = tempfile.mkstemp(suffix=".jsonl", dir=directory)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return run_path
+
+def iter_sorted_segment(path: str, chunk_size: int = 100_000) -> Iterator[Dict]:
+    """
+    Yields the records of a segment in id order, sorting it externally.
+
+    The segment is read `chunk_size` records at a time; each chunk is sorted
+    and written to a temporary run next to the segment, and the runs are then
+    k-way merged. Sorts are stable, so records of the same id keep their
+    logging order. The runs are deleted once the generator is exhausted or closed.
+
+    Args:
+        path (str): The segment.
+        chunk_size (int): Records held in memory at once.
+    """
+    directory = tempfile.mkdtemp(prefix=".sort-", dir=os.path.dirname(path) or None)
+    try:
+        runs = []
+        records = iter_segment(path)
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+            chunk.sort(key=lambda record: id_key(record["id"]))
+            runs.append(_write_run(chunk, directory))
+        yield from heapq.merge(*(iter_segment(run) for run in runs), key=lambda record: id_key(record["id"]))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def merge_segments(paths: List[str], chunk_size: int = 100_000) -> Iterator[Dict]:
+    """
+    K-way merges caption log segments into a single id-ordered stream.
+
+    Segments are read lazily, holding one record per segment in memory.
+    Segments written in dataset order are in id order for datasets built by
+    this repository; any other segment is sorted externally first (see
+    `iter_sorted_segment`), so datasets whose row order differs from their
+    id order still merge. When an id appears in several segments, the last
+    record with a caption wins, so a successful retry replaces an earlier failure.
+
+    Args:
+        paths (List[str]): The segment paths, oldest first.
+        chunk_size (int): Records per in-memory sort run of unordered segments.
+
+    Yields:
+        dict: One caption record per id, in id order.
+    """
+    streams = [
+        iter_segment(path) if is_id_ordered(path) else iter_sorted_segment(path, chunk_size)
+        for path in paths
+    ]
+    merged = heapq.merge(*streams, key=lambda record: id_key(record["id"]))
+
+    current = None
+    for record in merged:
+        if current is not None and record["id"] == current["id"]:
+            if record.get("caption") is not None or current.get("caption") is None:
+                current = record
+            continue
+        if current is not None:
+            yield current
+        current = record
+    if current is not None:
+        yield current
+
+def iter_records(output_path: str) -> Iterator[Dict]:
+    """
+    Yields every record logged for an output path, segment by segment.
+    """
+    for path in list_segments(output_path):
+        yield from iter_segment(path)
@@ -0,0 +1,145 @@
+import os
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Columnar caption files, by extension
+TABLE_FORMATS = {".parquet": "parquet", ".arrow": "arrow"}
+
+# The label and prompt of every record come from a handful of distinct
+# values, so they are stored once in a dictionary and referenced by index.
+CAPTION_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("label", pa.dictionary(pa.int32(), pa.string())),
+    ("prompt", pa.dictionary(pa.int32(), pa.string())),
+    ("caption", pa.string())
+])
+
+def table_format(path: str) -> Optional[str]:
+    """
+    Returns "parquet" or "arrow" for a columnar caption file, None otherwise (e.g., JSON).
+    """
+    return TABLE_FORMATS.get(os.path.splitext(path)[1].lower())
+
+class _DictionaryEncoder:
+    """
+    Dictionary encoder whose dictionary only grows, so that every batch's
+    dictionary extends the previous one (an Arrow IPC delta).
+    """
+
+    def __init__(self):
+        self.index = {}
+        self.values = []
+
+    def encode(self, values: List[Optional[str]]) -> pa.DictionaryArray:
+        indices = []
+        for value in values:
+            if value is None:
+                indices.append(None)
+                continue
+            i = self.index.get(value)
+            if i is None:
+                i = self.index[value] = len(self.values)
+                self.values.append(value)
+            indices.append(i)
+        return pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()), pa.array(self.values, pa.string()))
+
+class CaptionTableWriter:
+    """
+    Streams caption records into a Parquet or Arrow IPC file.
+
+    Records are buffered and written `batch_size` at a time, with the label
+    and prompt columns dictionary-encoded. Arrow IPC files are left
+    uncompressed so that readers can memory-map them without any copy.
+
+    Args:
+        path (str): The output file, ".parquet" or ".arrow".
+        metadata (Dict[str, str], optional): Extra schema metadata (e.g., the prompt templates).
+        batch_size (int): Records per row group or record batch.
+        compression (str): Parquet compression codec.
+    """
+
+    def __init__(self, path: str, metadata: Optional[Dict[str, str]] = None, batch_size: int = 10000, compression: str = "zstd"):
+        self.format = table_format(path)
+        if self.format is None:
+            raise ValueError(f"Unknown caption table format for '{path}'. Must end with {list(TABLE_FORMATS)}.")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.schema = CAPTION_SCHEMA.with_metadata(metadata or {})
+        self.count = 0
+        self._buffer = []
+        self._labels = _DictionaryEncoder()
+        self._prompts = _DictionaryEncoder()
+        if self.format == "parquet":
+            self._writer = pq.ParquetWriter(path, self.schema, compression=compression)
+        else:
+            self._writer = pa.ipc.new_file(path, self.schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+    def write(self, record: Dict) -> None:
+        """
+        Appends one caption record (with 'id', 'label', 'prompt' and 'caption').
+        """
+        self._buffer.append(record)
+        self.count += 1
+        if len(self._buffer) >= self.batch_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._buffer:
+            return
+        batch = pa.record_batch([
+            pa.array([record["id"] for record in self._buffer], pa.string()),
+            self._labels.encode([record.get("label") for record in self._buffer]),
+            self._prompts.encode([record.get("prompt") for record in self._buffer]),
+            pa.array([record.get("caption") for record in self._buffer], pa.string())
+        ], schema=self.schema)
+        self._writer.write_batch(batch)
+        self._buffer = []
+
+    def close(self) -> None:
+        """
+        Writes the buffered records and closes the file.
+        """
+        if self._writer is None:
+            return
+        self._flush()
+        self._writer.close()
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_caption_table(path: str, columns: Optional[List[str]] = None) -> pa.Table:
+    """
+    Reads a caption table, memory-mapped.
+
+    Arrow IPC files are mapped without any copy; Parquet files are read
+    from a memory map, keeping the label and prompt columns dictionary-encoded.
+
+    Args:
+        path (str): The ".parquet" or ".arrow" caption file.
+        columns (List[str], optional): The columns to read. Defaults to all.
+
+    Returns:
+        pa.Table: The caption table.
+    """
+    if table_format(path) == "parquet":
+        return pq.read_table(path, columns=columns, memory_map=True)
+    table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    return table.select(columns) if columns is not None else table
+
+def read_metadata(path: str) -> Dict[str, str]:
+    """
+    Returns the schema metadata of a caption table (e.g., "prompt_templates"), without reading its rows.
+    """
+    if table_format(path) == "parquet":
+        schema = pq.read_schema(path)
+    else:
+        schema = pa.ipc.open_file(pa.memory_map(path, 'r')).schema
+    return {key.decode("utf-8"): value.decode("utf-8") for key, value in (schema.metadata or {}).items()}
@@ -1,8 +1,97 @@
+import base64
+import json
 import os
+import zlib
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: checkpoints are not locked
+    fcntl = None
+
+class IndexSet:
+    """
+    Compact bitmap of dataset indices (one bit per index).
+
+    Serialized as zlib-compressed base64, so a fully completed run of 100k
+    images takes a few bytes on disk.
+    """
+
+    def __init__(self, indices: Iterable[int] = ()):
+        self._bits = bytearray()
+        self.update(indices)
+
+    def add(self, index: int) -> None:
+        byte, bit = divmod(index, 8)
+        if byte >= len(self._bits):
+            self._bits.extend(bytes(byte + 1 - len(self._bits)))
+        self._bits[byte] |= 1 << bit
+
+    def discard(self, index: int) -> None:
+        byte, bit = divmod(index, 8)
+        if byte < len(self._bits):
+            self._bits[byte] &= ~(1 << bit) & 0xFF
+
+    def update(self, indices: Iterable[int]) -> None:
+        for index in indices:
+            self.add(index)
+
+    def __contains__(self, index: int) -> bool:
+        byte, bit = divmod(index, 8)
+        return byte < len(self._bits) and bool(self._bits[byte] >> bit & 1)
+
+    def __iter__(self) -> Iterator[int]:
+        for byte, value in enumerate(self._bits):
+            if value:
+                for bit in range(8):
+                    if value >> bit & 1:
+                        yield byte * 8 + bit
+
+    def __len__(self) -> int:
+        return sum(bin(value).count("1") for value in self._bits)
+
+    def __or__(self, other: "IndexSet") -> "IndexSet":
+        result = IndexSet()
+        size = max(len(self._bits), len(other._bits))
+        result._bits = bytearray(
+            (self._bits[i] if i < len(self._bits) else 0) | (other._bits[i] if i < len(other._bits) else 0)
+            for i in range(size)
+        )
+        return result
+
+    def __sub__(self, other: "IndexSet") -> "IndexSet":
+        result = IndexSet()
+        result._bits = bytearray(
+            value & ~(other._bits[i] if i < len(other._bits) else 0) & 0xFF
+            for i, value in enumerate(self._bits)
+        )
+        return result
+
+    def prefix_length(self) -> int:
+        """
+        Returns the first index that is not in the set.
+        """
+        for byte, value in enumerate(self._bits):
+            if value != 0xFF:
+                bit = 0
+                while value >> bit & 1:
+                    bit += 1
+                return byte * 8 + bit
+        return len(self._bits) * 8
+
+    def encode(self) -> str:
+        return base64.b64encode(zlib.compress(bytes(self._bits))).decode("ascii")
+
+    @classmethod
+    def decode(cls, data: str) -> "IndexSet":
+        result = cls()
+        result._bits = bytearray(zlib.decompress(base64.b64decode(data)))
+        return result
 
 def get_path(output_path:str) -> str:
     """
-    Generates a checkpoint file path by appending the '.checkpoint' extension 
+    Generates a checkpoint file path by appending the '.checkpoint' extension
     to the provided output path.
 
     Args:
@@ -13,37 +102,124 @@ def get_path(output_path:str) -> str:
     """
     return f"{output_path}.checkpoint"
 
+@contextmanager
+def lock(output_path:str):
+    """
+    Holds an exclusive lock on the checkpoint of an output path.
+
+    Workers sharing a checkpoint take this lock around read-modify-write
+    updates so that they do not overwrite each other's progress.
+
+    Args:
+        output_path (str): The base path of the checkpoint.
+    """
+    lock_file = f"{get_path(output_path)}.lock"
+    if os.path.dirname(lock_file):
+        os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+    with open(lock_file, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def load_state(output_path:str) -> Tuple[IndexSet, IndexSet]:
+    """
+    Load the completed and failed dataset indices from a checkpoint file.
+
+    Checkpoints written by older versions hold a single integer N, which is
+    read as indices 0..N-1 completed.
+
+    Args:
+        output_path (str): The base path of the checkpoint.
+
+    Returns:
+        Tuple[IndexSet, IndexSet]: The completed and failed indices. Both are
+        empty if the file does not exist.
+    """
+    checkpoint_file = get_path(output_path)
+    if not os.path.exists(checkpoint_file):
+        return IndexSet(), IndexSet()
+    with open(checkpoint_file, 'r') as f:
+        content = f.read().strip()
+    if content.isdigit():
+        return IndexSet(range(int(content))), IndexSet()
+    data = json.loads(content)
+    return IndexSet.decode(data["completed"]), IndexSet.decode(data["failed"])
+
+def save_state(output_path:str, completed:IndexSet, failed:IndexSet) -> None:
+    """
+    Atomically writes the completed and failed indices to the checkpoint file.
+
+    The state is written to a temporary file which then replaces the
+    checkpoint, so a crash never leaves a truncated checkpoint behind.
+
+    Args:
+        output_path (str): The base path of the checkpoint.
+        completed (IndexSet): Indices captioned successfully.
+        failed (IndexSet): Indices whose caption failed.
+    """
+    checkpoint_file = get_path(output_path)
+    if os.path.dirname(checkpoint_file):
+        os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+    tmp_file = f"{checkpoint_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump({
+            "version": 2,
+            "completed": completed.encode(),
+            "failed": (failed - completed).encode()
+        }, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, checkpoint_file)
+
+def update_state(output_path:str, completed:IndexSet, failed:IndexSet) -> Tuple[IndexSet, IndexSet]:
+    """
+    Merges a worker's progress into the checkpoint, under the checkpoint lock.
+
+    Completed indices are added to the stored ones; an index completed by any
+    worker is no longer failed.
+
+    Args:
+        output_path (str): The base path of the checkpoint.
+        completed (IndexSet): Indices completed by this worker.
+        failed (IndexSet): Indices that failed in this worker.
+
+    Returns:
+        Tuple[IndexSet, IndexSet]: The merged completed and failed indices.
+    """
+    with lock(output_path):
+        stored_completed, stored_failed = load_state(output_path)
+        completed = stored_completed | completed
+        failed = (stored_failed | failed) - completed
+        save_state(output_path, completed, failed)
+    return completed, failed
+
 def load(output_path:str) -> int:
     """
     Load the checkpoint value from a file.
 
-    This function reads an integer value from a checkpoint file located at the
-    specified output path. If the file exists, it reads and returns the integer
-    value stored in the file. If the file does not exist, it returns 0.
+    This function reads the checkpoint file located at the specified output
+    path and returns the number of leading indices that are completed. If the
+    file does not exist, it returns 0.
 
     Args:
         output_path (str): The directory path where the checkpoint file is located.
 
     Returns:
-        int: The integer value read from the checkpoint file, or 0 if the file does not exist.
+        int: The first index that is not completed, or 0 if the file does not exist.
     """
-    checkpoint_file = get_path(output_path)
-    if os.path.exists(checkpoint_file):
-        with open(checkpoint_file, 'r') as f:
-            return int(f.read().strip())
-    return 0
+    completed, _ = load_state(output_path)
+    return completed.prefix_length()
 
 def save(output_path:str, index:int) -> None:
     """
-    Saves the given index to a checkpoint file at the specified output path.
+    Marks the indices below the given index as completed in the checkpoint file.
 
     Args:
         output_path (str): The directory path where the checkpoint file will be saved.
-        index (int): The index value to be written to the checkpoint file.
-
-    The function creates or overwrites a file in the specified directory and writes
-    the index value as a string to the file.
+        index (int): The index value up to which samples are completed.
     """
-    checkpoint_file = get_path(output_path)
-    with open(checkpoint_file, 'w') as f:
-        f.write(str(index))
\ No newline at end of file
+    update_state(output_path, IndexSet(range(index)), IndexSet())
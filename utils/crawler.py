@@ -0,0 +1,312 @@
+from PIL import Image
+from icrawler import ImageDownloader
+from icrawler.builtin import BingImageCrawler
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+MANIFEST_NAME = "manifest.jsonl"
+
+class Manifest:
+    """
+    Append-only JSONL record of the URLs already fetched into a directory.
+
+    Re-crawls skip every URL in the manifest, so an interrupted crawl resumes
+    where it stopped. Network errors are not recorded and are retried.
+
+    Args:
+        path (str): Path of the manifest file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._entries: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.endswith("\n"):
+                        entry = json.loads(line)
+                        self._entries[entry["url"]] = entry
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def __contains__(self, url: str) -> bool:
+        return url in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, url: str) -> Optional[Dict]:
+        return self._entries.get(url)
+
+    def count(self, status: str = "ok", keyword: Optional[str] = None) -> int:
+        """
+        Returns the number of URLs recorded with the given status, optionally
+        only those fetched for one keyword.
+        """
+        return sum(
+            1 for entry in self._entries.values()
+            if entry.get("status") == status and (keyword is None or entry.get("keyword") == keyword)
+        )
+
+    def record(self, url: str, **fields) -> None:
+        """
+        Records a fetched URL with its outcome (e.g., status, sha256, path).
+        """
+        entry = {"url": url, **fields}
+        with self._lock:
+            self._entries[url] = entry
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+class HostLimiter:
+    """
+    Per-host politeness limits shared by every downloader thread.
+
+    Args:
+        max_per_host (int): Maximum number of concurrent requests to one host.
+        min_interval (float): Minimum delay between two request starts on one host, in seconds.
+    """
+
+    def __init__(self, max_per_host: int = 2, min_interval: float = 0.0):
+        self.max_per_host = max_per_host
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._next_start: Dict[str, float] = {}
+
+    @contextmanager
+    def limit(self, url: str):
+        """
+        Holds a request slot on the host of `url`.
+        """
+        host = urlparse(url).netloc
+        with self._lock:
+            semaphore = self._semaphores.setdefault(host, threading.BoundedSemaphore(self.max_per_host))
+        with semaphore:
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_start.get(host, now))
+                self._next_start[host] = start + self.min_interval
+            if start > now:
+                time.sleep(start - now)
+            yield
+
+def ingest_image(data: bytes, max_edge: Optional[int] = None, quality: int = 90) -> Tuple[bytes, str, Tuple[int, int]]:
+    """
+    Validates, decodes and optionally downscales a downloaded image.
+
+    JPEG and PNG files are kept as is unless they are downscaled; other formats
+    are transcoded to JPEG so that they are picked up by the folder scanner.
+
+    Args:
+        data (bytes): The downloaded file.
+        max_edge (int, optional): Downscale images whose long edge is larger.
+        quality (int): JPEG quality of re-encoded images.
+
+    Returns:
+        Tuple[bytes, str, Tuple[int, int]]: The file to store, its extension and the image size.
+
+    Raises:
+        OSError: If the file is not a valid image.
+    """
+    Image.open(io.BytesIO(data)).verify()
+    image = Image.open(io.BytesIO(data))
+    image.load()
+
+    if max_edge is not None and max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    elif image.format in ("JPEG", "PNG"):
+        return data, "jpg" if image.format == "JPEG" else "png", image.size
+
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue(), "jpg", image.size
+
+def store_by_hash(root_dir: str, data: bytes, ext: str) -> Tuple[str, str, bool]:
+    """
+    Stores a file under its content hash, unless the same content is already stored.
+
+    Returns:
+        Tuple[str, str, bool]: The file path, the SHA-256 hex digest and
+        whether the file is new.
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = os.path.join(root_dir, f"{sha256}.{ext}")
+    if os.path.exists(path):
+        return path, sha256, False
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path, sha256, True
+
+class ManifestDownloader(ImageDownloader):
+    """
+    icrawler downloader that skips URLs in the manifest, honours per-host
+    limits, validates images in a worker pool and stores them by content hash.
+
+    Entries are recorded with their keyword: skipped URLs only count towards
+    `max_num` when they were fetched for the same keyword, as several keywords
+    share the manifest of a directory.
+    """
+
+    def __init__(self, thread_num, signal, session, storage, manifest=None, keyword=None, host_limiter=None, ingest_pool=None, max_edge=None):
+        super().__init__(thread_num, signal, session, storage)
+        self.manifest = manifest
+        self.keyword = keyword
+        self.host_limiter = host_limiter or HostLimiter()
+        self.ingest_pool = ingest_pool
+        self.max_edge = max_edge
+
+    def download(self, task, default_ext, timeout=5, max_retry=3, overwrite=False, **kwargs):
+        file_url = task["file_url"]
+        task["success"] = False
+        task["filename"] = None
+
+        entry = self.manifest.get(file_url)
+        if entry is not None:
+            if entry.get("status") == "ok" and entry.get("keyword") == self.keyword:
+                with self.lock:
+                    self.fetched_num += 1
+            self.logger.debug("skip already fetched url %s", file_url)
+            return
+
+        retry = max_retry
+        while retry > 0 and not self.signal.get("reach_max_num"):
+            try:
+                with self.host_limiter.limit(file_url):
+                    response = self.session.get(file_url, timeout=timeout)
+            except Exception as e:
+                self.logger.error("Exception caught when downloading file %s, error: %s, remaining retry times: %d", file_url, e, retry - 1)
+            else:
+                if self.reach_max_num():
+                    self.signal.set(reach_max_num=True)
+                    break
+                elif response.status_code != 200:
+                    self.logger.error("Response status code %d, file %s", response.status_code, file_url)
+                    break
+                elif not self.keep_file(task, response, **kwargs):
+                    # Outside the min_size/max_size filters, checked on the original size
+                    if "img_size" in task:
+                        self.manifest.record(file_url, keyword=self.keyword, status="filtered", size=list(task["img_size"]))
+                    else:
+                        self.manifest.record(file_url, keyword=self.keyword, status="invalid", error="not an image")
+                    break
+
+                try:
+                    if self.ingest_pool is not None:
+                        data, ext, size = self.ingest_pool.submit(ingest_image, response.content, self.max_edge).result()
+                    else:
+                        data, ext, size = ingest_image(response.content, self.max_edge)
+                except Exception as e:
+                    self.manifest.record(file_url, keyword=self.keyword, status="invalid", error=str(e))
+                    break
+
+                path, sha256, is_new = store_by_hash(self.storage.root_dir, data, ext)
+                self.manifest.record(
+                    file_url, keyword=self.keyword, status="ok" if is_new else "duplicate",
+                    sha256=sha256, path=os.path.basename(path), size=list(size)
+                )
+                if is_new:
+                    with self.lock:
+                        self.fetched_num += 1
+                    self.logger.info("image #%s\t%s", self.fetched_num, file_url)
+                task["success"] = True
+                task["filename"] = path
+                break
+            finally:
+                retry -= 1
+
+def crawl_keywords(
+    keywords_by_dir: Dict[str, List[str]],
+    max_num: int = 1000,
+    crawler_cls=BingImageCrawler,
+    query_arg: str = "keyword",
+    max_keywords: int = 4,
+    downloader_threads: int = 4,
+    max_per_host: int = 2,
+    min_host_interval: float = 0.2,
+    max_edge: Optional[int] = None,
+    num_proc: Optional[int] = None,
+    log_level: int = logging.WARNING
+) -> Dict[str, int]:
+    """
+    Crawls several keywords concurrently into content-addressed directories.
+
+    Each directory keeps a manifest of fetched URLs, so re-running resumes the
+    crawl instead of starting from zero. All keywords share the per-host
+    politeness limits and one process pool that validates, decodes and
+    optionally downscales the downloaded images.
+
+    Args:
+        keywords_by_dir (Dict[str, List[str]]): Keywords to crawl, by save directory.
+        max_num (int): Maximum number of images per keyword.
+        crawler_cls: icrawler crawler class (e.g., BingImageCrawler, or
+            UrlListCrawler with `query_arg="url_list"` for a local stand-in).
+        query_arg (str): Name of the `crawl` argument receiving each keyword.
+        max_keywords (int): Number of keywords crawled at once.
+        downloader_threads (int): Downloader threads per keyword.
+        max_per_host (int): Maximum number of concurrent requests to one host.
+        min_host_interval (float): Minimum delay between requests to one host, in seconds.
+        max_edge (int, optional): Downscale images whose long edge is larger.
+        num_proc (int, optional): Number of ingest processes.
+        log_level (int): Logging level of the crawlers.
+
+    Returns:
+        Dict[str, int]: The number of images in each manifest after the crawl.
+    """
+    manifests = {}
+    for save_dir in keywords_by_dir:
+        os.makedirs(save_dir, exist_ok=True)
+        manifests[save_dir] = Manifest(os.path.join(save_dir, MANIFEST_NAME))
+    host_limiter = HostLimiter(max_per_host=max_per_host, min_interval=min_host_interval)
+
+    def crawl_one(save_dir, keyword, ingest_pool):
+        print(f"[INFO] Downloading: {keyword} into {save_dir}")
+        crawler = crawler_cls(
+            downloader_cls=ManifestDownloader,
+            downloader_threads=downloader_threads,
+            storage={'root_dir': save_dir},
+            log_level=log_level,
+            extra_downloader_args={
+                "manifest": manifests[save_dir],
+                "keyword": keyword,
+                "host_limiter": host_limiter,
+                "ingest_pool": ingest_pool,
+                "max_edge": max_edge
+            }
+        )
+        crawler.crawl(**{query_arg: keyword}, max_num=max_num)
+
+    try:
+        with ProcessPoolExecutor(max_workers=num_proc) as ingest_pool, \
+                ThreadPoolExecutor(max_workers=max_keywords) as executor:
+            futures = [
+                executor.submit(crawl_one, save_dir, keyword, ingest_pool)
+                for save_dir, keywords in keywords_by_dir.items()
+                for keyword in keywords
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        for manifest in manifests.values():
+            manifest.close()
+
+    return {save_dir: manifest.count("ok") for save_dir, manifest in manifests.items()}
@@ -1,13 +1,138 @@
-from datasets import DatasetDict, Dataset, Features, ClassLabel, Value, Image as HfImage
+from datasets import DatasetDict, Dataset, DatasetInfo, Features, ClassLabel, Image as HfImage
+from datasets.table import InMemoryTable
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os
-import pandas as pd
-from typing import List, Dict
+import numpy as np
+import pyarrow as pa
+from typing import List, Dict, Optional, Tuple
 from tqdm import tqdm
 
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+def _list_class_dirs(split_path: str) -> List[str]:
+    """
+    Lists the class folder names of a partition, sorted.
+    """
+    with os.scandir(split_path) as it:
+        return sorted(entry.name for entry in it if entry.is_dir())
+
+def _scan_class_dir(class_dir: str) -> Tuple[int, List[str]]:
+    """
+    Lists the image file names of a class folder, sorted, with the folder mtime.
+    """
+    mtime = os.stat(class_dir).st_mtime_ns
+    with os.scandir(class_dir) as it:
+        files = sorted(
+            entry.name for entry in it
+            if entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file()
+        )
+    return mtime, files
+
+def scan_image_folders(
+    root_dir: str,
+    partitions: List[str],
+    num_workers: int = 16,
+    cache_path: Optional[str] = None
+) -> Dict[str, List[Tuple[str, str]]]:
+    """
+    Scans partition/class folders for images, in parallel.
+
+    Class folders are scanned with `os.scandir` on a thread pool, which keeps
+    many directory reads in flight on network-backed disks. With `cache_path`,
+    the listing of each class folder is cached along with the folder mtime, and
+    only folders whose mtime changed are scanned again.
+
+    Args:
+        root_dir (str): Root directory containing partition folders like 'train', 'test', etc.
+        partitions (List[str]): List of partition folder names to scan.
+        num_workers (int): Number of scanning threads.
+        cache_path (str, optional): JSON file caching the folder listings.
+
+    Returns:
+        Dict[str, List[Tuple[str, str]]]: For each partition, the (image path, class name)
+                                          pairs, sorted by class then file name.
+    """
+    for split in partitions:
+        if not os.path.exists(os.path.join(root_dir, split)):
+            raise FileNotFoundError(f"Partition folder '{split}' not found in '{root_dir}'")
+
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        split_paths = [os.path.join(root_dir, split) for split in partitions]
+        class_dirs = {
+            split: [os.path.join(split_path, name) for name in names]
+            for split, split_path, names in zip(partitions, split_paths, executor.map(_list_class_dirs, split_paths))
+        }
+
+        # Only scan the class folders whose mtime changed since the cached listing
+        all_dirs = [class_dir for dirs in class_dirs.values() for class_dir in dirs]
+        stale = [
+            class_dir for class_dir in all_dirs
+            if class_dir not in cache or cache[class_dir]["mtime"] != os.stat(class_dir).st_mtime_ns
+        ] if cache else all_dirs
+        if cache:
+            print(f"♻️ Rescanning {len(stale)} of {len(all_dirs)} class folders.")
+        for class_dir, (mtime, files) in zip(
+            stale,
+            tqdm(executor.map(_scan_class_dir, stale), total=len(stale), desc="🔍 Scanning class folders", leave=False)
+        ):
+            cache[class_dir] = {"mtime": mtime, "files": files}
+
+    if cache_path is not None:
+        if os.path.dirname(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(f"{cache_path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump({class_dir: cache[class_dir] for class_dir in all_dirs}, f)
+        os.replace(f"{cache_path}.tmp", cache_path)
+
+    return {
+        split: [
+            (os.path.join(class_dir, fname), os.path.basename(class_dir))
+            for class_dir in dirs
+            for fname in cache[class_dir]["files"]
+        ]
+        for split, dirs in class_dirs.items()
+    }
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _build_table(
+    entries: List[Tuple[str, str]],
+    label_map: Dict[str, int],
+    embed_images: bool,
+    executor: Optional[ThreadPoolExecutor]
+) -> pa.Table:
+    """
+    Builds the Arrow table of an image dataset, in the storage layout of the
+    `Image` and `ClassLabel` features.
+    """
+    paths = [path for path, _ in entries]
+    images = [None] * len(paths)
+    if embed_images:
+        images = list(tqdm(executor.map(_read_bytes, paths), total=len(paths), desc="📥 Reading images", leave=False))
+    image_type = pa.struct({"bytes": pa.binary(), "path": pa.string()})
+    return pa.table({
+        "image": pa.StructArray.from_arrays(
+            [pa.array(images, type=pa.binary()), pa.array(paths, type=pa.string())],
+            fields=list(image_type)
+        ),
+        "label": pa.array([label_map[label] for _, label in entries], type=pa.int64())
+    })
+
 def build_image_dataset_from_folders(
     root_dir: str,
     partitions: List[str],
-    keep_splits: bool = True
+    keep_splits: bool = True,
+    num_workers: int = 16,
+    embed_images: bool = False,
+    cache_path: Optional[str] = None
 ) -> DatasetDict | Dataset:
     """
     Build a Hugging Face DatasetDict or Dataset from an image folder with pre-defined partitions.
@@ -17,63 +142,45 @@ def build_image_dataset_from_folders(
                         Each partition folder must contain subfolders named after the classes.
         partitions (List[str]): List of partition folder names to load (e.g., ['train', 'test']).
         keep_splits (bool): Whether to return a DatasetDict (True) or a merged single Dataset (False).
+        num_workers (int): Number of threads scanning folders and reading images.
+        embed_images (bool): Whether to embed the image bytes in the dataset instead of
+                             referencing the files by path.
+        cache_path (str, optional): JSON file caching the folder listings. When it exists,
+                                    only class folders whose mtime changed are rescanned.
 
     Returns:
         DatasetDict or Dataset: A dictionary with keys like 'train', 'test', etc. if keep_splits is True,
                                 otherwise a merged single Dataset.
     """
-    dataset_dict = {}
-    all_labels = set()
-    data_by_split: Dict[str, List[Dict]] = {}
-
     print(f"📂 Reading image dataset from: {root_dir}")
-    for split in tqdm(partitions, desc="📁 Processing partitions"):
-        split_path = os.path.join(root_dir, split)
-        if not os.path.exists(split_path):
-            raise FileNotFoundError(f"Partition folder '{split}' not found in '{root_dir}'")
-        
-        data = []
-        class_folders = [d for d in os.listdir(split_path) if os.path.isdir(os.path.join(split_path, d))]
-
-        for class_name in tqdm(class_folders, desc=f"🔍 Scanning '{split}' classes", leave=False):
-            class_dir = os.path.join(split_path, class_name)
-            for fname in os.listdir(class_dir):
-                if fname.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    data.append({
-                        "image": os.path.join(class_dir, fname),
-                        "label": class_name
-                    })
-                    all_labels.add(class_name)
-        data_by_split[split] = data
-
-    label_names = sorted(all_labels)
+    data_by_split = scan_image_folders(root_dir, partitions, num_workers=num_workers, cache_path=cache_path)
+
+    label_names = sorted({label for entries in data_by_split.values() for _, label in entries})
+    label_map = {name: i for i, name in enumerate(label_names)}
 
     features = Features({
-        "image": Value("string"),
+        "image": HfImage(),
         "label": ClassLabel(names=label_names)
     })
 
     print("🧱 Building Hugging Face datasets...")
-    if keep_splits:
-        for split, data in tqdm(data_by_split.items(), desc="🛠️ Creating datasets"):
-            df = pd.DataFrame(data)
-            df["label"] = df["label"].apply(lambda x: label_names.index(x))
-            dataset = Dataset.from_pandas(df, features=features)
-            dataset = dataset.cast_column("image", HfImage())
-            dataset_dict[split] = dataset
-        print("✅ Datasets created for all splits.")
-        return DatasetDict(dataset_dict)
-    else:
-        all_data = []
-        for split_data in data_by_split.values():
-            all_data.extend(split_data)
-        df = pd.DataFrame(all_data)
-        df["label"] = df["label"].apply(lambda x: label_names.index(x))
-        dataset = Dataset.from_pandas(df, features=features)
-        dataset = dataset.cast_column("image", HfImage())
-        dataset = dataset.shuffle(seed=42)
-        print("✅ Merged dataset created.")
-        return dataset
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        if keep_splits:
+            dataset_dict = {}
+            for split, entries in tqdm(data_by_split.items(), desc="🛠️ Creating datasets"):
+                table = _build_table(entries, label_map, embed_images, executor)
+                dataset_dict[split] = Dataset(InMemoryTable(table), info=DatasetInfo(features=features.copy()), split=split)
+            print("✅ Datasets created for all splits.")
+            return DatasetDict(dataset_dict)
+        else:
+            all_entries = [entry for entries in data_by_split.values() for entry in entries]
+            table = _build_table(all_entries, label_map, embed_images, executor)
+            # Same permutation as `Dataset.shuffle(seed=42)`, applied to the table
+            # directly so that the dataset has no indices mapping
+            table = table.take(np.random.default_rng(42).permutation(len(table)))
+            dataset = Dataset(InMemoryTable(table), info=DatasetInfo(features=features))
+            print("✅ Merged dataset created.")
+            return dataset
 
 if __name__ == '__main__':
     root_dir = "data/raw/african_foods/nigerian_foods/"
@@ -0,0 +1,182 @@
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+import io
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Union
+
+HASH_METHODS = ("phash", "dhash")
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+_DCT_32 = _dct_matrix(32)
+_BIT_WEIGHTS = (1 << np.arange(63, -1, -1, dtype=np.uint64)).astype(np.uint64)
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int(np.bitwise_or.reduce(_BIT_WEIGHTS[bits.ravel()]) if bits.any() else 0)
+
+def dhash(image: Image.Image) -> int:
+    """
+    64-bit difference hash: compares neighbouring pixels of a 9x8 grayscale thumbnail.
+    """
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+def phash(image: Image.Image) -> int:
+    """
+    64-bit perceptual hash: signs of the 8x8 lowest DCT frequencies of a 32x32
+    grayscale thumbnail, relative to their median.
+    """
+    pixels = np.asarray(image.convert("L").resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8]
+    return _bits_to_int(low > np.median(low.ravel()[1:]))
+
+def _hash_one(args) -> int:
+    image_input, method = args
+    if isinstance(image_input, dict):
+        image_input = image_input["bytes"] if image_input.get("bytes") is not None else image_input["path"]
+    if isinstance(image_input, bytes):
+        image_input = io.BytesIO(image_input)
+    image = image_input if isinstance(image_input, Image.Image) else Image.open(image_input)
+    image.draft("L", (64, 64))  # let JPEG decoding downscale on the fly
+    return phash(image) if method == "phash" else dhash(image)
+
+def compute_hashes(
+    images: Iterable[Union[bytes, str, dict, Image.Image]],
+    method: str = "phash",
+    num_proc: Optional[int] = None,
+    chunksize: int = 64
+) -> np.ndarray:
+    """
+    Computes perceptual hashes of images in a process pool.
+
+    Args:
+        images (Iterable): Encoded image bytes, file paths, Hugging Face image
+            dicts ({"bytes", "path"}) or PIL images.
+        method (str): "phash" or "dhash".
+        num_proc (int, optional): Number of worker processes. 0 or 1 hashes in
+            the calling process. Defaults to the number of CPUs.
+        chunksize (int): Number of images sent to a worker at once.
+
+    Returns:
+        np.ndarray: The packed hashes, as a uint64 array.
+    """
+    if method not in HASH_METHODS:
+        raise ValueError(f"Unknown hash method '{method}'. Must be one of {HASH_METHODS}.")
+    tasks = ((image, method) for image in images)
+    if num_proc is not None and num_proc <= 1:
+        hashes = [_hash_one(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=num_proc) as executor:
+            hashes = list(executor.map(_hash_one, tasks, chunksize=chunksize))
+    return np.array(hashes, dtype=np.uint64)
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    """
+    Vectorized number of set bits of a uint64 array.
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    return table[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+def _find(parent: np.ndarray, i: int) -> int:
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def find_duplicate_clusters(hashes: np.ndarray, threshold: int = 4) -> np.ndarray:
+    """
+    Clusters near-duplicate hashes with a multi-index Hamming search.
+
+    The 64 bits are split into `threshold + 1` blocks. Two hashes within
+    `threshold` bits of each other agree exactly on at least one block
+    (pigeonhole), so only hashes sharing a block value are compared, with a
+    vectorized popcount. Near-duplicate pairs are then joined transitively.
+
+    Args:
+        hashes (np.ndarray): uint64 hashes from `compute_hashes`.
+        threshold (int): Maximum Hamming distance between duplicates.
+
+    Returns:
+        np.ndarray: For each image, the index of its cluster representative
+        (the lowest index in its cluster).
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n = len(hashes)
+    parent = np.arange(n)
+    num_blocks = threshold + 1
+    edges = np.linspace(0, 64, num_blocks + 1).astype(int)
+
+    for start, stop in zip(edges[:-1], edges[1:]):
+        mask = np.uint64((1 << int(stop - start)) - 1)
+        block = (hashes >> np.uint64(start)) & mask
+        order = np.argsort(block, kind="stable")
+        sorted_block = block[order]
+        # Boundaries of the runs of equal block values
+        bounds = np.flatnonzero(np.diff(sorted_block)) + 1
+        for members in np.split(order, bounds):
+            if len(members) < 2:
+                continue
+            member_hashes = hashes[members]
+            for k in range(len(members) - 1):
+                close = popcount(member_hashes[k + 1:] ^ member_hashes[k]) <= threshold
+                for other in members[k + 1:][close]:
+                    a, b = _find(parent, members[k]), _find(parent, other)
+                    if a != b:
+                        parent[max(a, b)] = min(a, b)
+
+    return np.array([_find(parent, i) for i in range(n)])
+
+def dataset_hashes(dataset, method: str = "phash", num_proc: Optional[int] = None) -> np.ndarray:
+    """
+    Computes the perceptual hashes of a Hugging Face image dataset.
+
+    Images are hashed from their encoded bytes, without decoding them in the
+    calling process.
+
+    Args:
+        dataset (Dataset): Dataset with an `image` column.
+        method (str): "phash" or "dhash".
+        num_proc (int, optional): Number of hashing processes.
+
+    Returns:
+        np.ndarray: The uint64 hash of each example.
+    """
+    from datasets import Image as HfImage
+
+    images = dataset.select_columns(["image"]).cast_column("image", HfImage(decode=False))
+    return compute_hashes((example["image"] for example in images), method=method, num_proc=num_proc)
+
+def dedup_dataset(dataset, threshold: int = 4, method: str = "phash", num_proc: Optional[int] = None) -> np.ndarray:
+    """
+    Finds the near-duplicate clusters of a Hugging Face image dataset.
+
+    Args:
+        dataset (Dataset): Dataset with an `image` column.
+        threshold (int): Maximum Hamming distance between duplicates.
+        method (str): "phash" or "dhash".
+        num_proc (int, optional): Number of hashing processes.
+
+    Returns:
+        np.ndarray: For each example, the index of its cluster representative.
+    """
+    hashes = dataset_hashes(dataset, method=method, num_proc=num_proc)
+    return find_duplicate_clusters(hashes, threshold=threshold)
+
+def duplicate_of(ids: List[str], representatives: np.ndarray) -> List[str]:
+    """
+    Maps each id to the id of its cluster representative (itself if it is one).
+    """
+    return [ids[r] for r in representatives]
+
+def cluster_sizes(representatives: np.ndarray) -> Dict[int, int]:
+    """
+    Returns the size of every cluster with more than one image, by representative.
+    """
+    values, counts = np.unique(representatives, return_counts=True)
+    return {int(v): int(c) for v, c in zip(values, counts) if c > 1}
@@ -0,0 +1,336 @@
+from openai import (
+    APIConnectionError, APITimeoutError, AuthenticationError, InternalServerError,
+    NotFoundError, PermissionDeniedError, RateLimitError
+)
+from collections import deque
+from typing import Dict, List, Optional
+import json
+import os
+import random
+import threading
+import time
+
+from utils.call_openai_api import get_client, load_env, API_VERSION, MODEL, MAX_TOKENS
+from utils.rate_limit import parse_retry_after
+
+# A wrong key, missing permission or unknown deployment (401, 403, 404) is
+# about the deployment's configuration: its breaker opens at once.
+DEPLOYMENT_ERRORS = (AuthenticationError, PermissionDeniedError, NotFoundError)
+# Errors worth sending to another deployment; anything else (e.g., a content
+# filter rejection) is about the request itself and is raised as is.
+FAILOVER_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError) + DEPLOYMENT_ERRORS
+
+class Deployment:
+    """
+    One endpoint/deployment pair of a pool, with its health and circuit breaker.
+
+    The breaker opens when the recent error rate reaches the pool threshold or
+    when the deployment is throttled, so no traffic is routed to it until its
+    cooldown (or `retry-after`) ends. It then lets a single probe request
+    through (half-open): a success closes it, a failure opens it again with a
+    doubled cooldown.
+
+    Args:
+        name (str): Name used in logs and metrics.
+        azure_endpoint (str): The Azure OpenAI endpoint.
+        azure_deployment (str): The deployment name.
+        weight (float): Routing weight, e.g., proportional to the quota.
+        api_key (str, optional): The endpoint's API key. Defaults to AZURE_OPENAI_KEY.
+        api_version (str): The Azure OpenAI API version.
+        rpm (float, optional): Requests per minute quota.
+        tpm (float, optional): Tokens per minute quota.
+        **client_kwargs: Extra `get_client` arguments (e.g., max_connections).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        azure_endpoint: str,
+        azure_deployment: str,
+        weight: float = 1.0,
+        api_key: Optional[str] = None,
+        api_version: str = API_VERSION,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        window: int = 50,
+        **client_kwargs
+    ):
+        self.name = name
+        self.weight = weight
+        self.api_version = api_version
+        # Failover replaces the client's own retries
+        client_kwargs.setdefault("max_retries", 0)
+        self.client = get_client(
+            azure_endpoint=azure_endpoint,
+            azure_deployment=azure_deployment,
+            api_version=api_version,
+            api_key=api_key,
+            rpm=rpm,
+            tpm=tpm,
+            **client_kwargs
+        )
+        self.outcomes = deque(maxlen=window)
+        self.latency = None
+        self.state = "closed"
+        self.open_until = 0.0
+        self.cooldown = None
+        self.probing = False
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def quota_factor(self) -> float:
+        """
+        Share of the deployment's quota currently available, from its rate limiter.
+        """
+        limiter = getattr(self.client, "rate_limiter", None)
+        if limiter is None:
+            return 1.0
+        factor = limiter.scale
+        for bucket in (limiter.requests, limiter.tokens):
+            if bucket is not None:
+                factor *= max(0.05, bucket.level / bucket.capacity)
+        return factor
+
+    def status(self) -> Dict:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "error_rate": self.error_rate,
+            "latency": self.latency,
+            "quota": self.quota_factor()
+        }
+
+class DeploymentPool:
+    """
+    Routes chat requests across several Azure OpenAI deployments.
+
+    Each request goes to a deployment drawn at random, weighted by its
+    configured weight, remaining quota (from its rate limiter), recent error
+    rate and latency. Throttled, failing or unreachable deployments are taken
+    out by their circuit breaker and the request fails over to another one.
+    Safe to share across threads.
+
+    Args:
+        deployments (List[Deployment]): The deployments.
+        model (str): Model name of the deployments, used in caption cache keys.
+        error_threshold (float): Recent error rate that opens a breaker.
+        min_requests (int): Requests in the window before the error rate counts.
+        cooldown (float): First open period of a breaker, in seconds.
+        max_cooldown (float): Longest open period, in seconds.
+        latency_decay (float): Weight of the newest latency in the moving average.
+    """
+
+    def __init__(
+        self,
+        deployments: List[Deployment],
+        model: str = MODEL,
+        error_threshold: float = 0.5,
+        min_requests: int = 10,
+        cooldown: float = 10.0,
+        max_cooldown: float = 300.0,
+        latency_decay: float = 0.2
+    ):
+        if not deployments:
+            raise ValueError("A deployment pool needs at least one deployment.")
+        self.deployments = deployments
+        self.model = model
+        self.error_threshold = error_threshold
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.latency_decay = latency_decay
+        self._lock = threading.Lock()
+
+    @property
+    def api_version(self) -> str:
+        """
+        The API version of the deployments, used in caption cache keys. A pool
+        mixing versions lists all of them, as any of them may answer.
+        """
+        return ",".join(sorted({deployment.api_version for deployment in self.deployments}))
+
+    @classmethod
+    def from_config(cls, config, **client_kwargs) -> "DeploymentPool":
+        """
+        Builds a pool from a JSON file path or a dict like:
+
+            {
+              "model": "gpt-4o",
+              "deployments": [
+                {"name": "eastus", "azure_endpoint": "https://...", "azure_deployment": "gpt-4o",
+                 "api_key_env": "AZURE_OPENAI_KEY_EASTUS", "weight": 2, "rpm": 300, "tpm": 50000},
+                ...
+              ]
+            }
+
+        `api_key_env` names the environment variable holding the key, so that
+        keys stay out of the file. Pool settings (e.g., "cooldown") go next to
+        "deployments".
+        """
+        if isinstance(config, str):
+            with open(config, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        config = dict(config)
+        deployments = []
+        for spec in config.pop("deployments"):
+            spec = dict(spec)
+            api_key_env = spec.pop("api_key_env", None)
+            if api_key_env is not None:
+                spec["api_key"] = os.environ[api_key_env]
+            spec.setdefault("name", spec["azure_deployment"])
+            deployments.append(Deployment(**{**client_kwargs, **spec}))
+        return cls(deployments, **config)
+
+    # ----------------------- routing -----------------------
+    def _available(self, deployment: Deployment, now: float) -> bool:
+        if deployment.state == "closed":
+            return True
+        if deployment.state == "open" and now >= deployment.open_until:
+            deployment.state = "half-open"
+            deployment.probing = False
+        return deployment.state == "half-open" and not deployment.probing
+
+    def _score(self, deployment: Deployment, fastest: Optional[float]) -> float:
+        score = deployment.weight * deployment.quota_factor()
+        if len(deployment.outcomes) >= self.min_requests:
+            score *= max(0.05, 1 - deployment.error_rate)
+        if fastest and deployment.latency:
+            score *= fastest / deployment.latency
+        return score
+
+    def choose(self, exclude=()) -> Deployment:
+        """
+        Picks the deployment for the next request, waiting for the first
+        breaker to close when every deployment is open.
+
+        Args:
+            exclude: Deployments already tried for this request, used only
+                when no other deployment is available.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                available = [d for d in self.deployments if self._available(d, now)]
+                candidates = [d for d in available if d not in exclude] or available
+                if candidates:
+                    latencies = [d.latency for d in candidates if d.latency]
+                    fastest = min(latencies) if latencies else None
+                    weights = [self._score(d, fastest) for d in candidates]
+                    deployment = random.choices(candidates, weights=weights)[0]
+                    if deployment.state == "half-open":
+                        deployment.probing = True
+                    return deployment
+                wait = min(d.open_until for d in self.deployments) - now
+            time.sleep(max(0.05, wait))
+
+    def _open(self, deployment: Deployment, duration: Optional[float] = None) -> None:
+        if duration is None:
+            deployment.cooldown = min(self.max_cooldown, deployment.cooldown * 2) if deployment.cooldown else self.cooldown
+            duration = deployment.cooldown
+        deployment.state = "open"
+        deployment.open_until = max(deployment.open_until, time.monotonic() + duration)
+        deployment.probing = False
+
+    def report(
+        self,
+        deployment: Deployment,
+        ok: bool,
+        latency: Optional[float] = None,
+        retry_after: Optional[float] = None,
+        throttled: bool = False,
+        broken: bool = False
+    ) -> None:
+        """
+        Updates a deployment's health with the outcome of a request. A
+        `broken` deployment (see `DEPLOYMENT_ERRORS`) is opened at once.
+        """
+        with self._lock:
+            deployment.outcomes.append(ok)
+            if ok:
+                if latency is not None:
+                    deployment.latency = latency if deployment.latency is None else (
+                        self.latency_decay * latency + (1 - self.latency_decay) * deployment.latency
+                    )
+                if deployment.state == "half-open":
+                    deployment.state = "closed"
+                    deployment.cooldown = None
+                    deployment.outcomes.clear()
+                return
+            if throttled:
+                self._open(deployment, retry_after if retry_after is not None else self.cooldown)
+            elif broken or deployment.state == "half-open" or (
+                len(deployment.outcomes) >= self.min_requests and deployment.error_rate >= self.error_threshold
+            ):
+                self._open(deployment)
+
+    def release(self, deployment: Deployment) -> None:
+        """
+        Frees the probe slot of a half-open deployment whose request failed
+        for reasons of its own, without counting it as a success or a failure.
+        """
+        with self._lock:
+            deployment.probing = False
+
+    def complete(self, messages: List[Dict], model: str = MODEL, max_tokens: int = MAX_TOKENS, max_attempts: Optional[int] = None, **request_kwargs):
+        """
+        Sends a chat request to the pool, failing over on throttling, server
+        or connection errors and on misconfigured deployments (401, 403, 404).
+
+        Args:
+            messages (List[Dict]): The chat messages.
+            model (str): The model name.
+            max_tokens (int): The completion token limit.
+            max_attempts (int, optional): Deployments tried before giving up.
+                Defaults to twice the pool size.
+            **request_kwargs: Extra request arguments (e.g., response_format).
+
+        Returns:
+            ChatCompletion: The response.
+        """
+        max_attempts = max_attempts or 2 * len(self.deployments)
+        tried = []
+        for attempt in range(1, max_attempts + 1):
+            deployment = self.choose(exclude=tried)
+            tried.append(deployment)
+            start = time.perf_counter()
+            try:
+                response = deployment.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    **request_kwargs
+                )
+            except FAILOVER_ERRORS as e:
+                throttled = isinstance(e, RateLimitError)
+                retry_after = parse_retry_after(e.response.headers) if throttled else None
+                self.report(
+                    deployment, ok=False, retry_after=retry_after, throttled=throttled,
+                    broken=isinstance(e, DEPLOYMENT_ERRORS)
+                )
+                if attempt == max_attempts:
+                    raise
+                continue
+            except Exception:
+                # The request itself is at fault (e.g., a bad request or a
+                # content filter): the deployment's health is unknown
+                self.release(deployment)
+                raise
+            self.report(deployment, ok=True, latency=time.perf_counter() - start)
+            return response
+
+    def status(self) -> List[Dict]:
+        with self._lock:
+            return [deployment.status() for deployment in self.deployments]
+
+def load_pool(config: Optional[str] = None, **client_kwargs) -> Optional[DeploymentPool]:
+    """
+    Loads the deployment pool of a config file, defaulting to the
+    AZURE_OPENAI_DEPLOYMENTS environment variable (or .env entry). Returns None without one.
+    """
+    load_env()
+    config = config or os.getenv("AZURE_OPENAI_DEPLOYMENTS")
+    return DeploymentPool.from_config(config, **client_kwargs) if config else None
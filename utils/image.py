@@ -1,9 +1,190 @@
 from PIL import Image
 import io
+import os
 import base64
-from typing import Union
+import hashlib
+import threading
+from typing import Optional, Tuple, Union
 
-def image_to_base64(image_input: Union[Image.Image, str, bytes, io.BytesIO], format="JPEG") -> str:
+# GPT-4o vision sizing: "low" detail sees a 512px thumbnail, "high" detail fits
+# the image in 2048x2048 and then scales its short side down to 768px before
+# cutting it into 512px tiles. Anything larger is only extra upload.
+LOW_DETAIL_EDGE = 512
+HIGH_DETAIL_MAX_EDGE = 2048
+HIGH_DETAIL_SHORT_EDGE = 768
+# Stored image formats the API accepts as they are, with their MIME subtype
+PASSTHROUGH_FORMATS = {"JPEG": "jpeg", "PNG": "png", "WEBP": "webp"}
+
+def _open_image(image_input: Union[Image.Image, str, bytes, io.BytesIO]) -> Image.Image:
+    """
+    Opens any supported image input as a PIL.Image.Image.
+    """
+    if isinstance(image_input, Image.Image):
+        return image_input
+    elif isinstance(image_input, str):
+        return Image.open(image_input)
+    elif isinstance(image_input, (bytes, io.BytesIO)):
+        return Image.open(io.BytesIO(image_input if isinstance(image_input, bytes) else image_input.read()))
+    else:
+        raise TypeError("Unsupported image input type. Must be PIL.Image.Image, file path, bytes, or BytesIO.")
+
+def target_size(width: int, height: int, detail: str = "auto", max_edge: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Computes the size at which the vision model actually looks at an image.
+
+    Args:
+        width (int): Original width.
+        height (int): Original height.
+        detail (str): The `detail` level of the request ("low", "high" or "auto").
+            "auto" is sized like "high".
+        max_edge (int, optional): Extra cap on the long edge.
+
+    Returns:
+        Tuple[int, int]: The target (width, height). Images are never upscaled.
+    """
+    if detail == "low":
+        scale = LOW_DETAIL_EDGE / max(width, height)
+    else:
+        scale = min(
+            HIGH_DETAIL_MAX_EDGE / max(width, height),
+            HIGH_DETAIL_SHORT_EDGE / min(width, height)
+        )
+    if max_edge is not None:
+        scale = min(scale, max_edge / max(width, height))
+    if scale >= 1:
+        return width, height
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def image_tokens(width: int, height: int, detail: str = "auto") -> int:
+    """
+    Estimates the prompt tokens of an image: 85 base tokens, plus 170 per
+    512px tile of its target size unless the detail is "low".
+    """
+    if detail == "low":
+        return 85
+    width, height = target_size(width, height, detail)
+    return 85 + 170 * (-(-width // 512)) * (-(-height // 512))
+
+def encode_image(
+    image: Image.Image,
+    format: str = "JPEG",
+    quality: int = 85,
+    max_bytes: Optional[int] = None,
+    min_quality: int = 40
+) -> bytes:
+    """
+    Encodes a PIL image, lowering the JPEG quality until it fits `max_bytes`.
+
+    If the lowest quality is still too large, the image is downscaled by 25%
+    steps until it fits.
+
+    Args:
+        image (PIL.Image.Image): The image to encode.
+        format (str): The output format (e.g., "JPEG", "PNG").
+        quality (int): The starting JPEG quality.
+        max_bytes (int, optional): Size budget for the encoded image.
+        min_quality (int): The lowest JPEG quality to try.
+
+    Returns:
+        bytes: The encoded image.
+    """
+    if format.upper() in ("JPEG", "JPG") and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    while True:
+        q = quality
+        while True:
+            buffered = io.BytesIO()
+            if format.upper() in ("JPEG", "JPG"):
+                image.save(buffered, format=format, quality=q, optimize=True)
+            else:
+                image.save(buffered, format=format)
+            data = buffered.getvalue()
+            if max_bytes is None or len(data) <= max_bytes or format.upper() not in ("JPEG", "JPG") or q <= min_quality:
+                break
+            q = max(min_quality, q - 10)
+        if max_bytes is None or len(data) <= max_bytes or min(image.size) <= 64:
+            return data
+        image = image.resize((max(1, image.width * 3 // 4), max(1, image.height * 3 // 4)), Image.LANCZOS)
+
+def _source_hash(image_input: Union[Image.Image, str, bytes, io.BytesIO]) -> str:
+    """
+    Hashes the content of an image input, without re-encoding it.
+    """
+    h = hashlib.sha256()
+    if isinstance(image_input, Image.Image):
+        h.update(f"{image_input.mode}:{image_input.size}".encode())
+        h.update(image_input.tobytes())
+    elif isinstance(image_input, str):
+        with open(image_input, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    elif isinstance(image_input, bytes):
+        h.update(image_input)
+    elif isinstance(image_input, io.BytesIO):
+        h.update(image_input.getvalue())
+    else:
+        raise TypeError("Unsupported image input type. Must be PIL.Image.Image, file path, bytes, or BytesIO.")
+    return h.hexdigest()
+
+def raw_image_base64(
+    image_input: Union[str, bytes],
+    *,
+    detail: Optional[str] = None,
+    max_edge: Optional[int] = None,
+    max_bytes: Optional[int] = None
+) -> Optional[Tuple[str, str]]:
+    """
+    Base64-encodes stored image bytes as they are, without decoding them.
+
+    Only the image header is read, to check that the API accepts the format
+    and that the image needs no resizing for `detail`/`max_edge` and already
+    fits `max_bytes`; the pixels are never decoded or re-compressed.
+
+    Args:
+        image_input (Union[str, bytes]): The encoded image, or its file path.
+        detail (str, optional): The `detail` level the image will be sent with.
+        max_edge (int, optional): Extra cap on the long edge, in pixels.
+        max_bytes (int, optional): Size budget for the image.
+
+    Returns:
+        Optional[Tuple[str, str]]: The base64 string and the MIME type, or
+        None when the image has to be transcoded instead.
+    """
+    if isinstance(image_input, str):
+        if max_bytes is not None and os.path.getsize(image_input) > max_bytes:
+            return None
+        with open(image_input, 'rb') as f:
+            data = f.read()
+    else:
+        data = image_input
+    if max_bytes is not None and len(data) > max_bytes:
+        return None
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            subtype = PASSTHROUGH_FORMATS.get(image.format)
+            if subtype is None or image.mode not in ("RGB", "L", "RGBA", "LA", "P") or getattr(image, "n_frames", 1) > 1:
+                return None
+            if subtype == "jpeg" and image.mode not in ("RGB", "L"):
+                return None
+            if target_size(image.width, image.height, detail or "auto", max_edge) != image.size:
+                return None
+    except (OSError, SyntaxError, ValueError):
+        # Unreadable header: let the transcoding path report it
+        return None
+    return base64.b64encode(data).decode("utf-8"), f"image/{subtype}"
+
+def image_to_base64(
+    image_input: Union[Image.Image, str, bytes, io.BytesIO],
+    format="JPEG",
+    *,
+    detail: Optional[str] = None,
+    max_edge: Optional[int] = None,
+    quality: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    cache_dir: Optional[str] = None
+) -> str:
     """
     Converts an image to a base64-encoded string.
 
@@ -13,27 +194,60 @@ def image_to_base64(image_input: Union[Image.Image, str, bytes, io.BytesIO], for
     - a byte string (bytes),
     - or a BytesIO object.
 
+    Without any of the optional arguments, the image is re-encoded as is.
+    Otherwise it is first resized to what the vision model will actually see
+    for `detail`, then encoded within the `quality`/`max_bytes` budget.
+
     Args:
         image_input (Union[PIL.Image.Image, str, bytes, BytesIO]): The image to convert.
         format (str): The format to use when saving the image (default: "JPEG").
+        detail (str, optional): The `detail` level the image will be sent with
+            ("low", "high" or "auto"), used to pick the target size.
+        max_edge (int, optional): Extra cap on the long edge, in pixels.
+        quality (int, optional): JPEG quality (default: 85 when optimizing).
+        max_bytes (int, optional): Size budget for the encoded image.
+        cache_dir (str, optional): Directory where prepared payloads are cached,
+            keyed by the hash of the image content and the settings.
 
     Returns:
         str: The base64-encoded representation of the image.
     """
-    # Convert to PIL.Image.Image if not already
-    if isinstance(image_input, Image.Image):
-        image = image_input
-    elif isinstance(image_input, str):
-        image = Image.open(image_input)
-    elif isinstance(image_input, (bytes, io.BytesIO)):
-        image = Image.open(io.BytesIO(image_input if isinstance(image_input, bytes) else image_input.read()))
+    optimize = any(arg is not None for arg in (detail, max_edge, quality, max_bytes))
+
+    cache_file = None
+    if cache_dir is not None:
+        settings = f"{format}:{detail}:{max_edge}:{quality}:{max_bytes}"
+        key = hashlib.sha256(f"{_source_hash(image_input)}:{settings}".encode()).hexdigest()
+        cache_file = os.path.join(cache_dir, key[:2], f"{key}.b64")
+        if os.path.exists(cache_file):
+            with open(cache_file, 'r') as f:
+                return f.read()
+        if isinstance(image_input, io.BytesIO):
+            image_input.seek(0)
+
+    image = _open_image(image_input)
+
+    if optimize:
+        size = target_size(image.width, image.height, detail or "auto", max_edge)
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        data = encode_image(image, format=format, quality=quality or 85, max_bytes=max_bytes)
     else:
-        raise TypeError("Unsupported image input type. Must be PIL.Image.Image, file path, bytes, or BytesIO.")
+        # Save to a buffer as is
+        buffered = io.BytesIO()
+        image.save(buffered, format=format)
+        data = buffered.getvalue()
+
+    base64_str = base64.b64encode(data).decode("utf-8")
+
+    if cache_file is not None:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(base64_str)
+        os.replace(tmp_file, cache_file)
 
-    # Save to a buffer and encode
-    buffered = io.BytesIO()
-    image.save(buffered, format=format)
-    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+    return base64_str
 
 
 if __name__ == '__main__':
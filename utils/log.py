@@ -0,0 +1,47 @@
+from loguru import logger
+import os
+import sys
+
+def setup_logging(name: str, log_dir: str = "logs", level: str = "INFO") -> None:
+    """
+    Sends the loguru logs to stdout and to the `<name>.log` (warnings and
+    above) and `<name>_error.log` files of `log_dir`.
+
+    Called by the entry points rather than at import time, so that importing
+    a pipeline module leaves the logging configuration untouched.
+
+    Args:
+        name (str): Base name of the log files (e.g., "generate_caption").
+        log_dir (str): Directory of the log files. None logs to stdout only.
+        level (str): Minimum level printed to stdout.
+    """
+    logger.remove()
+    logger.add(
+        sys.stdout,
+        level=level,
+        colorize=True,
+        enqueue=True,
+        backtrace=True,
+        diagnose=False
+    )
+    if log_dir is None:
+        return
+    os.makedirs(log_dir, exist_ok=True)
+    logger.add(
+        os.path.join(log_dir, f"{name}_error.log"),
+        level="ERROR",
+        rotation="10 MB",
+        encoding="utf-8",
+        enqueue=True,
+        backtrace=True,
+        diagnose=False
+    )
+    logger.add(
+        os.path.join(log_dir, f"{name}.log"),
+        level="WARNING",
+        rotation="10 MB",
+        encoding="utf-8",
+        enqueue=True,
+        backtrace=True,
+        diagnose=False
+    )
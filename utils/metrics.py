@@ -0,0 +1,296 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional, Sequence
+
+METRIC_PREFIX = "afroannotation"
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (16_384, 65_536, 262_144, 1_048_576, 4_194_304, 16_777_216)
+
+class Histogram:
+    """
+    Cumulative Prometheus-style histogram.
+    """
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Estimates the q-quantile like Prometheus' `histogram_quantile`, by
+        linear interpolation within its bucket (the first bucket starts at 0).
+        Quantiles in the +Inf bucket return the highest finite bound, and an
+        empty histogram returns None.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative, lower = 0, 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.buckets[-1]
+
+    def lines(self, name: str) -> List[str]:
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            lines.append(f'{name}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f"{name}_sum {self.sum:g}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+class Metrics:
+    """
+    Per-request and per-stage metrics of a captioning run.
+
+    Every request is appended to a JSONL trace as it completes, and the
+    aggregated counters and histograms are written to a Prometheus textfile
+    (for the node exporter textfile collector) every `flush_every` requests
+    and on close. Both outputs are optional; the aggregates are always kept
+    in memory and returned by `snapshot()`. Safe to share across threads.
+
+    Args:
+        trace_path (str, optional): JSONL file receiving one event per request.
+        prometheus_path (str, optional): Prometheus textfile, rewritten atomically.
+        flush_every (int): Requests between two textfile writes.
+        labels (Dict[str, str], optional): Constant labels of every metric (e.g., run, shard).
+    """
+
+    def __init__(
+        self,
+        trace_path: Optional[str] = None,
+        prometheus_path: Optional[str] = None,
+        flush_every: int = 100,
+        labels: Optional[Dict[str, str]] = None
+    ):
+        self.trace_path = trace_path
+        self.prometheus_path = prometheus_path
+        self.flush_every = flush_every
+        self.labels = labels or {}
+        self._lock = threading.Lock()
+        self._trace = None
+        if trace_path is not None:
+            if os.path.dirname(trace_path):
+                os.makedirs(os.path.dirname(trace_path), exist_ok=True)
+            self._trace = open(trace_path, 'a', encoding='utf-8')
+
+        self.requests = Counter()
+        self.errors = Counter()
+        self.statuses = Counter()
+        self.tokens = Counter()
+        self.retries = 0
+        self.payload_bytes = 0
+        self.cache_hits = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.ttfb = Histogram(LATENCY_BUCKETS)
+        self.payload = Histogram(BYTES_BUCKETS)
+        self.stage_seconds = defaultdict(float)
+        self.stage_calls = Counter()
+
+    # ----------------------- recording -----------------------
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times a pipeline stage (e.g., "decode", "encode", "network", "write").
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(name, time.perf_counter() - start)
+
+    def observe_stage(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.stage_seconds[name] += seconds
+            self.stage_calls[name] += 1
+
+    def record_request(self, event: Dict) -> None:
+        """
+        Records one `describe_image` call.
+
+        Args:
+            event (Dict): The request event, with `latency`, `ttfb`,
+                `payload_bytes`, `attempts`, `statuses`, `usage`, `cached` and
+                `error` (the exception class name, or None) fields.
+        """
+        with self._lock:
+            outcome = "cached" if event.get("cached") else "error" if event.get("error") else "ok"
+            self.requests[outcome] += 1
+            if event.get("error"):
+                self.errors[event["error"]] += 1
+            if event.get("cached"):
+                self.cache_hits += 1
+            self.retries += max(0, event.get("attempts", 0) - 1)
+            self.statuses.update(str(status) for status in event.get("statuses", ()))
+            self.tokens.update({k: v for k, v in (event.get("usage") or {}).items() if v})
+            if not event.get("cached"):
+                self.latency.observe(event["latency"])
+            if event.get("ttfb") is not None:
+                self.ttfb.observe(event["ttfb"])
+            if event.get("payload_bytes"):
+                self.payload_bytes += event["payload_bytes"]
+                self.payload.observe(event["payload_bytes"])
+
+            if self._trace is not None:
+                self._trace.write(json.dumps({"time": time.time(), **self.labels, **event}, ensure_ascii=False) + "\n")
+                self._trace.flush()
+            flush = self.prometheus_path is not None and sum(self.requests.values()) % self.flush_every == 0
+        if flush:
+            self.write_prometheus()
+
+    # ----------------------- reporting -----------------------
+    def snapshot(self) -> Dict:
+        """
+        Returns the aggregated metrics as a dict.
+        """
+        with self._lock:
+            latency = self.latency
+            return {
+                "requests": dict(self.requests),
+                "errors": dict(self.errors),
+                "statuses": dict(self.statuses),
+                "retries": self.retries,
+                "cache_hits": self.cache_hits,
+                "payload_bytes": self.payload_bytes,
+                "tokens": dict(self.tokens),
+                "mean_latency": latency.sum / latency.count if latency.count else None,
+                "p50_latency": latency.quantile(0.5),
+                "p95_latency": latency.quantile(0.95),
+                "mean_ttfb": self.ttfb.sum / self.ttfb.count if self.ttfb.count else None,
+                "stage_seconds": dict(self.stage_seconds),
+                "stage_calls": dict(self.stage_calls)
+            }
+
+    def _label_str(self, **extra) -> str:
+        labels = {**self.labels, **extra}
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+    def prometheus_text(self) -> str:
+        """
+        Renders the metrics in the Prometheus text exposition format.
+        """
+        p = METRIC_PREFIX
+        with self._lock:
+            lines = [
+                f"# HELP {p}_requests_total Caption requests by outcome.",
+                f"# TYPE {p}_requests_total counter",
+                *(f"{p}_requests_total{self._label_str(outcome=k)} {v}" for k, v in sorted(self.requests.items())),
+                f"# HELP {p}_request_errors_total Failed caption requests by error class.",
+                f"# TYPE {p}_request_errors_total counter",
+                *(f"{p}_request_errors_total{self._label_str(error_class=k)} {v}" for k, v in sorted(self.errors.items())),
+                f"# HELP {p}_http_responses_total HTTP responses by status code, retries included.",
+                f"# TYPE {p}_http_responses_total counter",
+                *(f"{p}_http_responses_total{self._label_str(status=k)} {v}" for k, v in sorted(self.statuses.items())),
+                f"# HELP {p}_request_retries_total HTTP attempts beyond the first one.",
+                f"# TYPE {p}_request_retries_total counter",
+                f"{p}_request_retries_total{self._label_str()} {self.retries}",
+                f"# HELP {p}_payload_bytes_total Request body bytes uploaded.",
+                f"# TYPE {p}_payload_bytes_total counter",
+                f"{p}_payload_bytes_total{self._label_str()} {self.payload_bytes}",
+                f"# HELP {p}_tokens_total Token usage reported by the API.",
+                f"# TYPE {p}_tokens_total counter",
+                *(f"{p}_tokens_total{self._label_str(kind=k)} {v}" for k, v in sorted(self.tokens.items())),
+                f"# HELP {p}_stage_seconds_total Time spent in each pipeline stage, summed over threads.",
+                f"# TYPE {p}_stage_seconds_total counter",
+                *(f"{p}_stage_seconds_total{self._label_str(stage=k)} {v:g}" for k, v in sorted(self.stage_seconds.items())),
+                f"# HELP {p}_stage_calls_total Number of times each pipeline stage ran.",
+                f"# TYPE {p}_stage_calls_total counter",
+                *(f"{p}_stage_calls_total{self._label_str(stage=k)} {v}" for k, v in sorted(self.stage_calls.items())),
+            ]
+            for name, histogram, help_text in (
+                (f"{p}_request_duration_seconds", self.latency, "Caption request latency, retries included."),
+                (f"{p}_time_to_first_byte_seconds", self.ttfb, "Time to the response headers of each HTTP attempt."),
+                (f"{p}_payload_bytes", self.payload, "Request body size."),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                lines += [self._with_labels(line) for line in histogram.lines(name)]
+        return "\n".join(lines) + "\n"
+
+    def _with_labels(self, line: str) -> str:
+        if not self.labels:
+            return line
+        name, value = line.rsplit(" ", 1)
+        constant = ",".join(f'{k}="{v}"' for k, v in self.labels.items())
+        if name.endswith("}"):
+            return f"{name[:-1]},{constant}}} {value}"
+        return f"{name}{{{constant}}} {value}"
+
+    def write_prometheus(self, path: Optional[str] = None) -> None:
+        """
+        Atomically writes the Prometheus textfile.
+        """
+        path = path or self.prometheus_path
+        if path is None:
+            return
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+    def close(self) -> None:
+        """
+        Writes the final textfile and closes the trace.
+        """
+        self.write_prometheus()
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
+
+def stage(metrics: Optional[Metrics], name: str):
+    """
+    Times a stage on `metrics`, or does nothing when it is None.
+    """
+    return metrics.stage(name) if metrics is not None else nullcontext()
+
+# --------------------------- HTTP ATTEMPTS ---------------------------
+# httpx event hooks run in the calling thread, so each thread collects the
+# attempts of the request it is making.
+_attempts = threading.local()
+
+@contextmanager
+def track_http_attempts():
+    """
+    Collects the HTTP attempts made by the current thread while in the block.
+
+    Yields:
+        List[Dict]: One dict per attempt, with `status`, `ttfb` and `request_bytes`
+        (status and ttfb are None when no response was received).
+    """
+    _attempts.log = []
+    try:
+        yield _attempts.log
+    finally:
+        _attempts.log = None
+
+def on_http_request(request) -> None:
+    log = getattr(_attempts, "log", None)
+    if log is not None:
+        log.append({"status": None, "ttfb": None, "request_bytes": len(request.content), "start": time.perf_counter()})
+
+def on_http_response(response) -> None:
+    log = getattr(_attempts, "log", None)
+    if log:
+        attempt = log[-1]
+        attempt["status"] = response.status_code
+        attempt["ttfb"] = time.perf_counter() - attempt.pop("start")
@@ -0,0 +1,283 @@
+from PIL import Image
+import base64
+import io
+import json
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from utils.image import image_tokens
+
+# Azure enforces the per-minute quotas over short windows, so buckets only
+# hold a few seconds' worth of budget instead of a full minute.
+BURST_SECONDS = 10.0
+# Tokens assumed for an image given by URL, whose size is unknown (4 tiles)
+URL_IMAGE_TOKENS = 765
+# Base64 characters of a data URL decoded to read the image size (48 KiB of
+# image bytes): the header comes first, so the pixels are never decoded
+HEADER_BASE64_CHARS = 65536
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `rate_per_minute`.
+
+    Args:
+        rate_per_minute (float): Refill rate.
+        burst_seconds (float): Capacity, in seconds of refill.
+    """
+
+    def __init__(self, rate_per_minute: float, burst_seconds: float = BURST_SECONDS):
+        self.rate_per_minute = rate_per_minute
+        self.capacity = max(1.0, rate_per_minute * burst_seconds / 60)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float, scale: float = 1.0) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate_per_minute * scale / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float, scale: float = 1.0) -> float:
+        """
+        Seconds until `amount` is available (amounts above the capacity wait for a full bucket).
+        """
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60 / (self.rate_per_minute * scale))
+
+    def consume(self, amount: float) -> None:
+        self.level -= min(amount, self.capacity)
+
+class RateLimiter:
+    """
+    Adaptive requests-per-minute and tokens-per-minute limiter.
+
+    Every HTTP attempt waits for one request and its estimated tokens in the
+    two buckets, and for any `retry-after` pause set by a 429. Responses feed
+    the limiter back: a 429 pauses every caller for its `retry-after` (with
+    jitter) and lowers the refill rate once per throttling episode; successes
+    slowly restore it; the `x-ratelimit-remaining-*` headers cap the buckets
+    to what the service reports as left. Safe to share across threads.
+
+    Args:
+        rpm (float, optional): Requests per minute quota. None means unlimited.
+        tpm (float, optional): Tokens per minute quota. None means unlimited.
+        burst_seconds (float): Bucket capacity, in seconds of quota.
+        min_scale (float): Lowest fraction of the quota the rate adapts down to.
+        decrease (float): Rate multiplier applied on every 429.
+        increase (float): Rate fraction recovered on every success.
+        max_retries (int): Rate-limited, failed and unreachable attempts
+            retried by `describe_image`.
+        base_delay (float): First backoff delay without `retry-after`, in seconds.
+        max_delay (float): Maximum backoff delay, in seconds.
+    """
+
+    def __init__(
+        self,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        burst_seconds: float = BURST_SECONDS,
+        min_scale: float = 0.1,
+        decrease: float = 0.7,
+        increase: float = 0.02,
+        max_retries: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0
+    ):
+        self.burst_seconds = burst_seconds
+        self.requests = TokenBucket(rpm, burst_seconds) if rpm else None
+        self.tokens = TokenBucket(tpm, burst_seconds) if tpm else None
+        self.min_scale = min_scale
+        self.decrease = decrease
+        self.increase = increase
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.scale = 1.0
+        self.blocked_until = 0.0
+        self.throttled = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def quota(self) -> Tuple[Optional[float], Optional[float]]:
+        """
+        Returns the requests and tokens per minute quotas (None when unlimited).
+        """
+        with self._lock:
+            return (
+                self.requests.rate_per_minute if self.requests else None,
+                self.tokens.rate_per_minute if self.tokens else None
+            )
+
+    def set_quota(self, rpm: Optional[float] = None, tpm: Optional[float] = None) -> None:
+        """
+        Changes the quotas, keeping the current pause and adaptive rate.
+        """
+        with self._lock:
+            if (self.requests.rate_per_minute if self.requests else None) != rpm:
+                self.requests = TokenBucket(rpm, self.burst_seconds) if rpm else None
+            if (self.tokens.rate_per_minute if self.tokens else None) != tpm:
+                self.tokens = TokenBucket(tpm, self.burst_seconds) if tpm else None
+
+    def acquire(self, tokens: int = 0) -> float:
+        """
+        Blocks until one request with `tokens` estimated tokens fits the budget.
+
+        Returns:
+            float: The time waited, in seconds.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self.blocked_until - now
+                for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+                    if bucket is not None:
+                        bucket.refill(now, self.scale)
+                        wait = max(wait, bucket.wait_time(amount, self.scale))
+                if wait <= 0:
+                    for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+                        if bucket is not None:
+                            bucket.consume(amount)
+                    self.waited += waited
+                    return waited
+            # Jitter spreads the callers woken up at the same time
+            delay = wait * random.uniform(1.0, 1.1)
+            time.sleep(delay)
+            waited += delay
+
+    def on_response(self, status: int, headers) -> None:
+        """
+        Adapts the limiter to a response's status and rate-limit headers.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if status == 429:
+                self.throttled += 1
+                # Concurrent 429s of the same throttling episode lower the rate once
+                if now >= self.blocked_until:
+                    self.scale = max(self.min_scale, self.scale * self.decrease)
+                retry_after = parse_retry_after(headers)
+                pause = retry_after if retry_after is not None else self.base_delay
+                self.blocked_until = max(self.blocked_until, now + pause * random.uniform(1.0, 1.2))
+            elif 200 <= status < 300:
+                self.scale = min(1.0, self.scale + self.increase)
+
+            for bucket, header in ((self.requests, "x-ratelimit-remaining-requests"), (self.tokens, "x-ratelimit-remaining-tokens")):
+                remaining = _header_number(headers, header)
+                if bucket is not None and remaining is not None:
+                    bucket.refill(now, self.scale)
+                    bucket.level = min(bucket.level, remaining)
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Returns the delay before retry number `attempt`: the `retry-after` when
+        given, else an exponential backoff with jitter.
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+        return max(delay, retry_after or 0.0)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"scale": self.scale, "throttled": self.throttled, "waited": self.waited}
+
+    # httpx event hooks, installed by `get_client`
+    def before_request(self, request) -> None:
+        if request.url.path.endswith("/chat/completions"):
+            self.acquire(estimate_request_tokens(request.content))
+
+    def after_response(self, response) -> None:
+        if response.request.url.path.endswith("/chat/completions"):
+            self.on_response(response.status_code, response.headers)
+
+def _header_number(headers, name: str) -> Optional[float]:
+    value = headers.get(name) if headers is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def parse_retry_after(headers) -> Optional[float]:
+    """
+    Reads the `retry-after-ms` or `retry-after` header, in seconds.
+    """
+    retry_after_ms = _header_number(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    return _header_number(headers, "retry-after")
+
+def _data_url_size(url: str) -> Optional[Tuple[int, int]]:
+    """
+    Reads the size of a data URL image from the start of its data, or from
+    all of it when the header lies further in (e.g., after a large EXIF block).
+    """
+    data = url.split(",", 1)[1]
+    chunks = (data[:HEADER_BASE64_CHARS], data) if len(data) > HEADER_BASE64_CHARS else (data,)
+    for chunk in chunks:
+        try:
+            return Image.open(io.BytesIO(base64.b64decode(chunk))).size
+        except Exception:
+            continue
+    return None
+
+def _image_part_tokens(part: Dict) -> int:
+    image_url = part.get("image_url") or {}
+    url, detail = image_url.get("url", ""), image_url.get("detail", "auto")
+    if detail == "low":
+        return image_tokens(0, 0, "low")
+    if url.startswith("data:"):
+        size = _data_url_size(url)
+        if size is not None:
+            return image_tokens(*size, detail)
+    return URL_IMAGE_TOKENS
+
+def estimate_request_tokens(body: bytes) -> int:
+    """
+    Estimates the tokens a chat request counts against the TPM quota: its
+    text (about 4 characters per token), its image tiles and its `max_tokens`.
+    """
+    try:
+        request = json.loads(body)
+    except (ValueError, UnicodeDecodeError):
+        return 0
+    tokens = request.get("max_tokens") or request.get("max_completion_tokens") or 0
+    for message in request.get("messages", []):
+        content = message.get("content")
+        tokens += 4
+        if isinstance(content, str):
+            tokens += len(content) // 4 + 1
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                tokens += len(part.get("text", "")) // 4 + 1
+            elif part.get("type") == "image_url":
+                tokens += _image_part_tokens(part)
+    return tokens
+
+# Shared limiters, keyed by process id, endpoint and deployment
+_limiters: Dict[Tuple, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(azure_endpoint: str, azure_deployment: str, rpm: Optional[float] = None, tpm: Optional[float] = None) -> RateLimiter:
+    """
+    Returns the rate limiter shared by every client of a deployment in this process.
+
+    Quotas default to the AZURE_OPENAI_RPM and AZURE_OPENAI_TPM environment
+    variables; without them, only `retry-after` pauses are applied. The
+    quotas of an existing limiter only change when `rpm` or `tpm` is given,
+    so that a later call without them keeps the quotas set earlier.
+    """
+    key = (os.getpid(), azure_endpoint, azure_deployment)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = RateLimiter(
+                rpm=rpm if rpm is not None else _header_number(os.environ, "AZURE_OPENAI_RPM"),
+                tpm=tpm if tpm is not None else _header_number(os.environ, "AZURE_OPENAI_TPM")
+            )
+        elif rpm is not None or tpm is not None:
+            limiter.set_quota(
+                rpm=rpm if rpm is not None else limiter.quota()[0],
+                tpm=tpm if tpm is not None else limiter.quota()[1]
+            )
+    return limiter
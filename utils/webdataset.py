@@ -0,0 +1,244 @@
+from PIL import Image
+from typing import Dict, Iterable, Iterator, List, Optional
+import io
+import json
+import os
+import random
+import tarfile
+import time
+
+# Shard index written next to the tar shards
+INDEX_FILE = "index.json"
+# Extensions of the stored image formats, used as the image member suffix
+IMAGE_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif", "BMP": "bmp", "TIFF": "tif"}
+# Tar block size: every member has a header block and its data padded to blocks
+TAR_BLOCK = tarfile.BLOCKSIZE
+# Tar files end with two zero blocks and are padded to a whole record
+TAR_RECORD = tarfile.RECORDSIZE
+
+def sample_key(index: int) -> str:
+    """
+    Returns the key of a sample: its zero-padded dataset index, so that
+    member names sort like the dataset and contain no extra dots.
+    """
+    return f"{index:09d}"
+
+def tar_member_size(size: int) -> int:
+    """
+    Returns the bytes a member of `size` bytes takes in a tar file: its
+    header block plus its data padded to whole blocks.
+    """
+    return TAR_BLOCK + -(-size // TAR_BLOCK) * TAR_BLOCK
+
+def tar_file_size(members_size: int) -> int:
+    """
+    Returns the size of a tar file whose members take `members_size` bytes,
+    with the end-of-archive blocks and the padding to a whole record.
+    """
+    return -(-(members_size + 2 * TAR_BLOCK) // TAR_RECORD) * TAR_RECORD
+
+def sample_fields(fields: Dict) -> bytes:
+    """
+    Encodes the JSON member of a sample.
+    """
+    return json.dumps(fields, ensure_ascii=False).encode("utf-8")
+
+def image_extension(data: bytes) -> str:
+    """
+    Returns the file extension of encoded image bytes, from their header only.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        return IMAGE_EXTENSIONS.get(image.format, (image.format or "img").lower())
+
+class TarShardWriter:
+    """
+    Writes samples to a tar shard in the WebDataset layout: the members of a
+    sample share its key and are written next to each other, e.g.,
+    `000000042.jpg` (the stored image bytes) and `000000042.json` (its caption,
+    prompt and other fields).
+
+    The shard is written under a temporary name and renamed when closed, so a
+    shard that exists is complete.
+
+    Args:
+        path (str): The tar shard to write.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.samples = 0
+        self._tmp_path = f"{path}.{os.getpid()}.tmp"
+        self._tar = tarfile.open(self._tmp_path, "w")
+        # Whole seconds: a float mtime costs every member an extra PAX header
+        self._mtime = int(time.time())
+
+    def _add(self, name: str, data: bytes) -> None:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = self._mtime
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def write(self, key: str, image: bytes, fields: Dict) -> None:
+        """
+        Appends one sample: its image bytes and its JSON fields.
+        """
+        self._add(f"{key}.{image_extension(image)}", image)
+        self._add(f"{key}.json", sample_fields(fields))
+        self.samples += 1
+
+    def close(self) -> None:
+        if self._tar is None:
+            return
+        self._tar.close()
+        self._tar = None
+        os.replace(self._tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+            return
+        # Leave no partial shard behind
+        self._tar.close()
+        self._tar = None
+        os.remove(self._tmp_path)
+
+def write_index(output_dir: str, shards: List[Dict], **info) -> str:
+    """
+    Writes the shard index of an export: the shard files with their sample
+    counts and sizes, plus any extra `info` (e.g., the source dataset).
+
+    Returns:
+        str: The index file.
+    """
+    index = {
+        "format": "webdataset",
+        "num_samples": sum(shard["samples"] for shard in shards),
+        "num_bytes": sum(shard["bytes"] for shard in shards),
+        **info,
+        "shards": shards
+    }
+    index_file = os.path.join(output_dir, INDEX_FILE)
+    tmp_file = f"{index_file}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, index_file)
+    return index_file
+
+def load_index(path: str) -> Dict:
+    """
+    Loads the shard index of an export directory (or of its index file), with
+    the shard file paths made absolute.
+    """
+    index_file = os.path.join(path, INDEX_FILE) if os.path.isdir(path) else path
+    with open(index_file, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(index_file))
+    for shard in index["shards"]:
+        shard["path"] = os.path.join(base_dir, shard["file"])
+    return index
+
+def iter_tar_samples(path: str) -> Iterator[Dict]:
+    """
+    Streams the samples of a tar shard, reading it sequentially from start to
+    end (no seeks), which suits network storage.
+
+    Yields:
+        dict: The `__key__` of each sample, its JSON fields and its image bytes as "image".
+    """
+    with open(path, 'rb') as f, tarfile.open(fileobj=f, mode="r|") as tar:
+        key, sample = None, None
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, _, extension = member.name.partition(".")
+            data = tar.extractfile(member).read()
+            if member_key != key:
+                if sample is not None:
+                    yield sample
+                key, sample = member_key, {"__key__": member_key}
+            if extension == "json":
+                sample.update(json.loads(data))
+            else:
+                sample["image"] = data
+        if sample is not None:
+            yield sample
+
+def shuffle_buffer(samples: Iterable, size: int, rng: random.Random) -> Iterator:
+    """
+    Shuffles a stream with a buffer of `size` items: each incoming item takes
+    the place of a random buffered one, which is yielded.
+    """
+    buffer = []
+    for sample in samples:
+        if len(buffer) < size:
+            buffer.append(sample)
+            continue
+        i = rng.randrange(size)
+        buffer[i], sample = sample, buffer[i]
+        yield sample
+    rng.shuffle(buffer)
+    yield from buffer
+
+def iter_webdataset(
+    path: str,
+    shuffle: int = 1000,
+    seed: Optional[int] = None,
+    epoch: int = 0,
+    rank: int = 0,
+    world_size: int = 1,
+    decode: bool = True
+) -> Iterator[Dict]:
+    """
+    Streams the samples of a tar shard export, e.g., for a training loop.
+
+    Shards are read sequentially, in an order shuffled per epoch, and samples
+    are mixed across shards by a shuffle buffer. With `world_size > 1`, every
+    reader (e.g., one per training process or DataLoader worker) shuffles the
+    full shard list the same way, from `seed` and `epoch` only, then reads
+    every `world_size`-th shard from `rank`: readers never read the same
+    shard, and each reader gets different shards every epoch.
+
+    Args:
+        path (str): The export directory (or its index file).
+        shuffle (int): Size of the shuffle buffer. 0 reads the samples in order.
+        seed (int, optional): Seed of the shard order and the shuffle buffer.
+            Must be the same for every reader; with several readers, None
+            stands for 0 in the shard order.
+        epoch (int): The epoch, mixed into the seed so that every epoch has its own order.
+        rank (int): Index of this reader.
+        world_size (int): Number of readers sharing the shards.
+        decode (bool): Whether to decode images into PIL images; otherwise
+            they are returned as their stored bytes.
+
+    Yields:
+        dict: The sample's `image`, `prompt`, `caption` and other fields, with its `__key__`.
+
+    Raises:
+        ValueError: If there are fewer shards than readers, or `rank` is out of range.
+    """
+    if not 0 <= rank < world_size:
+        raise ValueError(f"Rank {rank} is out of range for {world_size} readers.")
+    index = load_index(path)
+    shards = [shard["path"] for shard in index["shards"]]
+    if len(shards) < world_size:
+        raise ValueError(
+            f"The export has {len(shards)} shards for {world_size} readers; some readers would get "
+            f"no data. Export with a smaller max_shard_size or use fewer readers."
+        )
+    if shuffle:
+        # Same order on every reader, so that the rank slices never overlap
+        shared_seed = seed if seed is not None or world_size == 1 else 0
+        random.Random(None if shared_seed is None else f"{shared_seed}:{epoch}").shuffle(shards)
+    shards = shards[rank::world_size]
+    rng = random.Random(None if seed is None else f"{seed}:{epoch}:{rank}")
+
+    samples = (sample for shard in shards for sample in iter_tar_samples(shard))
+    if shuffle:
+        samples = shuffle_buffer(samples, shuffle, rng)
+    for sample in samples:
+        if decode:
+            sample["image"] = Image.open(io.BytesIO(sample["image"]))
+        yield sample